@@ -14,7 +14,34 @@ const SETTINGS = Settings(15)
 
 # Dict for storing A_matrices
 const A_matrix = Dict{Tuple{Int64, Int64, Int64, Int64, Float64, Float64, Float64,
-                            Float64}, Matrix{Float64}}()
+                            Float64}, SparseMatrixCSC{Float64, Int64}}()
+
+# Dict for storing factorizations of the interpolation operator, keyed by 
+# the grid size, the linear indices of the punched voxels, and the Matern 
+# parameters. Each factorization is stored with its own lock, since solves 
+# using the same factorization share its workspace. CACHE_LOCK only guards 
+# lookups and inserts, so solves with different factorizations can run 
+# concurrently. The keys of both caches are kept in order of use, so the 
+# least recently used entry is evicted when a cache is full.
+const FactorizationKey = Tuple{Int64, Int64, Int64, Vector{Int64}, Int64, 
+                               Float64, Float64, Float64, Float64}
+const A_factorization = Dict{FactorizationKey, Tuple{Any, ReentrantLock}}()
+const A_factorization_order = FactorizationKey[]
+const A_matrix_order = Tuple{Int64, Int64, Int64, Int64, Float64, Float64, 
+                             Float64, Float64}[]
+const CACHE_LOCK = ReentrantLock()
+
+""" Helper function to mark a cache key as used, evicting the least recently
+used entries if the cache is full. It must be called holding CACHE_LOCK. """
+function _cache_use!(cache, order, key)
+    i = findfirst(isequal(key), order)
+    i === nothing || deleteat!(order, i)
+    push!(order, key)
+    while length(order) > SETTINGS.A_matrix_STORE_MAX
+        delete!(cache, popfirst!(order))
+    end
+end
+
 """
   nablasq_3d_grid(Nx,Ny)
 
@@ -62,18 +89,74 @@ end
 
 """ Helper function to give the matern matrix """
 function _Matern_matrix(Nx, Ny, Nz, m, eps, h, k, l)
-    #haskey(A_matrix, (Nx, Ny, Nz, m, eps, h, k, l)) && return A_matrix[(Nx, Ny, Nz, m, eps, h, k, l)]
+    key = (Nx, Ny, Nz, m, Float64(eps), Float64(h), Float64(k), Float64(l))
+    A3DMatern = lock(CACHE_LOCK) do
+        haskey(A_matrix, key) || return nothing
+        _cache_use!(A_matrix, A_matrix_order, key)
+        return A_matrix[key]
+    end
+    A3DMatern === nothing || return A3DMatern
     A3D = nablasq_3d_grid(Nx, Ny, Nz, h, k, l) 
     sizeA = size(A3D, 1)
     for i = 1:sizeA
         A3D[i, i] = A3D[i, i] + eps^2
     end
-    A3DMatern = A3D^m
-    #length(A_matrix) <  SETTINGS.A_matrix_STORE_MAX && (A_matrix[(Nx, Ny, Nz, m, eps, h, k, l)] = A3DMatern)
-    #if length(A_matrix) == SETTINGS.A_matrix_STORE_MAX
-    #  @warn "A_matrix cache full, no longer caching Laplace interpolation matrices."
-    #end
-    A3DMatern
+    A3DMatern = A3D
+    for i = 1:m - 1
+        A3DMatern = A3DMatern * A3D
+    end
+    lock(CACHE_LOCK) do
+        A_matrix[key] = A3DMatern
+        _cache_use!(A_matrix, A_matrix_order, key)
+    end
+    return A3DMatern
+end
+
+"""
+  _matern_factorization(Nx, Ny, Nz, discard, m, eps, h, k, l)
+
+Return the LU factorization of the interpolation operator for a punched grid
+
+The operator only depends on the grid size, the punched voxels, and the Matern
+parameters, so its factorization is cached and reused by every interpolation 
+with the same punch, leaving only a back-substitution per call.
+
+# Arguments
+  - `Nx, Ny, Nz::Int64`: The number of nodes in each dimension
+  - `discard::Vector{Int64}`: the sorted linear indices of the punched voxels
+  - `m::Int64`: Matern parameter
+  - `eps::Float64`: Matern parameter eps
+  - `h, k, l`: Aspect ratios in each dimension
+
+# Outputs
+  - factorization of the sparse interpolation operator
+  - lock to be held while solving with the factorization
+"""
+function _matern_factorization(Nx, Ny, Nz, discard, m, eps, h, k, l)
+    key = (Nx, Ny, Nz, discard, m, Float64(eps), Float64(h), Float64(k), 
+           Float64(l))
+    entry = lock(CACHE_LOCK) do
+        haskey(A_factorization, key) || return nothing
+        _cache_use!(A_factorization, A_factorization_order, key)
+        return A_factorization[key]
+    end
+    entry === nothing || return entry
+    A3D = (eps == 0.0)&&(m == 1) ? 
+                nablasq_3d_grid(Nx, Ny, Nz, h, k, l) :
+                _Matern_matrix(Nx, Ny, Nz, m, eps, h, k, l) 
+    totalsize = Nx * Ny * Nz
+    C = sparse(I, totalsize, totalsize)
+    for j in discard
+        C[j, j] = 0.0
+    end
+    Id = sparse(I, totalsize, totalsize)    
+    F = lu(C - (Id - C) * A3D)
+    # If another task factorized the same operator meanwhile, use its entry
+    return lock(CACHE_LOCK) do
+        entry = get!(A_factorization, key, (F, ReentrantLock()))
+        _cache_use!(A_factorization, A_factorization_order, key)
+        return entry
+    end
 end
 
 """
@@ -102,19 +185,13 @@ function matern_3d_grid(imgg, discard::Union{Vector{CartesianIndex{3}}, Vector{I
                 m::Int64 = 1,  eps::Float64 = 0.0, 
                 h = 1.0, k = 1.0, l = 1.0) 
     Nx, Ny, Nz = size(imgg)
-    A3D = (eps == 0.0)&&(m == 1) ? 
-                nablasq_3d_grid(Nx, Ny, Nz, h, k, l) :
-                _Matern_matrix(Nx, Ny, Nz, m, eps, h, k, l) 
-    totalsize = Nx * Ny * Nz
-    C = sparse(I, totalsize, totalsize)
-    rhs_a = copy(imgg)[:]
-    for i in discard
-        j = (typeof(i) <: CartesianIndex) ? LinearIndices(imgg)[i] : i
-        C[j, j] = 0.0
-        rhs_a[j] = 0.0
-    end
-    Id = sparse(I, totalsize, totalsize)    
-    u = ((C - (Id - C) * A3D)) \ rhs_a
+    linear = sort!([(typeof(i) <: CartesianIndex) ? LinearIndices((Nx, Ny, Nz))[i] : i 
+                    for i in discard])
+    F, solve_lock = _matern_factorization(Nx, Ny, Nz, linear, m, eps, h, k, l)
+    rhs_a = Vector{Float64}(vec(imgg))
+    rhs_a[linear] .= 0.0
+    # Only solves sharing a factorization (and its workspace) are serialized
+    u = lock(() -> F \ rhs_a, solve_lock)
     return reshape(u, Nx, Ny, Nz)
 end
 
@@ -78,27 +78,11 @@ end
 
 """
 function Matern3D_Grid(xpoints, ypoints, zpoints, imgg, epsilon, radius, h, k, l, m)
-    A3D = nablasq_3d_grid(length(xpoints), length(ypoints), length(zpoints), h, k, l)
-    sizeA = size(A3D, 1)
-    for i = 1:sizeA
-        A3D[i, i] = A3D[i, i] + epsilon^2
-    end
-    A3DMatern = A3D
-    for i = 1:m - 1
-        A3DMatern = A3DMatern * A3D
-    end
     discard = punch_holes_nexus(xpoints, ypoints, zpoints, radius)
     punched_image = copy(imgg)
     punched_image[discard] .= 1
-    totalsize = prod(size(imgg))
-    C = sparse(I, totalsize, totalsize)
-    rhs_a = punched_image[:]
-    for i in discard
-        C[i, i] = 0
-        rhs_a[i] = 0
-    end
-    Id = sparse(I, totalsize, totalsize)    
-    u = ((C - (Id - C) * A3DMatern)) \ rhs_a
+    u = matern_3d_grid(punched_image, vec(collect(discard)), m, 
+                       Float64(epsilon), h, k, l)[:]
     return (u, punched_image[:])
 end
 
@@ -123,19 +107,10 @@ end
 
 """
 function Laplace3D_Grid(xpoints, ypoints, zpoints, imgg, radius, h, k, l)
-    A3D = nablasq_3d_grid(length(xpoints), length(ypoints), length(zpoints), h, k, l)
     discard = punch_holes_nexus(xpoints, ypoints, zpoints, radius)
     punched_image = copy(imgg)
     punched_image[discard] .= 1
-    totalsize = prod(size(imgg))
-    C = sparse(I, totalsize, totalsize)
-    rhs_a = punched_image[:]
-    for i in discard
-        C[i,i] = 0
-        rhs_a[i] = 0
-    end
-    Id = sparse(I, totalsize, totalsize)
-    u = ((C - (Id - C) * A3D)) \ rhs_a
+    u = matern_3d_grid(punched_image, vec(collect(discard)), 1, 0.0, h, k, l)[:]
     return u, punched_image[:]
 end
 
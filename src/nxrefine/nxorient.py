@@ -218,35 +218,41 @@ class UBMatrixFFT:
         self._phi_list = phi_list
 
     def _projection(self, data:np.ndarray, idx_factor:float) -> np.ndarray:
-        """project onto one direction
+        """project onto one or more directions
         Geometry/Crystal/IndexingUtils::GetMagFFT - line 1601 to 1609
 
         Parameters
         ----------
         data: np.ndarray
-
+            projections of the q vectors, either a 1D array for one
+            direction or an m x n array for m directions
         idx_factor: float
+            number of histogram bins per unit of projection
 
+        Returns
+        -------
+        np.ndarray
+            histograms of the absolute projections, with fft_num bins
+            along the last axis
         """
-        proj = np.zeros(self.fft_num, dtype=np.float32)
-        for elem in data*idx_factor:
-            idx = math.floor(abs(elem))
-            if idx < self.fft_num:
-                proj[idx] += 1
-            else: # this should not happen, but trap it in case of rounding errors
-                proj[idx-1] += 1
-        return proj
+        single = np.ndim(data) == 1
+        data = np.atleast_2d(data)
+        idx = np.floor(np.abs(data*idx_factor)).astype(np.intp)
+        # this should not happen, but trap it in case of rounding errors
+        np.minimum(idx, self.fft_num-1, out=idx)
+        idx += self.fft_num * np.arange(data.shape[0])[:, np.newaxis]
+        proj = np.bincount(idx.ravel(), minlength=data.shape[0]*self.fft_num)
+        proj = proj.reshape(data.shape[0], self.fft_num).astype(np.float32)
+        return proj[0] if single else proj
 
     def _projection_list_cal(self) -> None:
         """project onto all directions"""
-        self._p_list = (self.q_vectors@self._t_list.T).T
-        self._fj_list = np.zeros((self._p_list.shape[0], self.fft_num), dtype=np.float32)
+        self._p_list = self._t_list @ self.q_vectors.T
 
         self._q_max = norm(self.q_vectors, axis=1).max() * 1.1
         idx_factor = self.fft_num / self._q_max
 
-        for i in range(self._p_list.shape[0]):
-            self._fj_list[i] += self._projection(self._p_list[i], idx_factor)
+        self._fj_list = self._projection(self._p_list, idx_factor)
 
     def _max_mag_fft_cal(self) -> None:
         """Geometry/Crystal/IndexingUtils::GetMagFFT"""
@@ -13,12 +13,861 @@ from pathlib import Path
 
 import numpy as np
 import scipy.fft
-from nexusformat.nexus import (NeXusError, NXdata, NXentry, NXfield, NXlink,
-                               nxgetconfig, nxopen, nxsetconfig)
+import scipy.sparse
+import scipy.sparse.linalg
+from nexusformat.nexus import (NeXusError, NXcollection, NXdata, NXentry,
+                               NXfield, NXlink, nxgetconfig, nxopen,
+                               nxsetconfig)
 
 from .nxrefine import NXRefine
 from .nxsymmetry import NXSymmetry
-from .nxutils import init_julia, load_julia
+from .nxutils import as_completed, init_julia, load_julia
+
+_taper_cache = {}
+_TAPER_CACHE_SIZE = 4
+_matern_cache = {}
+_MATERN_CACHE_SIZE = 4
+
+
+class SphericalTaper:
+    """Spherical Tukey taper function on a reciprocal space grid.
+
+    The taper is unity for Q < qmax/2, falls to zero as a cosine
+    between qmax/2 and qmax, and is set to the smallest value in that
+    shell beyond qmax. Since it only depends on |Q|, only the
+    one-dimensional grid axes are stored, and the taper is evaluated in
+    single precision when the object is indexed, so slabs are
+    calculated without creating the full volume. That is only created
+    if the object is converted to an array.
+
+    Parameters
+    ----------
+    x, y, z : array-like
+        One-dimensional grid axes along H, K, and L in Å-1.
+    qmax : float
+        Maximum Q value in Å-1.
+    """
+
+    def __init__(self, x, y, z, qmax):
+        self.x, self.y, self.z = (np.asarray(a, dtype=np.float32)
+                                  for a in (x, y, z))
+        self.qmax = float(qmax)
+        self._floor = None
+
+    def __repr__(self):
+        return f"SphericalTaper(shape={self.shape}, qmax={self.qmax:g})"
+
+    @property
+    def shape(self):
+        return (self.z.size, self.y.size, self.x.size)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def _shell(self, q2):
+        """Return the taper without the floor and the mask beyond qmax.
+
+        The squared Q values in `q2` are overwritten by the taper.
+        """
+        taper = np.sqrt(q2, out=q2)
+        taper *= np.float32(2.0 / self.qmax)
+        inner = taper <= 1.0
+        outer = taper >= 2.0
+        taper *= np.float32(np.pi)
+        np.cos(taper, out=taper)
+        np.subtract(np.float32(1.0), taper, out=taper)
+        taper *= np.float32(0.5)
+        taper[inner] = 1.0
+        return taper, outer
+
+    @property
+    def floor(self):
+        """Smallest value of the taper within qmax, used beyond it."""
+        if self._floor is None:
+            y2 = np.square(self.y)[:, None]
+            x2 = np.square(self.x)[None, :]
+            floor = None
+            for z in self.z:
+                taper, outer = self._shell((np.square(z) + y2) + x2)
+                if not outer.all():
+                    value = taper[~outer].min()
+                    floor = value if floor is None else min(floor, value)
+            self._floor = np.float32(1.0 if floor is None else floor)
+        return self._floor
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if Ellipsis in index:
+            i = index.index(Ellipsis)
+            index = (index[:i] + (slice(None),) * (self.ndim-len(index)+1)
+                     + index[i+1:])
+        index = index + (slice(None),) * (self.ndim - len(index))
+        values = [np.asarray(axis[idx])
+                  for axis, idx in zip((self.z, self.y, self.x), index)]
+        ndim = sum(v.ndim for v in values)
+        q2, dim = np.float32(0.0), 0
+        for v in values:
+            if v.ndim:
+                shape = [1] * ndim
+                shape[dim] = v.size
+                v = v.reshape(shape)
+                dim += 1
+            q2 = q2 + np.square(v)
+        taper, outer = self._shell(np.asarray(q2))
+        if outer.any():
+            taper[outer] = self.floor
+        return taper
+
+
+def spherical_taper(x, y, z, qmax):
+    """Return a spherical Tukey taper function on a reciprocal space grid.
+
+    The taper only depends on the grid and qmax, so the returned
+    `SphericalTaper` is cached and returned on subsequent calls. It
+    only stores the one-dimensional axes, along with the smallest taper
+    value within qmax, which requires a pass over the grid, so the
+    cache does not hold any full-size arrays.
+
+    Parameters
+    ----------
+    x, y, z : array-like
+        One-dimensional grid axes along H, K, and L in Å-1.
+    qmax : float
+        Maximum Q value in Å-1.
+
+    Returns
+    -------
+    SphericalTaper
+        Taper function with shape (len(z), len(y), len(x)), whose
+        slabs are evaluated when it is indexed.
+    """
+    x, y, z = (np.asarray(a, dtype=np.float32) for a in (x, y, z))
+    key = tuple((a.size, float(a[0]), float(a[-1])) for a in (x, y, z))
+    key += (float(qmax),)
+    if key in _taper_cache:
+        return _taper_cache[key]
+    taper = SphericalTaper(x, y, z, qmax)
+    if len(_taper_cache) >= _TAPER_CACHE_SIZE:
+        del _taper_cache[next(iter(_taper_cache))]
+    _taper_cache[key] = taper
+    return taper
+
+
+class WeightsTaper:
+    """Taper function read in slabs from stored symmetrization weights.
+
+    The weights stored with symmetrized transforms are the reciprocal
+    of the taper, so they are read and inverted when the object is
+    indexed, without loading the full volume.
+
+    Parameters
+    ----------
+    weights : NXfield or array-like
+        Stored weights. If they have more than three dimensions, the
+        first element of the leading axis is used.
+    dtype : dtype, optional
+        Floating point precision of the taper, by default float32.
+    """
+
+    def __init__(self, weights, dtype=np.float32):
+        self.weights = weights
+        self.dtype = np.dtype(dtype)
+
+    def __repr__(self):
+        return f"WeightsTaper(shape={self.shape}, dtype={self.dtype})"
+
+    @property
+    def shape(self):
+        return tuple(self.weights.shape[-3:])
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(self.weights.shape) > 3:
+            index = (0,) + index
+        return np.reciprocal(_read_slab(self.weights, index),
+                             dtype=self.dtype)
+
+
+def _shift_slices(n):
+    """Return source and destination slices that implement fftshift."""
+    h = n // 2
+    return [(slice(0, n-h), slice(h, n)), (slice(n-h, n), slice(0, h))]
+
+
+def _negate(data, axes):
+    """Return the array with the indices along the given axes negated."""
+    for axis in axes:
+        data = np.roll(np.flip(data, axis), 1, axis)
+    return data
+
+
+def _hermitian_real(half, n, negated=None):
+    """Return the real part of a full FFT from the output of `rfftn`.
+
+    Since the input of `rfftn` is real, the Fourier transform satisfies
+    F(-k) = F(k)*, so the real part of the missing half is obtained by
+    negating the indices of the calculated half.
+
+    Parameters
+    ----------
+    half : ndarray
+        Real part of the output of `rfftn`, with the last axis halved.
+    n : int
+        Length of the last axis of the full transform.
+    negated : ndarray, optional
+        Rows of `half` at the negated indices along the first axis, if
+        `half` only contains a slab of the first axis, by default None.
+
+    Returns
+    -------
+    ndarray
+        Real part of the full Fourier transform.
+    """
+    if negated is None:
+        negated = _negate(half, (0,))
+    m = half.shape[-1]
+    full = np.empty(half.shape[:-1] + (n,), dtype=half.dtype)
+    full[..., :m] = half
+    full[..., m:] = _negate(negated, range(1, half.ndim-1))[
+        ..., 1:n-m+1][..., ::-1]
+    return full
+
+
+def pdf_transform(data, taper, workers=None, dtype=None):
+    """Return the PDF calculated from tapered reciprocal space data.
+
+    The last element along each axis is dropped, so that the origin is
+    at the center of an even grid. The taper is applied while the data
+    are copied into the shifted FFT input buffer, so neither input is
+    modified. Since the input is real, only half the transform is
+    calculated with `rfftn`, and the real part of the other half is
+    obtained from the Hermitian symmetry of the result.
+
+    Parameters
+    ----------
+    data : array-like
+        Symmetrized reciprocal space data.
+    taper : array-like
+        Taper function with the same shape as the data.
+    workers : int, optional
+        Number of workers used by the FFT, by default None.
+    dtype : dtype, optional
+        Floating point precision of the calculation, by default the
+        precision of the input arrays. The FFT is performed in the
+        corresponding complex precision.
+
+    Returns
+    -------
+    ndarray
+        The real part of the Fourier transform, normalized by the
+        number of grid points.
+    """
+    shape = tuple(n-1 for n in data.shape)
+    if dtype is None:
+        dtype = np.result_type(data.dtype, taper.dtype)
+    buffer = np.empty(shape, dtype=dtype)
+    for sl, dl in _shift_slices(shape[0]):
+        for sk, dk in _shift_slices(shape[1]):
+            for sh, dh in _shift_slices(shape[2]):
+                np.multiply(data[sl, sk, sh], taper[sl, sk, sh],
+                            out=buffer[dl, dk, dh], casting='unsafe')
+    half = np.real(scipy.fft.rfftn(buffer, workers=workers))
+    del buffer
+    fft = scipy.fft.fftshift(_hermitian_real(half, shape[-1]))
+    fft *= (1.0 / np.prod(fft.shape))
+    return fft
+
+
+def _read_slab(data, index):
+    """Return a slab of an NXfield or array as a NumPy array."""
+    slab = data[index]
+    return np.asarray(getattr(slab, 'nxvalue', slab))
+
+
+def fft_slab(scratch_file, axis, start, stop, axes, workers=None):
+    """Fourier transform a slab of a memory-mapped scratch array in place.
+
+    Parameters
+    ----------
+    scratch_file : str
+        Path to the '.npy' file containing the complex scratch array.
+    axis : int
+        Axis along which the slab is selected.
+    start, stop : int
+        Range of indices along `axis` defining the slab.
+    axes : tuple of ints
+        Axes over which the Fourier transform is computed. These must
+        not include `axis`.
+    workers : int, optional
+        Number of workers used by the FFT, by default None.
+
+    Returns
+    -------
+    int
+        Start index of the slab, for progress monitoring.
+    """
+    buffer = np.load(scratch_file, mmap_mode='r+')
+    index = [slice(None)] * buffer.ndim
+    index[axis] = slice(start, stop)
+    index = tuple(index)
+    buffer[index] = scipy.fft.fftn(buffer[index], axes=axes, workers=workers,
+                                   overwrite_x=True)
+    buffer.flush()
+    del buffer
+    return start
+
+
+def pdf_transform_chunked(data, taper, output, scratch_file, chunk_size,
+                          executor=None, workers=None, dtype=None):
+    """Calculate the PDF out-of-core using a memory-mapped scratch array.
+
+    This gives the same result as `pdf_transform`, but only holds slabs
+    of `chunk_size` planes in memory (see `pdf_memory`). Slabs of the
+    tapered and shifted data along the first axis are transformed over
+    the other two axes with `rfftn` and stored in a complex scratch
+    array, which is then transformed by 1D FFTs over pencils along the
+    second axis. Since these write to disjoint slabs, they may be
+    distributed over a process pool. The real part of the full
+    transform is then reconstructed, shifted, normalized, and written
+    to the output in slabs. Input slabs that are all zero, *e.g.*,
+    outside the detector coverage, are skipped, since the scratch array
+    is initialized to zero.
+
+    Parameters
+    ----------
+    data : NXfield or array-like
+        Symmetrized reciprocal space data, which is read in slabs.
+    taper : SphericalTaper, WeightsTaper, or array-like
+        Taper function with the same shape as the data, which is also
+        indexed in slabs, so it need not be held in memory.
+    output : NXfield or array-like
+        Writable field with a shape one smaller than the data along
+        each axis.
+    scratch_file : str or Path
+        Path to the '.npy' file used as the scratch array. It is
+        overwritten, and should be removed by the caller.
+    chunk_size : int
+        Number of planes in each slab.
+    executor : Executor, optional
+        Executor used to distribute the FFT slabs, by default None.
+    workers : int, optional
+        Number of workers used by each FFT, by default None.
+    dtype : dtype, optional
+        Floating point precision of the calculation, by default the
+        precision of the data and taper.
+    """
+    shape = tuple(n-1 for n in data.shape)
+    if dtype is None:
+        dtype = np.result_type(data.dtype, taper.dtype)
+    scratch_file = str(scratch_file)
+    buffer = np.lib.format.open_memmap(
+        scratch_file, mode='w+', dtype=np.result_type(dtype, np.complex64),
+        shape=shape[:2] + (shape[2]//2 + 1,))
+    for src, dst in _shift_slices(shape[0]):
+        offset = dst.start - src.start
+        for i in range(src.start, src.stop, chunk_size):
+            j = min(i+chunk_size, src.stop)
+            slab = _read_slab(data, np.s_[i:j, :-1, :-1])
+            if not np.any(slab):
+                continue
+            slab = np.multiply(slab, taper[i:j, :-1, :-1], dtype=dtype)
+            buffer[i+offset:j+offset] = scipy.fft.rfftn(
+                scipy.fft.fftshift(slab, axes=(1, 2)), axes=(1, 2),
+                workers=workers)
+    buffer.flush()
+    del buffer
+
+    slabs = [(i, min(i+chunk_size, shape[1]))
+             for i in range(0, shape[1], chunk_size)]
+    if executor is None:
+        for i, j in slabs:
+            fft_slab(scratch_file, 1, i, j, (0,), workers=workers)
+    else:
+        futures = [executor.submit(fft_slab, scratch_file, 1, i, j, (0,), 1)
+                   for i, j in slabs]
+        for future in as_completed(futures):
+            future.result()
+
+    buffer = np.load(scratch_file, mmap_mode='r')
+    norm = 1.0 / np.prod(shape)
+    for src, dst in _shift_slices(shape[0]):
+        offset = dst.start - src.start
+        for i in range(src.start, src.stop, chunk_size):
+            j = min(i+chunk_size, src.stop)
+            rows = -np.arange(i, j) % shape[0]
+            slab = _hermitian_real(np.real(buffer[i:j]), shape[2],
+                                   negated=np.real(buffer[rows]))
+            slab *= norm
+            output[i+offset:j+offset] = scipy.fft.fftshift(slab, axes=(1, 2))
+    del buffer
+
+
+def pdf_memory(shape, itemsize, dtype, chunk_size=None, processes=1):
+    """Return the peak memory in bytes used to calculate a PDF.
+
+    The estimates assume the taper is evaluated in slabs (see
+    `SphericalTaper` and `WeightsTaper`), so it never requires a
+    full-size array.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of the reciprocal space data.
+    itemsize : int
+        Number of bytes in each element of the data.
+    dtype : dtype
+        Floating point precision of the calculation.
+    chunk_size : int, optional
+        Number of planes in each slab of `pdf_transform_chunked`, by
+        default None, in which case the memory used by `pdf_transform`
+        is returned.
+    processes : int, optional
+        Number of processes transforming slabs concurrently in
+        `pdf_transform_chunked`, by default 1.
+
+    Returns
+    -------
+    int
+        Estimated number of bytes.
+    """
+    size = np.dtype(dtype).itemsize
+    n0, n1, n2 = (n-1 for n in shape)
+    # The taper slab, and the masks or stored weights it is calculated
+    # from.
+    taper = 4 + size
+    if chunk_size is None:
+        # The data are read in full. The peak is when the real part of
+        # the full transform is reconstructed and shifted while the half
+        # transform is held, with an allowance for the FFT workspace.
+        # Before that, the taper is only evaluated for one octant at a
+        # time, which is smaller.
+        return int(np.prod(shape) * itemsize + 4 * size * n0 * n1 * n2)
+    # Per plane: the data, taper, tapered, shifted, and half-transformed
+    # slabs; the complex pencils read and transformed by each process;
+    # the complex slab and its negated rows, their real parts, and the
+    # reconstructed and shifted output slab.
+    plane = max(shape[1] * shape[2] * itemsize + n1 * n2 * (taper + 3*size),
+                processes * 4 * size * n0 * (n2//2 + 1),
+                5 * size * n1 * n2)
+    return int(chunk_size * plane)
+
+
+def pdf_axes(shape, steps, rmax=None):
+    """Return the real space axes of a PDF.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of the reciprocal space data, which has one more point
+        along each axis than the full PDF.
+    steps : tuple of floats
+        Reciprocal space grid spacing along each axis.
+    rmax : tuple of floats, optional
+        Maximum absolute value of r along each axis, by default None.
+        If given, only the points of the full PDF axes within these
+        limits are returned.
+
+    Returns
+    -------
+    list of ndarrays
+        Axis values in reciprocal units of the grid spacing.
+    """
+    axes = [scipy.fft.fftshift(scipy.fft.fftfreq(n-1, d))
+            for n, d in zip(shape, steps)]
+    if rmax is not None:
+        axes = [r[np.abs(r) <= limit*(1+1e-9)] for r, limit in zip(axes, rmax)]
+    return axes
+
+
+def _dft_matrix(r, n, step, dtype):
+    """Return the partial DFT matrix mapping n centered points to r."""
+    q = (np.arange(n) - n//2) * step
+    return np.exp(-2j * np.pi * np.multiply.outer(r, q)).astype(dtype)
+
+
+def pdf_transform_local(data, taper, steps, axes, chunk_size=None,
+                        dtype=None):
+    """Return the PDF evaluated on a local real space grid.
+
+    This gives the same values as `pdf_transform` at the points of its
+    grid, but the transform is evaluated directly on the requested
+    axes using separable partial DFT matrices, so the cost scales with
+    the size of the output rather than the full grid. The data are
+    read in slabs of `chunk_size` planes, which are tapered and
+    contracted with the DFT matrices of the last two axes before
+    being accumulated into the result. Slabs that are all zero are
+    skipped.
+
+    Parameters
+    ----------
+    data : NXfield or array-like
+        Symmetrized reciprocal space data, which is read in slabs.
+    taper : array-like
+        Taper function with the same shape as the data.
+    steps : tuple of floats
+        Reciprocal space grid spacing along each axis.
+    axes : tuple of array-like
+        Real space axes on which the PDF is evaluated, usually
+        returned by `pdf_axes`, although any values may be used.
+    chunk_size : int, optional
+        Number of planes in each slab, by default the whole array.
+    dtype : dtype, optional
+        Floating point precision of the calculation, by default the
+        precision of the data and taper.
+
+    Returns
+    -------
+    ndarray
+        The real part of the Fourier transform, normalized by the
+        number of grid points of the full transform.
+    """
+    shape = tuple(n-1 for n in data.shape)
+    if dtype is None:
+        dtype = np.result_type(data.dtype, taper.dtype)
+    ctype = np.result_type(dtype, np.complex64)
+    el, ek, eh = [_dft_matrix(r, n, d, ctype)
+                  for r, n, d in zip(axes, shape, steps)]
+    if chunk_size is None:
+        chunk_size = shape[0]
+    result = np.zeros((len(axes[0]), len(axes[1]), len(axes[2])),
+                      dtype=ctype)
+    for i in range(0, shape[0], chunk_size):
+        j = min(i+chunk_size, shape[0])
+        slab = _read_slab(data, np.s_[i:j, :-1, :-1])
+        if not np.any(slab):
+            continue
+        slab = np.multiply(slab, taper[i:j, :-1, :-1], dtype=dtype)
+        slab = ek @ (slab @ eh.T)
+        result += np.tensordot(el[:, i:j], slab, axes=1)
+    fft = np.real(result).astype(dtype)
+    fft *= (1.0 / np.prod(shape))
+    return fft
+
+
+def punch_batches(indices, axes, shape, chunks=None):
+    """Group the reflections to be punched into chunk-aligned batches.
+
+    The grid indices of each reflection are calculated from the
+    origin and step of the axes, rather than by searching them, and
+    reflections that are not on the grid, or whose surrounding cube
+    extends beyond the data, are rejected. The remaining cubes are
+    grouped by the block of chunks containing their centers, so
+    that each batch can be read from the file as a single slab.
+
+    Parameters
+    ----------
+    indices : list of tuples
+        (H, K, L) values of the reflections.
+    axes : tuple of ndarrays
+        Ql, Qk, and Qh axes of the symmetrized data.
+    shape : tuple of ints
+        Shape of the cube surrounding each punched hole.
+    chunks : tuple of ints, optional
+        Chunk shape of the symmetrized data, by default None.
+
+    Returns
+    -------
+    tuple of (batches, rejected)
+        `batches` is a list of (reflections, corners) tuples, where
+        `corners` is an array containing the first (l, k, h) index
+        of each cube. `rejected` is a list of (outcome,
+        (H, K, L), message) tuples.
+    """
+    hkls = np.array(indices, dtype=float).reshape(-1, 3)
+    Q = hkls[:, ::-1]
+    origin = np.array([ax[0] for ax in axes])
+    step = np.array([ax[1] - ax[0] for ax in axes])
+    size = np.array([len(ax) for ax in axes])
+    centers = np.rint((Q - origin) / step).astype(int)
+    on_grid = np.all((centers >= 0) & (centers < size), axis=1)
+    clipped = np.clip(centers, 0, size-1)
+    on_grid &= np.all(np.isclose(
+        np.stack([ax[clipped[:, i]] for i, ax in enumerate(axes)],
+                 axis=1), Q), axis=1)
+    half = (np.array(shape) - 1) // 2
+    corners = centers - half
+    inside = np.all((corners >= 0) & (centers + half < size), axis=1)
+    rejected = []
+    for n in np.flatnonzero(~on_grid | ~inside):
+        hkl = tuple(indices[n])
+        if not on_grid[n]:
+            rejected.append(('off_grid', hkl, None))
+        else:
+            rejected.append(('edge', hkl, "cube extends beyond data"))
+    if chunks is None:
+        chunks = shape
+    block = np.array([c * int(np.ceil(4 * n / c))
+                      for c, n in zip(chunks, shape)])
+    batches = {}
+    for n in np.flatnonzero(on_grid & inside):
+        key = tuple(centers[n] // block)
+        batches.setdefault(key, []).append(n)
+    return [([tuple(indices[n]) for n in batch], corners[batch])
+            for _, batch in sorted(batches.items())], rejected
+
+
+def laplacian_3d_grid(shape):
+    """Return the discrete Laplacian of a 3D grid with unit spacing.
+
+    This is the same operator as `nablasq_3d_grid` in the Julia
+    LaplaceInterpolation module, i.e., the graph Laplacian of the grid,
+    whose diagonal elements are the number of nearest neighbors of each
+    voxel. Voxels are ordered as in a flattened C-ordered array.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of the grid.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Sparse matrix with the size of the grid along each dimension.
+    """
+    def path_laplacian(n):
+        degree = np.full(n, 2.0)
+        degree[0] -= 1
+        degree[-1] -= 1
+        return scipy.sparse.diags([-np.ones(n-1), degree, -np.ones(n-1)],
+                                  [-1, 0, 1])
+    identities = [scipy.sparse.identity(n) for n in shape]
+    laplacian = scipy.sparse.csr_matrix((np.prod(shape), np.prod(shape)))
+    for axis, n in enumerate(shape):
+        factors = list(identities)
+        factors[axis] = path_laplacian(n)
+        laplacian += scipy.sparse.kron(
+            scipy.sparse.kron(factors[0], factors[1]), factors[2])
+    return laplacian.tocsr()
+
+
+def matern_factorization(shape, punched, m=1, epsilon=0.0):
+    """Return the factorized Matérn interpolation system for a punch.
+
+    The Matérn operator, A = (L + epsilon**2 I)**m, where L is the grid
+    Laplacian, is required to vanish at the punched voxels, while the
+    other voxels retain their original values. This is the sparse
+    linear system, A_pp u_p = -A_pk v_k, where p and k denote the
+    punched and known voxels, respectively. Since A_pp only depends on
+    the cube shape, punch, and Matérn parameters, its LU factorization
+    is cached, so repeated interpolations of identical punches only
+    require a back-substitution.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of the cube containing the hole.
+    punched : array-like
+        Array of shape (n, 3) containing the indices of the punched
+        voxels.
+    m : int, optional
+        Matérn exponent, by default 1, which is Laplace interpolation.
+    epsilon : float, optional
+        Matérn parameter, by default 0.0.
+
+    Returns
+    -------
+    tuple of (punched, known, solve, coupling)
+        Flattened indices of the punched voxels, a boolean mask of the
+        known voxels, a function solving A_pp x = b, and the sparse
+        matrix A_pk.
+    """
+    shape = tuple(int(n) for n in shape)
+    punched = np.ravel_multi_index(tuple(np.asarray(punched).T), shape)
+    key = (shape, punched.tobytes(), int(m), float(epsilon))
+    if key in _matern_cache:
+        return _matern_cache[key]
+    operator = laplacian_3d_grid(shape)
+    if epsilon:
+        operator = operator + epsilon**2 * scipy.sparse.identity(
+            operator.shape[0], format='csr')
+    matern = operator
+    for _ in range(m-1):
+        matern = matern @ operator
+    rows = matern.tocsr()[punched]
+    known = np.ones(matern.shape[0], dtype=bool)
+    known[punched] = False
+    system = (punched, known,
+              scipy.sparse.linalg.factorized(rows[:, punched].tocsc()),
+              rows[:, known].tocsr())
+    if len(_matern_cache) >= _MATERN_CACHE_SIZE:
+        del _matern_cache[next(iter(_matern_cache))]
+    _matern_cache[key] = system
+    return system
+
+
+def matern_3d_grid(data, punched, m=1, epsilon=0.0):
+    """Interpolate the data within a punched hole using SciPy.
+
+    This reproduces `matern_3d_grid` in the Julia LaplaceInterpolation
+    module without requiring Julia, using the cached factorization
+    returned by `matern_factorization`.
+
+    Parameters
+    ----------
+    data : array-like
+        Three-dimensional array containing the data surrounding the hole.
+    punched : array-like
+        Array of shape (n, 3) containing the indices of the voxels to be
+        interpolated.
+    m : int, optional
+        Matérn exponent, by default 1, which is Laplace interpolation.
+    epsilon : float, optional
+        Matérn parameter, by default 0.0.
+
+    Returns
+    -------
+    ndarray
+        Copy of the data with the punched voxels interpolated.
+    """
+    punched, known, solve, coupling = matern_factorization(
+        data.shape, punched, m=m, epsilon=epsilon)
+    u = np.array(data, dtype=np.float64).ravel()
+    u[punched] = solve(-(coupling @ u[known]))
+    return u.reshape(data.shape)
+
+
+def punch_fill_blocks(fill, changed, shape):
+    """Return the voxels changed by punch-and-fill as sparse blocks.
+
+    The grid is divided into blocks of the given shape, and only blocks
+    containing changed voxels are returned.
+
+    Parameters
+    ----------
+    fill : ndarray
+        Array containing the filled values of the changed voxels.
+    changed : ndarray
+        Boolean array defining the changed voxels.
+    shape : tuple of ints
+        Shape of each block, e.g., the cube surrounding each punch.
+
+    Returns
+    -------
+    tuple of (corners, values, mask)
+        `corners` is an (n, 3) array containing the first index of each
+        block, `values` an array of shape (n,) + `shape` containing the
+        filled values, and `mask` a boolean array of the same shape
+        defining the changed voxels within each block.
+    """
+    shape = np.array(shape)
+    corners = np.unique(np.argwhere(changed) // shape, axis=0) * shape
+    values = np.zeros((len(corners),) + tuple(shape), dtype=fill.dtype)
+    mask = np.zeros(values.shape, dtype=bool)
+    for n, corner in enumerate(corners):
+        index = tuple(slice(c, c+b) for c, b in zip(corner, shape))
+        block = changed[index]
+        local = tuple(slice(0, b) for b in block.shape)
+        mask[n][local] = block
+        values[n][local] = np.where(block, fill[index], 0)
+    return corners, values, mask
+
+
+class PunchFillView:
+    """Lazy view of the symmetrized data after punch-and-fill.
+
+    Slabs are read from the original data, and the voxels changed by
+    punch-and-fill are replaced by the values stored in sparse blocks,
+    returned by `punch_fill_blocks`, so the punched or filled volumes
+    never need to be stored in full.
+
+    Parameters
+    ----------
+    data : NXfield or array-like
+        Original symmetrized data.
+    corners : array-like
+        First index of each block.
+    values : array-like
+        Filled values of the voxels in each block.
+    mask : array-like
+        Boolean array defining the changed voxels in each block.
+    filled : bool, optional
+        True if the changed voxels contain the filled values, or False
+        if they are punched, i.e., set to zero, by default True.
+    """
+
+    def __init__(self, data, corners, values, mask, filled=True):
+        self.data = data
+        self.corners = np.asarray(corners, dtype=int).reshape(-1, 3)
+        self.values = np.asarray(values)
+        self.mask = np.asarray(mask, dtype=bool)
+        self.filled = filled
+
+    def __repr__(self):
+        return (f"PunchFillView(shape={self.shape}, "
+                f"blocks={len(self.corners)}, filled={self.filled})")
+
+    @property
+    def shape(self):
+        return tuple(self.data.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nxvalue(self):
+        return self[()]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.nxvalue, dtype=dtype)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if Ellipsis in index:
+            i = index.index(Ellipsis)
+            index = (index[:i] + (slice(None),) * (self.ndim-len(index)+1)
+                     + index[i+1:])
+        index = index + (slice(None),) * (self.ndim - len(index))
+        slices, squeeze = [], []
+        for axis, (idx, n) in enumerate(zip(index, self.shape)):
+            if isinstance(idx, slice):
+                start, stop, step = idx.indices(n)
+                if step != 1:
+                    raise IndexError("Only unit steps are supported")
+                slices.append(slice(start, max(start, stop)))
+            else:
+                idx = int(idx) + n if int(idx) < 0 else int(idx)
+                slices.append(slice(idx, idx+1))
+                squeeze.append(axis)
+        result = np.array(_read_slab(self.data, tuple(slices)))
+        start = np.array([s.start for s in slices])
+        stop = np.array([s.stop for s in slices])
+        block = np.array(self.mask.shape[1:])
+        lo = np.maximum(self.corners, start)
+        hi = np.minimum(self.corners + block, stop)
+        for n in np.flatnonzero(np.all(lo < hi, axis=1)):
+            dst = tuple(slice(a-s, b-s)
+                        for a, b, s in zip(lo[n], hi[n], start))
+            src = tuple(slice(a-c, b-c)
+                        for a, b, c in zip(lo[n], hi[n], self.corners[n]))
+            changed = self.mask[n][src]
+            if self.filled:
+                result[dst][changed] = self.values[n][src][changed]
+            else:
+                result[dst][changed] = 0
+        return result.squeeze(axis=tuple(squeeze)) if squeeze else result
 
 
 class NXPDF:
@@ -141,7 +990,7 @@ class NXPDF:
                 self.entry['transform'].nxsignal.nxvalue,
                 posinf=0.0, neginf=0.0)
         symm_root['entry/data'].nxsignal = symm_root['entry/data/data']
-        symm_root['entry/data'].nxweights = 1.0 / self.taper
+        symm_root['entry/data'].nxweights = 1.0 / self.taper[()]
         symm_root['entry/data'].nxaxes = self.entry['transform'].nxaxes
         if self.symm_data in self.entry:
             del self.entry[self.symm_data]
@@ -177,15 +1026,9 @@ class NXPDF:
         tic = timeit.default_timer()
         if qmax is None:
             qmax = self.qmax
-        Z, Y, X = np.meshgrid(self.Ql * self.refine.cstar,
-                              self.Qk * self.refine.bstar,
-                              self.Qh * self.refine.astar,
-                              indexing='ij')
-        taper = np.ones(X.shape, dtype=np.float32)
-        R = 2 * np.sqrt(X**2 + Y**2 + Z**2) / qmax
-        idx = (R > 1.0) & (R < 2.0)
-        taper[idx] = 0.5 * (1 - np.cos(R[idx] * np.pi))
-        taper[R >= 2.0] = taper.min()
+        taper = spherical_taper(self.Qh.nxvalue * self.refine.astar,
+                                self.Qk.nxvalue * self.refine.bstar,
+                                self.Ql.nxvalue * self.refine.cstar, qmax)
         toc = timeit.default_timer()
         self.logger.info(f"{self.title}: Taper function calculated "
                          f"({toc-tic:g} seconds)")
@@ -202,11 +1045,7 @@ class NXPDF:
         self.logger.info(f"{self.title}: Calculating total PDF")
         tic = timeit.default_timer()
         symm_data = self.entry[self.symm_data].nxsignal.nxvalue
-        symm_data *= self.taper
-        fft = np.real(scipy.fft.fftshift(
-            scipy.fft.fftn(scipy.fft.fftshift(symm_data[:-1, :-1, :-1]),
-                           workers=os.cpu_count())))
-        fft *= (1.0 / np.prod(fft.shape))
+        fft = pdf_transform(symm_data, self.taper, workers=os.cpu_count())
 
         root = nxopen(self.total_pdf_file, 'a')
         root['entry'] = NXentry()
@@ -285,7 +1124,7 @@ class NXPDF:
         symm_root = nxopen(self.symm_file, 'rw')
         symm_data = symm_root['entry/data/data']
 
-        mask, mask_indices = self.hole_mask(symm_data)
+        mask, mask_indices = self.hole_mask()
         idx = [Main.CartesianIndex(int(i[0]+1), int(i[1]+1), int(i[2]+1))
                for i in mask_indices]
         ml = int((mask.shape[0]-1)/2)
@@ -310,30 +1149,56 @@ class NXPDF:
         self.logger.info(f"{self.title}: Symmetrizing punch-and-fill")
 
         # fill_data = self.symmetrize(fill_data)
-        self.changed_idx = np.where(fill_data > 0)
-        buffer = symm_data.nxvalue
-        buffer[self.changed_idx] = fill_data[self.changed_idx]
-        if 'fill' in symm_root['entry/data']:
-            del symm_root['entry/data/fill']
-        symm_root['entry/data/fill'] = buffer
-        if 'filled_data' in self.entry[self.symm_data]:
-            del self.entry[self.symm_data]['filled_data']
-        self.entry[self.symm_data]['filled_data'] = NXlink(
-            '/entry/data/fill', file=self.symm_file)
-
-        buffer[self.changed_idx] *= 0
-        if 'punch' in symm_root['entry/data']:
-            del symm_root['entry/data/punch']
-        symm_root['entry/data/punch'] = buffer
-        if 'punched_data' in self.entry[self.symm_data]:
-            del self.entry[self.symm_data]['punched_data']
-        self.entry[self.symm_data]['punched_data'] = NXlink(
-            '/entry/data/punch', file=self.symm_file)
+        corners, values, changed = punch_fill_blocks(
+            fill_data, fill_data > 0, mask.shape)
+        for name in ['fill', 'punch', 'delta']:
+            if name in symm_root['entry/data']:
+                del symm_root['entry/data'][name]
+        symm_root['entry/data/delta'] = NXcollection(
+            NXfield(corners, name='corners'),
+            NXfield(values, name='values'),
+            NXfield(changed, name='mask'))
+        for name in ['filled_data', 'punched_data', 'delta']:
+            if name in self.entry[self.symm_data]:
+                del self.entry[self.symm_data][name]
+        self.entry[self.symm_data]['delta'] = NXlink(
+            '/entry/data/delta', file=self.symm_file)
 
         toc = timeit.default_timer()
         self.logger.info(f"{self.title}: Punch-and-fill completed "
                          f"({toc - tic:g} seconds)")
 
+    def filled_data(self, filled=True):
+        """Return a lazy view of the symmetrized data after punch-and-fill.
+
+        The changed voxels are stored as sparse blocks in the 'delta'
+        collection, as in `NXMultiReduce.punch_and_fill`, so files
+        written by either class can be read by the other.
+
+        Parameters
+        ----------
+        filled : bool, optional
+            True if the punched voxels contain the interpolated values,
+            or False if they are set to zero, by default True.
+
+        Returns
+        -------
+        PunchFillView
+            View composing the symmetrized data and the sparse blocks
+            of voxels changed by punch-and-fill.
+        """
+        symm_group = self.entry[self.symm_data]
+        if 'delta' not in symm_group:
+            raise NeXusError("Punch-and-fill has not been performed")
+        delta = symm_group['delta']
+        return PunchFillView(symm_group.nxsignal, delta['corners'].nxvalue,
+                             delta['values'].nxvalue, delta['mask'].nxvalue,
+                             filled=filled)
+
+    def punched_data(self):
+        """Return a lazy view of the symmetrized data with punched holes."""
+        return self.filled_data(filled=False)
+
     def delta_pdf(self):
         self.logger.info(f"{self.title}: Calculating Delta-PDF")
         if self.pdf_file.exists():
@@ -344,12 +1209,8 @@ class NXPDF:
                     f"{self.title}: Delta-PDF file already exists")
                 return
         tic = timeit.default_timer()
-        symm_data = self.entry[self.symm_data]['filled_data'].nxvalue
-        symm_data *= self.taper
-        fft = np.real(scipy.fft.fftshift(
-            scipy.fft.fftn(scipy.fft.fftshift(symm_data[:-1, :-1, :-1]),
-                           workers=os.cpu_count())))
-        fft *= (1.0 / np.prod(fft.shape))
+        fft = pdf_transform(self.filled_data(), self.taper,
+                            workers=os.cpu_count())
 
         root = nxopen(self.pdf_file, 'a')
         root['entry'] = NXentry()
@@ -15,11 +15,12 @@ import shutil
 import subprocess
 import sys
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import h5py as h5
 import numpy as np
-import scipy.fft
+import psutil
 from h5py import is_hdf5
 from nexusformat.nexus import (NeXusError, NXcollection, NXdata, NXentry,
                                NXfield, NXlink, NXLock, NXnote, NXparameters,
@@ -31,12 +32,18 @@ from . import __version__
 from .nxbeamline import get_beamline
 from .nxdatabase import NXDatabase
 from .nxparent import NXParent
+from .nxpdf import (PunchFillView, WeightsTaper, pdf_axes, pdf_memory,
+                    pdf_transform, pdf_transform_chunked, pdf_transform_local,
+                    punch_batches, punch_fill_blocks, spherical_taper)
 from .nxrefine import NXRefine
 from .nxserver import NXServer
 from .nxsettings import NXSettings
 from .nxsymmetry import NXSymmetry
-from .nxutils import (find_maximum_chunk, init_julia, load_julia,
-                       mask_volume, peak_search)
+from .nxutils import (NXExecutor, as_completed, find_maximum_chunk,
+                      init_julia, load_julia, mask_volume, pdf_series_scan,
+                      peak_search, punch_fill_batch, read_stored_chunks,
+                      refine_series_scans, write_nonzero_chunks)
+from .nxvolume import write_pyramid
 
 QMIN_PIXEL_FRACTION = 0.3
 QMAX_PIXEL_FRACTION = 0.95
@@ -197,8 +204,8 @@ class NXReduce(QtCore.QObject):
             load=False, link=False,
             maxcount=False, find=False, refine=False, prepare=False,
             transform=False, combine=False, pdf=False,
-            lattice=False, regular=False, mask=False, overwrite=False,
-            monitor_progress=True, gui=False, server=None):
+            lattice=False, regular=False, mask=False, pyramid=False,
+            overwrite=False, monitor_progress=True, gui=False, server=None):
 
         super(NXReduce, self).__init__()
 
@@ -277,6 +284,7 @@ class NXReduce(QtCore.QObject):
         self.mask = mask
         if not self.mask:
             self.regular = True
+        self.pyramid = pyramid
         self.overwrite = overwrite
         self.monitor_progress = monitor_progress
         self.gui = gui
@@ -841,6 +849,26 @@ class NXReduce(QtCore.QObject):
             except NeXusError as error:
                 self.log(f"Could not consolidate {group.nxpath}: {error}")
 
+    def add_pyramid(self, group):
+        """Write 2x, 4x, and 8x binned levels of a transform.
+
+        The levels are written by `write_pyramid` to the file containing
+        the transform, where they can be selected by `NXPyramid` when
+        the full resolution is not required.
+        """
+        if group is None:
+            return
+        self.log(f"Writing binned levels of '{group.nxname}'")
+        tic = timeit.default_timer()
+        try:
+            write_pyramid(group)
+        except Exception as error:
+            self.log(f"Could not write binned levels: {error}")
+            return
+        toc = timeit.default_timer()
+        self.log(f"Binned levels of '{group.nxname}' written "
+                 f"({toc-tic:g} seconds)")
+
     @property
     def first(self):
         """First frame of the raw data to be used in the reduction."""
@@ -1965,15 +1993,12 @@ class NXReduce(QtCore.QObject):
         - Finally, it clears the 'threshold', 'first', and 'last'
           parameters from the instance.
         """
+        names = ['intensity', 'x', 'y', 'z', 'sigx', 'sigy', 'sigz']
+        values = np.array([[getattr(peak, name) for name in names]
+                           for peak in peaks], dtype=float).reshape(-1, 7)
         group = NXreflections()
-        group['intensity'] = NXfield([peak.intensity for peak in peaks],
-                                     dtype=float)
-        group['x'] = NXfield([peak.x for peak in peaks], dtype=float)
-        group['y'] = NXfield([peak.y for peak in peaks], dtype=float)
-        group['z'] = NXfield([peak.z for peak in peaks], dtype=float)
-        group['sigx'] = NXfield([peak.sigx for peak in peaks], dtype=float)
-        group['sigy'] = NXfield([peak.sigy for peak in peaks], dtype=float)
-        group['sigz'] = NXfield([peak.sigz for peak in peaks], dtype=float)
+        for name, value in zip(names, values.T):
+            group[name] = NXfield(value, dtype=float)
         group.attrs['first'] = self.first
         group.attrs['last'] = self.last
         group.attrs['threshold'] = self.threshold
@@ -1983,8 +2008,8 @@ class NXReduce(QtCore.QObject):
                 del target['peaks']
             target['peaks'] = group
         refine = self.refine
-        polar_angles, azimuthal_angles = refine.calculate_angles(refine.xp,
-                                                                 refine.yp)
+        polar_angles, azimuthal_angles = refine.calculate_angles(values[:, 1],
+                                                                 values[:, 2])
         refine.write_angles(polar_angles, azimuthal_angles,
                             entry=self.scan_entry or self.entry)
         self.clear_parameters(['threshold', 'first', 'last'])
@@ -2161,6 +2186,58 @@ class NXReduce(QtCore.QObject):
             self.log("HKL refinement not successful")
             return None
 
+    def refine_from_seed(self, seed=None):
+        """Refine this entry starting from a neighboring scan's solution.
+
+        The goniometer angles and orientation matrix, and, for the first
+        entry, the lattice parameters are copied from the seed before
+        running `nxrefine`. The other entries read the lattice parameters
+        written by the first entry of the same scan.
+
+        Parameters
+        ----------
+        seed : dict, optional
+            Refined state of the same entry in a neighboring scan, as
+            returned by `NXRefine.get_state`.
+
+        Returns
+        -------
+        dict
+            Convergence statistics of the refinement.
+        """
+        refine = self.refine
+        processed = not self.not_processed('nxrefine')
+        if seed is not None and not processed:
+            names = ['chi', 'omega', 'theta', 'Umat']
+            if self.is_first_entry():
+                names = NXRefine.lattice_names + names
+            refine.set_state({name: seed[name] for name in names})
+        refine.polar_max = self.polar_max
+        refine.hkl_tolerance = self.hkl_tolerance
+        self.refine = refine
+        stats = {'scan': self.scan, 'entry': self.entry_name,
+                 'peaks': 0, 'initial': refine.score(), 'final': np.nan,
+                 'nfev': 0, 'time': 0.0, 'status': 'failed'}
+        tic = timeit.default_timer()
+        try:
+            self.nxrefine()
+        except Exception as error:
+            stats['status'] = f'failed: {error}'
+            return stats
+        stats['time'] = timeit.default_timer() - tic
+        if processed:
+            stats['status'] = 'skipped'
+        elif hasattr(refine, 'result') and refine.result.success:
+            stats['status'] = 'converged'
+            stats['nfev'] = refine.result.nfev
+        else:
+            return stats
+        if refine.idx is not None:
+            stats['peaks'] = len(refine.idx)
+        stats['final'] = refine.score()
+        stats['state'] = refine.get_state(peaks=False)
+        return stats
+
     def nxprepare(self):
         if self.not_processed('nxprepare_mask') and self.prepare:
             try:
@@ -2322,6 +2399,9 @@ class NXReduce(QtCore.QObject):
                                     output=cctw_output,
                                     errors=cctw_errors)
                         self.record_end(task)
+                        if self.pyramid:
+                            self.add_pyramid(self.find_group(
+                                'masked_transform' if mask else 'transform'))
                         if cctw_settings:
                             with self:
                                 target = self._get_reduce_target()
@@ -2545,6 +2625,7 @@ class NXReduce(QtCore.QObject):
                                    subentry=self.subentry_name,
                                    combine=self.combine, pdf=self.pdf,
                                    regular=self.regular, mask=self.mask,
+                                   pyramid=self.pyramid,
                                    overwrite=self.overwrite)
             if self.combine:
                 if self.regular and self.all_complete('nxtransform'):
@@ -2657,7 +2738,8 @@ class NXMultiReduce(NXReduce):
     def __init__(self, entry=None, subentry='', directory=None,
                  entries=None, combine=False, pdf=False, regular=False,
                  mask=False, laue=None, radius=None, qmax=None,
-                 overwrite=False):
+                 memory=None, precision='double', interpolation='julia',
+                 pipeline=False, rmax=None, pyramid=False, overwrite=False):
         if isinstance(entry, NXroot):
             root = entry
             if subentry and 'entry' in root and subentry in root['entry']:
@@ -2671,7 +2753,8 @@ class NXMultiReduce(NXReduce):
         elif not isinstance(entry, NXentry):
             entry = None
         super().__init__(entry=entry, directory=directory, entries=entries,
-                         subentry=subentry, overwrite=overwrite)
+                         subentry=subentry, pyramid=pyramid,
+                         overwrite=overwrite)
         self.refine = NXRefine(self.root, subentry=subentry)
 
         if laue:
@@ -2679,8 +2762,23 @@ class NXMultiReduce(NXReduce):
                 self.refine.laue_group = laue
             else:
                 raise NeXusError('Invalid Laue group specified')
+        self._laue = laue
         self._radius = radius
         self._qmax = qmax
+        self._memory = memory
+        if precision not in ['single', 'double']:
+            raise NeXusError(f"Invalid precision '{precision}'")
+        self.precision = precision
+        if interpolation not in ['julia', 'scipy']:
+            raise NeXusError(
+                f"Invalid interpolation backend '{interpolation}'")
+        self.interpolation = interpolation
+        self.pipeline = pipeline
+        self.rmax = rmax
+        self.shared = None
+        self._volumes = {}
+        self._writer = None
+        self._pending = []
 
         self.combine = combine
         self.pdf = pdf
@@ -2693,6 +2791,77 @@ class NXMultiReduce(NXReduce):
     def __repr__(self):
         return f"NXMultiReduce('{self.sample}_{self.scan}')"
 
+    @property
+    def memory(self):
+        """Memory budget in MB for in-core PDF transforms.
+
+        If the transform is estimated to need more than this, it is
+        calculated out-of-core. By default, this is half the memory
+        available when first requested.
+        """
+        if self._memory is None:
+            self._memory = psutil.virtual_memory().available / 2e6
+        return self._memory
+
+    @memory.setter
+    def memory(self, value):
+        self._memory = value
+
+    @property
+    def float_type(self):
+        """Floating point type used in the PDF calculations.
+
+        Single precision halves the memory and I/O required by the
+        symmetrized data and transforms, with FFTs performed in
+        complex64.
+        """
+        if self.precision == 'single':
+            return np.float32
+        else:
+            return np.float64
+
+    def write_async(self, write, finish=None):
+        """Write PDF results, in the background in pipeline mode.
+
+        In pipeline mode, the intermediate volumes are kept in memory
+        between the stages of `nxpdf`, so their files are only needed
+        once the task is complete. They are then written by a single
+        background thread, in the order they are submitted, while the
+        following stages are calculated.
+
+        Parameters
+        ----------
+        write : callable
+            Function writing the results to a separate file.
+        finish : callable, optional
+            Function to be called in this thread once the write is
+            complete, e.g., to consolidate the results in the parent.
+        """
+        if self.pipeline:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1)
+            future = self._writer.submit(write) if write else None
+            self._pending.append((future, finish))
+        else:
+            if write:
+                write()
+            if finish:
+                finish()
+
+    def finish_writes(self):
+        """Wait for background writes to complete."""
+        try:
+            while self._pending:
+                future, finish = self._pending.pop(0)
+                if future is not None:
+                    future.result()
+                if finish is not None:
+                    finish()
+        finally:
+            if self._writer is not None:
+                self._writer.shutdown(wait=True)
+                self._writer = None
+
     def complete(self, task):
         if task in ['nxcombine', 'nxmasked_combine', 'nxpdf', 'nxmasked_pdf']:
             target = self.scan_entry
@@ -2762,6 +2931,9 @@ class NXMultiReduce(NXReduce):
                             f"completed ({toc-tic:g} seconds)")
                         self.consolidate(
                             self.scan_entry[self.transform_path])
+                        if self.pyramid:
+                            self.add_pyramid(
+                                self.scan_entry[self.transform_path])
                         self.record(task, command=cctw_command,
                                     output=cctw_output,
                                     errors=cctw_errors)
@@ -2855,14 +3027,14 @@ class NXMultiReduce(NXReduce):
                 self.log(
                     "Need to define a valid Laue group before PDF calculation")
                 return
-            if self.julia is None:
+            if self.interpolation == 'julia' and self.julia is None:
                 try:
                     self.julia = init_julia()
                 except Exception as error:
                     self.log(f"Cannot initialize Julia: {error}")
                     self.julia = None
                     return
-            load_julia(['LaplaceInterpolation.jl'])
+                load_julia(['LaplaceInterpolation.jl'])
             self.record_start(task)
             self.ensure_transmission_q()
             self.init_pdf(mask)
@@ -2871,6 +3043,10 @@ class NXMultiReduce(NXReduce):
                 self.total_pdf()
                 self.punch_and_fill()
                 self.delta_pdf()
+                self.finish_writes()
+                if self.pyramid:
+                    self.add_pyramid(
+                        (self.scan_entry or self.entry)[self.symm_data])
                 self.write_parameters(radius=self.radius, qmax=self.qmax)
                 self.record(task, laue=self.refine.laue_group,
                             radius=self.radius, qmax=self.qmax)
@@ -2879,9 +3055,218 @@ class NXMultiReduce(NXReduce):
                 self.log(str(error))
                 self.record_fail(task)
                 raise
+            finally:
+                self._pending = []
+                if self._writer is not None:
+                    self._writer.shutdown(wait=True)
+                    self._writer = None
+                self._volumes = {}
         else:
             self.log(f"{'Masked PDF' if mask else 'PDF'} already calculated")
 
+    def nxpdf_series(self, mask=False, parallel=False):
+        """Calculate the PDFs of all the selected scans in the parent.
+
+        The taper function, hole mask, and reflection indices are
+        calculated once, using the first scan, and shared by all scans
+        whose PDF grid is the same (see `pdf_grid`). The scans are then
+        processed in turn in this process, so that Julia is only started
+        once and the FFT plans cached by SciPy are reused. If `parallel`
+        is True, the scans are distributed over a process pool instead,
+        with each worker processing its scans sequentially within a
+        share of the memory budget. Only the hole mask and reflection
+        indices are sent to the workers, which obtain the taper from
+        `spherical_taper`, so its grid pass is done once per worker
+        and not for every scan. The output of each
+        scan is the same as if `nxpdf` were run separately.
+
+        Parameters
+        ----------
+        mask : bool, optional
+            True if the masked transforms are used, by default False.
+        parallel : bool, optional
+            True if the scans are processed in parallel, by default
+            False.
+        """
+        if self.parent is None:
+            self.log("Cannot calculate PDF series: no parent defined")
+            return
+        directories = [self.parent.directory.joinpath(
+                       self.parent.scan_directory(scan.stem))
+                       for scan in self.parent.selected_scans]
+        directories = [d for d in directories if d.is_dir()]
+        if not directories:
+            self.log("No scans selected in the parent")
+            return
+        options = self.pdf_options()
+        first = NXMultiReduce(directory=directories[0], **options)
+        if first.find_group('masked_transform' if mask else 'transform'):
+            first.init_pdf(mask)
+            self.shared = {'grid': first.pdf_grid, 'taper': first.taper,
+                           'hole_mask': first.hole_mask(),
+                           'indices': first.indices}
+        self.log(f"Calculating {'masked ' if mask else ''}PDFs for "
+                 f"{len(directories)} scans")
+        if parallel:
+            workers = min(self.process_count, len(directories))
+            options['memory'] = self.memory / workers
+            # Workers obtain the taper from the spherical_taper cache.
+            shared = self.shared
+            if shared is not None:
+                shared = {key: value for key, value in shared.items()
+                          if key != 'taper'}
+            with NXExecutor(max_workers=workers,
+                            mp_context=self.concurrent or 'spawn') as executor:
+                futures = {executor.submit(pdf_series_scan, directory,
+                                           options, shared, mask):
+                           directory for directory in directories}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                        self.log(f"PDF series: '{futures[future].name}' "
+                                 "completed")
+                    except Exception as error:
+                        self.log(f"PDF series: '{futures[future].name}' "
+                                 f"failed: {error}")
+        else:
+            for directory in directories:
+                reduce = NXMultiReduce(directory=directory, **options)
+                reduce.shared = self.shared
+                reduce.julia = self.julia
+                try:
+                    reduce.nxpdf(mask=mask)
+                    self.julia = reduce.julia
+                except Exception as error:
+                    self.log(f"PDF series: '{directory.name}' failed: "
+                             f"{error}")
+
+    def nxrefine_series(self, lattice=False, parallel=False):
+        """Refine the HKL values of all the selected scans in the parent.
+
+        The first scan is refined in this process. Each subsequent scan
+        is then seeded with the solution of the preceding scan, so that
+        refinements of a series of temperatures start close to their
+        minima. If `parallel` is True, the remaining scans are divided
+        into consecutive blocks, one per process, each seeded with the
+        solution of the first scan. The refined parameters are written
+        to each wrapper file as if `nxrefine` were run separately, and a
+        table of convergence statistics is logged.
+
+        Parameters
+        ----------
+        lattice : bool, optional
+            True if the lattice parameters are refined for all entries,
+            not just the first, by default False.
+        parallel : bool, optional
+            True if the scans are refined in parallel, by default False.
+
+        Returns
+        -------
+        list of dict
+            Convergence statistics of each entry of each scan.
+        """
+        if self.parent is None:
+            self.log("Cannot refine series: no parent defined")
+            return []
+        directories = [self.parent.directory.joinpath(
+                       self.parent.scan_directory(scan.stem))
+                       for scan in self.parent.selected_scans]
+        directories = [d for d in directories if d.is_dir()]
+        if not directories:
+            self.log("No scans selected in the parent")
+            return []
+        options = {'subentry': self.subentry_name, 'lattice': lattice,
+                   'polar_max': self.polar_max,
+                   'hkl_tolerance': self.hkl_tolerance,
+                   'overwrite': self.overwrite}
+        self.log(f"Refining {len(directories)} scans")
+        stats = []
+        seeds = {}
+        for entry in NXReduce(directory=directories[0]).entries:
+            reduce = NXReduce(entry, directory=directories[0], refine=True,
+                              **options)
+            entry_stats = reduce.refine_from_seed()
+            if 'state' in entry_stats:
+                seeds[entry] = entry_stats.pop('state')
+            stats.append(entry_stats)
+        directories = directories[1:]
+        if parallel and len(directories) > 1:
+            workers = min(self.process_count, len(directories))
+            blocks = [[directories[i] for i in block] for block
+                      in np.array_split(np.arange(len(directories)), workers)]
+            with NXExecutor(max_workers=workers,
+                            mp_context=self.concurrent or 'spawn') as executor:
+                futures = {executor.submit(refine_series_scans, block,
+                                           seeds, options): i
+                           for i, block in enumerate(blocks)}
+                results = [[] for _ in blocks]
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception as error:
+                        self.log(f"Refinement series failed: {error}")
+            for result in results:
+                stats.extend(result)
+        elif directories:
+            stats.extend(refine_series_scans(directories, seeds, options))
+        for line in self.refinement_table(stats):
+            self.log(line)
+        return stats
+
+    @staticmethod
+    def refinement_table(stats):
+        """Return the convergence statistics of a series as table rows.
+
+        Parameters
+        ----------
+        stats : list of dict
+            Statistics returned by `NXReduce.refine_from_seed`.
+
+        Returns
+        -------
+        list of str
+            Header and one row for each refined entry.
+        """
+        lines = [f"{'Scan':<16}{'Entry':<8}{'Peaks':>7}{'Initial':>10}"
+                 f"{'Final':>10}{'Evals':>7}{'Time':>8}  Status"]
+        for s in stats:
+            lines.append(f"{s['scan']:<16}{s['entry']:<8}{s['peaks']:>7d}"
+                         f"{s['initial']:>10.5f}{s['final']:>10.5f}"
+                         f"{s['nfev']:>7d}{s['time']:>8.2f}  {s['status']}")
+        converged = sum(s['status'] == 'converged' for s in stats)
+        lines.append(f"{converged} of {len(stats)} refinements converged")
+        return lines
+
+    def pdf_options(self):
+        """Return the keyword arguments used to reproduce PDF settings."""
+        return {'subentry': self.subentry_name, 'pdf': True,
+                'laue': self._laue, 'radius': self._radius,
+                'qmax': self._qmax,
+                'memory': self._memory, 'precision': self.precision,
+                'interpolation': self.interpolation,
+                'pipeline': self.pipeline, 'rmax': self.rmax,
+                'pyramid': self.pyramid,
+                'regular': self.regular, 'mask': self.mask,
+                'overwrite': self.overwrite}
+
+    @property
+    def pdf_grid(self):
+        """Parameters determining the PDF inputs shared by a series.
+
+        These are the shape and limits of the transform grid, the Laue
+        group, and the values of `qmax` and `radius`. They are only
+        defined after `init_pdf` has been called.
+        """
+        return (tuple((len(Q), float(Q[0]), float(Q[-1]))
+                      for Q in (self.Ql, self.Qk, self.Qh)),
+                self.refine.laue_group, self.qmax, self.radius)
+
+    @property
+    def shares_pdf_grid(self):
+        """True if the shared series PDF inputs apply to this scan."""
+        return self.shared is not None and self.shared['grid'] == (
+            self.pdf_grid)
+
     def init_pdf(self, mask=False):
         if mask:
             self.title = 'Masked PDF'
@@ -2912,21 +3297,35 @@ class NXMultiReduce(NXReduce):
         total_size = transform.nxsignal.nbytes / 1e6
         if total_size > nxgetconfig('memory'):
             nxsetconfig(memory=total_size+1000)
-        self.taper = self.fft_taper()
+        if self.shares_pdf_grid and 'taper' in self.shared:
+            self.taper = self.shared['taper']
+        else:
+            self.taper = self.fft_taper()
 
     def symmetrize_transform(self):
         self.log(f"{self.title}: Transform being symmetrized")
         tic = timeit.default_timer()
-        symm_root = nxopen(self.symm_file, 'w')
-        symm_root['entry'] = NXentry()
-        symm_root['entry/data'] = NXdata()
         transform = self.find_group(self.transform_path)
         symmetry = NXSymmetry(transform,
                               laue_group=self.refine.laue_group)
-        symm_root['entry/data/data'] = symmetry.symmetrize(entries=True)
-        symm_root['entry/data'].nxsignal = symm_root['entry/data/data']
-        symm_root['entry/data'].nxweights = 1.0 / self.taper
-        symm_root['entry/data'].nxaxes = transform.nxaxes
+        result = symmetry.symmetrize(entries=True, dtype=self.float_type)
+        if self.pipeline:
+            self._volumes['symm'] = result
+        weights = 1.0 / self.taper[()]
+        axes = [NXfield(axis.nxvalue, name=axis.nxname, attrs=axis.attrs)
+                for axis in transform.nxaxes]
+        chunks = transform.nxsignal.chunks or True
+
+        def write():
+            with nxopen(self.symm_file, 'w') as symm_root:
+                symm_root['entry'] = NXentry()
+                symm_root['entry/data'] = NXdata(
+                    NXfield(shape=result.shape, dtype=result.dtype,
+                            chunks=chunks, fillvalue=0, name='data'), axes)
+                write_nonzero_chunks(symm_root['entry/data/data'], result)
+                symm_root['entry/data'].nxweights = weights
+
+        self.write_async(write)
         with self:
             write_target = self._get_reduce_target()
             if self.symm_data in write_target:
@@ -2939,7 +3338,8 @@ class NXMultiReduce(NXReduce):
                 '/entry/data/data_weights', file=self.symm_file)
             write_target[self.symm_data].nxauxiliary_signals = ['data_weights']
             self.add_title(write_target[self.symm_data])
-            self.consolidate(write_target[self.symm_data])
+            symm_group = write_target[self.symm_data]
+        self.write_async(None, lambda: self.consolidate(symm_group))
         self.log(f"'{self.symm_data}' added to entry")
         toc = timeit.default_timer()
         self.log(f"{self.title}: Symmetrization completed "
@@ -2948,8 +3348,12 @@ class NXMultiReduce(NXReduce):
     def fft_taper(self, qmax=None):
         """Calculate spherical Tukey taper function.
 
-        The taper function values are read from the parent if they are
-        available.
+        The taper function values are read in slabs from the parent's
+        weights if they are available. Otherwise, the taper is returned
+        by `spherical_taper`, which evaluates it in slabs from the grid
+        axes when it is indexed, and caches it for the current grid and
+        qmax. In either case, the full volume is only created if it is
+        needed.
 
         Parameters
         ----------
@@ -2958,8 +3362,8 @@ class NXMultiReduce(NXReduce):
 
         Returns
         -------
-        array-like
-            An array containing the 3D taper function values.
+        SphericalTaper or WeightsTaper
+            The 3D taper function, evaluated when it is indexed.
         """
         if self.parent:
             entry = self.parent.root['entry']
@@ -2971,26 +3375,14 @@ class NXMultiReduce(NXReduce):
                     and entry['symm_masked_transform'].nxweights):
                 weights = entry['symm_masked_transform'].nxweights
             if weights is not None:
-                weights_mb = weights.nbytes / 1e6
-                if weights_mb > nxgetconfig('memory'):
-                    nxsetconfig(memory=weights_mb + 1000)
-                data = weights.nxvalue
-                if data.ndim > 3:
-                    data = data[0]
-                return 1.0 / data
+                return WeightsTaper(weights, dtype=self.float_type)
         self.log(f"{self.title}: Calculating taper function")
         tic = timeit.default_timer()
         if qmax is None:
             qmax = self.qmax
-        Z, Y, X = np.meshgrid(self.Ql * self.refine.cstar,
-                              self.Qk * self.refine.bstar,
-                              self.Qh * self.refine.astar,
-                              indexing='ij')
-        taper = np.ones(X.shape, dtype=np.float32)
-        R = 2 * np.sqrt(X**2 + Y**2 + Z**2) / qmax
-        idx = (R > 1.0) & (R < 2.0)
-        taper[idx] = 0.5 * (1 - np.cos(R[idx] * np.pi))
-        taper[R >= 2.0] = taper.min()
+        taper = spherical_taper(self.Qh.nxvalue * self.refine.astar,
+                                self.Qk.nxvalue * self.refine.bstar,
+                                self.Ql.nxvalue * self.refine.cstar, qmax)
         toc = timeit.default_timer()
         self.log(f"{self.title}: Taper function calculated "
                          f"({toc-tic:g} seconds)")
@@ -3006,17 +3398,11 @@ class NXMultiReduce(NXReduce):
                 return
         self.log(f"{self.title}: Calculating total PDF")
         tic = timeit.default_timer()
-        target = self.scan_entry or self.entry
-        symm_data = target[self.symm_data].nxsignal.nxvalue
-        symm_data *= self.taper
-        fft = np.real(scipy.fft.fftshift(
-            scipy.fft.fftn(scipy.fft.fftshift(symm_data[:-1, :-1, :-1]),
-                           workers=self.process_count)))
-        fft *= (1.0 / np.prod(fft.shape))
-
-        with nxopen(self.total_pdf_file, 'a') as root:
-            root['entry'] = NXentry()
-            root['entry/pdf'] = NXdata(NXfield(fft, name='pdf'))
+        if 'symm' in self._volumes:
+            data = self._volumes['symm']
+        else:
+            data = (self.scan_entry or self.entry)[self.symm_data].nxsignal
+        z, y, x = self.transform_pdf(data, self.total_pdf_file)
 
         with self:
             write_target = self._get_reduce_target()
@@ -3024,29 +3410,122 @@ class NXMultiReduce(NXReduce):
                 del write_target[self.total_pdf_data]
             pdf = NXlink('/entry/pdf/pdf', file=self.total_pdf_file,
                          name='pdf')
-
-            dl, dk, dh = [(ax[1]-ax[0]).nxvalue
-                          for ax in write_target[self.symm_data].nxaxes]
-            x = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[2], dh)), name='x', scaling_factor=self.refine.a)
-            y = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[1], dk)), name='y', scaling_factor=self.refine.b)
-            z = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[0], dl)), name='z', scaling_factor=self.refine.c)
+            x = NXfield(x, name='x', scaling_factor=self.refine.a)
+            y = NXfield(y, name='y', scaling_factor=self.refine.b)
+            z = NXfield(z, name='z', scaling_factor=self.refine.c)
             write_target[self.total_pdf_data] = NXdata(pdf, (z, y, x))
             write_target[self.total_pdf_data].attrs['angles'] = (
                 self.refine.lattice_parameters[3:])
             self.add_title(write_target[self.total_pdf_data])
-            self.consolidate(write_target[self.total_pdf_data])
+            pdf_group = write_target[self.total_pdf_data]
+        self.write_async(None, lambda: self.consolidate(pdf_group))
 
         self.log(f"'{self.total_pdf_data}' added to entry")
         toc = timeit.default_timer()
         self.log(f"{self.title}: Total PDF calculated "
                          f"({toc - tic:g} seconds)")
 
+    def transform_pdf(self, data, pdf_file):
+        """Write the Fourier transform of the tapered data to a PDF file.
+
+        The transform is calculated in memory unless its estimated
+        size (see `pdf_memory`) exceeds the memory budget, in which
+        case it is calculated out-of-core using a scratch file in the
+        scan directory, in slabs whose size fits the budget, with the
+        FFT slabs distributed over a process pool if concurrent
+        processing is enabled. The taper is evaluated slab by slab in
+        both cases, so it is never held in full. The precision of the
+        transform is set by `precision`. In pipeline mode, in-core
+        transforms are written in the background.
+
+        If `rmax` is set, the PDF is only evaluated within a local
+        region, |r| <= rmax along each axis, using partial DFTs, whose
+        cost scales with the size of the region instead of the full
+        grid.
+
+        Parameters
+        ----------
+        data : NXfield, ndarray, or PunchFillView
+            Symmetrized reciprocal space data.
+        pdf_file : Path
+            File to contain the PDF in '/entry/pdf/pdf'.
+
+        Returns
+        -------
+        list of ndarrays
+            The z, y, and x axes of the PDF in lattice units.
+        """
+        shape = tuple(n-1 for n in data.shape)
+        dtype = self.float_type
+        size = np.dtype(dtype).itemsize
+        steps = [(ax[1]-ax[0]).nxvalue for ax
+                 in (self.scan_entry or self.entry)[self.symm_data].nxaxes]
+        if self.rmax is not None:
+            rmax = [self.rmax / p for p in
+                    (self.refine.c, self.refine.b, self.refine.a)]
+            axes = pdf_axes(data.shape, steps, rmax=rmax)
+        else:
+            axes = pdf_axes(data.shape, steps)
+        local = tuple(len(r) for r in axes) != shape
+        itemsize = data.dtype.itemsize
+        required = pdf_memory(data.shape, itemsize, dtype) / 1e6
+        if local or required <= self.memory:
+            if local:
+                plane_size = ((itemsize + self.taper.dtype.itemsize) *
+                              np.prod(data.shape[1:]) +
+                              2 * size * len(axes[2]) * data.shape[1])
+                chunk_size = max(1, int(self.memory * 1e6 / (4*plane_size)))
+                fft = pdf_transform_local(data, self.taper, steps, axes,
+                                          chunk_size=chunk_size, dtype=dtype)
+            else:
+                if isinstance(data, NXfield):
+                    data = read_stored_chunks(data)
+                fft = pdf_transform(
+                    np.asarray(getattr(data, 'nxvalue', data)), self.taper,
+                    workers=self.process_count, dtype=dtype)
+
+            def write():
+                with nxopen(pdf_file, 'a') as root:
+                    root['entry'] = NXentry()
+                    root['entry/pdf'] = NXdata(NXfield(fft, name='pdf'))
+
+            self.write_async(write)
+            return axes
+        processes = self.process_count if self.concurrent else 1
+        chunk_size = max(1, int(self.memory * 1e6 / pdf_memory(
+            data.shape, itemsize, dtype, chunk_size=1, processes=processes)))
+        used = pdf_memory(data.shape, itemsize, dtype, chunk_size,
+                          processes) / 1e6
+        self.log(f"{self.title}: Calculating transform out-of-core "
+                 f"({required:.0f} MB required in memory, {used:.0f} MB "
+                 f"in slabs of {chunk_size} planes)")
+        with nxopen(pdf_file, 'a') as root:
+            root['entry'] = NXentry()
+            root['entry/pdf'] = NXdata(NXfield(shape=shape, dtype=dtype,
+                                               name='pdf'))
+            scratch_file = pdf_file.with_suffix('.npy')
+            try:
+                if self.concurrent:
+                    with NXExecutor(max_workers=self.process_count,
+                                    mp_context=self.concurrent) as executor:
+                        pdf_transform_chunked(
+                            data, self.taper, root['entry/pdf/pdf'],
+                            scratch_file, chunk_size, executor=executor,
+                            dtype=dtype)
+                else:
+                    pdf_transform_chunked(
+                        data, self.taper, root['entry/pdf/pdf'],
+                        scratch_file, chunk_size, workers=self.process_count,
+                        dtype=dtype)
+            finally:
+                if scratch_file.exists():
+                    scratch_file.unlink()
+        return axes
+
     def hole_mask(self):
-        symm_group = (self.scan_entry or self.entry)[self.symm_data]
-        dl, dk, dh = [(ax[1]-ax[0]).nxvalue for ax in symm_group.nxaxes]
+        if self.shares_pdf_grid:
+            return self.shared['hole_mask']
+        dl, dk, dh = [(Q[1]-Q[0]).nxvalue for Q in (self.Ql, self.Qk, self.Qh)]
         dhp = np.rint(self.radius / (dh * self.refine.astar))
         dkp = np.rint(self.radius / (dk * self.refine.bstar))
         dlp = np.rint(self.radius / (dl * self.refine.cstar))
@@ -3059,6 +3538,8 @@ class NXMultiReduce(NXReduce):
 
     @property
     def indices(self):
+        if self.shares_pdf_grid:
+            return self.shared['indices']
         self.refine.polar_max = max([NXRefine(
             self.root[e], subentry=self._subentry).two_theta_max()
             for e in self.entries])
@@ -3077,7 +3558,7 @@ class NXMultiReduce(NXReduce):
                 root['data'] = data
                 symmetry = NXSymmetry(root['data'],
                                       laue_group=self.refine.laue_group)
-            result = symmetry.symmetrize()
+            result = symmetry.symmetrize(dtype=data.dtype)
             Path(root.nxfilename).unlink()
             return result
         else:
@@ -3086,27 +3567,29 @@ class NXMultiReduce(NXReduce):
     def punch_and_fill(self):
         self.log(f"{self.title}: Performing punch-and-fill")
 
-        from juliacall import Main
-        LaplaceInterpolation = Main.LaplaceInterpolation
-
         tic = timeit.default_timer()
         target = self.scan_entry or self.entry
         symm_group = target[self.symm_data]
         Qh, Qk, Ql = (symm_group['Qh'], symm_group['Qk'], symm_group['Ql'])
 
-        symm_root = nxopen(self.symm_file, 'rw')
-        symm_data = symm_root['entry/data/data']
+        scratch_file = self.symm_file.with_suffix('.npy')
+        if 'symm' in self._volumes:
+            symm_data = self._volumes['symm']
+            chunks = None
+            if self.concurrent:
+                np.save(scratch_file, symm_data)
+                args = (str(scratch_file), None)
+            else:
+                args = (symm_data, None)
+        else:
+            symm_data = nxopen(self.symm_file, 'r')['entry/data/data']
+            chunks = symm_data.chunks
+            args = (symm_data.nxfilename, symm_data.nxfilepath)
 
         mask, mask_indices = self.hole_mask()
-        idx = [Main.CartesianIndex(int(i[0]+1), int(i[1]+1), int(i[2]+1))
-               for i in mask_indices]
-        ml = int((mask.shape[0]-1)/2)
-        mk = int((mask.shape[1]-1)/2)
-        mh = int((mask.shape[2]-1)/2)
+        mask_indices = np.array(mask_indices, dtype=int).reshape(-1, 3)
+        ml, mk, mh = [(n-1) // 2 for n in mask.shape]
         fill_data = np.zeros(shape=symm_data.shape, dtype=symm_data.dtype)
-        self.refine.polar_max = max([NXRefine(
-            self.root[e], subentry=self._subentry).two_theta_max()
-            for e in self.entries])
         indices = self.indices
         self.log(f"{self.title}: Punching {len(indices)} reflections; "
                  f"mask shape {mask.shape}, {len(mask_indices)} interior "
@@ -3123,41 +3606,60 @@ class NXMultiReduce(NXReduce):
                     tag += f": {msg}"
                 examples[bucket].append(tag)
 
-        for H, K, L in indices:
-            ih_hits = np.argwhere(np.isclose(Qh, H))
-            ik_hits = np.argwhere(np.isclose(Qk, K))
-            il_hits = np.argwhere(np.isclose(Ql, L))
-            if not (len(ih_hits) and len(ik_hits) and len(il_hits)):
-                _record('off_grid', (H, K, L))
-                continue
-            ih, ik, il = ih_hits[0][0], ik_hits[0][0], il_hits[0][0]
-            lslice = slice(il-ml, il+ml+1)
-            kslice = slice(ik-mk, ik+mk+1)
-            hslice = slice(ih-mh, ih+mh+1)
-            try:
-                v = symm_data[(lslice, kslice, hslice)].nxvalue
-            except Exception as error:
-                _record('other', (H, K, L), f"read failed: {error}")
-                continue
-            if v.shape != mask.shape:
-                _record('edge', (H, K, L), f"cube {v.shape} vs mask "
-                                            f"{mask.shape}")
-                continue
-            if not np.any(v > 0.0):
-                _record('no_signal', (H, K, L),
-                        f"max={float(np.nanmax(v)):.3g}")
-                continue
-            try:
-                w = LaplaceInterpolation.matern_3d_grid(v, idx)
-            except Exception as error:
-                _record('matern_failed', (H, K, L), str(error))
-                continue
-            try:
-                fill_data[(lslice, kslice, hslice)] += np.where(mask, w, 0)
-            except Exception as error:
-                _record('other', (H, K, L), f"assign failed: {error}")
-                continue
-            counts['punched'] += 1
+        batches, rejected = punch_batches(
+            indices, (Ql.nxvalue, Qk.nxvalue, Qh.nxvalue), mask.shape,
+            chunks)
+        for bucket, hkl, msg in rejected:
+            _record(bucket, hkl, msg)
+
+        punched = tuple(mask_indices.T)
+
+        def _fill(result):
+            i, filled, values, failures = result
+            reflections, corners = batches[i]
+            for bucket, hkl, msg in failures:
+                _record(bucket, hkl, msg)
+            for j, value in zip(filled, values):
+                cube = tuple(slice(c, c+n)
+                             for c, n in zip(corners[j], mask.shape))
+                fill_data[cube][punched] += value
+                counts['punched'] += 1
+            return len(reflections)
+
+        done = 0
+        self.start_progress(0, len(indices))
+        if self.concurrent:
+            with NXExecutor(max_workers=self.process_count,
+                            mp_context=self.concurrent) as executor:
+                futures = {executor.submit(punch_fill_batch, *args, i,
+                                           reflections, corners,
+                                           mask_indices, mask.shape,
+                                           self.interpolation): i
+                           for i, (reflections, corners)
+                           in enumerate(batches)}
+                for future in as_completed(futures):
+                    try:
+                        done += _fill(future.result())
+                    except Exception as error:
+                        reflections = batches[futures[future]][0]
+                        _record('other', reflections[0],
+                                f"batch failed: {error}")
+                        done += len(reflections)
+                    self.update_progress(done)
+        else:
+            for i, (reflections, corners) in enumerate(batches):
+                try:
+                    done += _fill(punch_fill_batch(
+                        *args, i, reflections, corners, mask_indices,
+                        mask.shape, self.interpolation))
+                except Exception as error:
+                    _record('other', reflections[0],
+                            f"batch failed: {error}")
+                    done += len(reflections)
+                self.update_progress(done)
+        self.stop_progress()
+        if scratch_file.exists():
+            scratch_file.unlink()
         self.log(f"{self.title}: Punch outcomes: " +
                  ", ".join(f"{k}={v}" for k, v in counts.items()))
         for bucket, exs in examples.items():
@@ -3168,37 +3670,70 @@ class NXMultiReduce(NXReduce):
         self.log(f"{self.title}: Symmetrizing punch-and-fill")
 
         fill_data = self.symmetrize(fill_data)
-        changed_idx = np.where(fill_data > 0)
-        buffer = symm_data.nxvalue
-        buffer[changed_idx] = fill_data[changed_idx]
-        if 'fill' in symm_root['entry/data']:
-            del symm_root['entry/data/fill']
-        symm_root['entry/data/fill'] = buffer
+        corners, values, changed = punch_fill_blocks(
+            fill_data, fill_data > 0, mask.shape)
+        self.log(f"{self.title}: {changed.sum()} voxels changed in "
+                 f"{len(corners)} blocks")
+        if self.pipeline:
+            self._volumes['delta'] = (corners, values, changed)
+
+        def write():
+            with nxopen(self.symm_file, 'rw') as symm_root:
+                for name in ['fill', 'punch', 'delta']:
+                    if name in symm_root['entry/data']:
+                        del symm_root['entry/data'][name]
+                symm_root['entry/data/delta'] = NXcollection(
+                    NXfield(corners, name='corners'),
+                    NXfield(values, name='values'),
+                    NXfield(changed, name='mask'))
+
+        self.write_async(write)
         with self:
             write_target = self._get_reduce_target()
-            if 'filled_data' in write_target[self.symm_data]:
-                del write_target[self.symm_data]['filled_data']
-            write_target[self.symm_data]['filled_data'] = NXlink(
-                '/entry/data/fill', file=self.symm_file)
-
-        buffer[changed_idx] *= 0
-        if 'punch' in symm_root['entry/data']:
-            del symm_root['entry/data/punch']
-        symm_root['entry/data/punch'] = buffer
-        with self:
-            write_target = self._get_reduce_target()
-            if 'punched_data' in write_target[self.symm_data]:
-                del write_target[self.symm_data]['punched_data']
-            write_target[self.symm_data]['punched_data'] = NXlink(
-                '/entry/data/punch', file=self.symm_file)
+            for name in ['filled_data', 'punched_data', 'delta']:
+                if name in write_target[self.symm_data]:
+                    del write_target[self.symm_data][name]
+            write_target[self.symm_data]['delta'] = NXlink(
+                '/entry/data/delta', file=self.symm_file)
             write_target[self.symm_data].nxauxiliary_signals = [
-                'data_weights', 'filled_data', 'punched_data']
-            self.consolidate(write_target[self.symm_data])
+                'data_weights']
+            symm_group = write_target[self.symm_data]
+        self.write_async(None, lambda: self.consolidate(symm_group))
 
         toc = timeit.default_timer()
         self.log(f"{self.title}: Punch-and-fill completed "
                          f"({toc - tic:g} seconds)")
 
+    def filled_data(self, filled=True):
+        """Return a lazy view of the symmetrized data after punch-and-fill.
+
+        Parameters
+        ----------
+        filled : bool, optional
+            True if the punched voxels contain the interpolated values,
+            or False if they are set to zero, by default True.
+
+        Returns
+        -------
+        PunchFillView
+            View composing the symmetrized data and the sparse blocks
+            of voxels changed by punch-and-fill.
+        """
+        if 'delta' in self._volumes:
+            return PunchFillView(self._volumes['symm'],
+                                 *self._volumes['delta'], filled=filled)
+        symm_group = (self.scan_entry or self.entry)[self.symm_data]
+        if 'delta' not in symm_group:
+            raise NeXusError("Punch-and-fill has not been performed")
+        delta = symm_group['delta']
+        return PunchFillView(symm_group.nxsignal, delta['corners'].nxvalue,
+                             delta['values'].nxvalue, delta['mask'].nxvalue,
+                             filled=filled)
+
+    def punched_data(self):
+        """Return a lazy view of the symmetrized data with punched holes."""
+        return self.filled_data(filled=False)
+
     def delta_pdf(self):
         self.log(f"{self.title}: Calculating Delta-PDF")
         if self.pdf_file.exists():
@@ -3209,37 +3744,22 @@ class NXMultiReduce(NXReduce):
                     f"{self.title}: Delta-PDF file already exists")
                 return
         tic = timeit.default_timer()
-        target = self.scan_entry or self.entry
-        symm_data = target[self.symm_data]['filled_data'].nxvalue
-        symm_data *= self.taper
-        fft = np.real(scipy.fft.fftshift(
-            scipy.fft.fftn(scipy.fft.fftshift(symm_data[:-1, :-1, :-1]),
-                           workers=self.process_count)))
-        fft *= (1.0 / np.prod(fft.shape))
-
-        root = nxopen(self.pdf_file, 'a')
-        root['entry'] = NXentry()
-        root['entry/pdf'] = NXdata(NXfield(fft, name='pdf'))
+        z, y, x = self.transform_pdf(self.filled_data(), self.pdf_file)
 
         with self:
             write_target = self._get_reduce_target()
             if self.pdf_data in write_target:
                 del write_target[self.pdf_data]
             pdf = NXlink('/entry/pdf/pdf', file=self.pdf_file, name='pdf')
-
-            dl, dk, dh = [(ax[1]-ax[0]).nxvalue
-                          for ax in write_target[self.symm_data].nxaxes]
-            x = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[2], dh)), name='x', scaling_factor=self.refine.a)
-            y = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[1], dk)), name='y', scaling_factor=self.refine.b)
-            z = NXfield(scipy.fft.fftshift(scipy.fft.fftfreq(
-                fft.shape[0], dl)), name='z', scaling_factor=self.refine.c)
+            x = NXfield(x, name='x', scaling_factor=self.refine.a)
+            y = NXfield(y, name='y', scaling_factor=self.refine.b)
+            z = NXfield(z, name='z', scaling_factor=self.refine.c)
             write_target[self.pdf_data] = NXdata(pdf, (z, y, x))
             write_target[self.pdf_data].attrs['angles'] = (
                 self.refine.lattice_parameters[3:])
             self.add_title(write_target[self.pdf_data])
-        self.consolidate((self.scan_entry or self.entry)[self.pdf_data])
+        pdf_group = (self.scan_entry or self.entry)[self.pdf_data]
+        self.write_async(None, lambda: self.consolidate(pdf_group))
 
         self.log(f"'{self.pdf_data}' added to entry")
         toc = timeit.default_timer()
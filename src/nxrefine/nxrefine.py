@@ -6,6 +6,7 @@
 # The full license is in the file LICENSE.pdf, distributed with this software.
 # -----------------------------------------------------------------------------
 
+import os
 from pathlib import Path
 
 import gemmi
@@ -16,9 +17,8 @@ from nexusformat.nexus import (NeXusError, NXcollection, NXdata, NXdetector,
                                NXinstrument, NXlink, NXmonochromator,
                                NXprocess, NXroot, NXsample, NXsubentry)
 from numpy.linalg import inv, norm
-from scipy import optimize
 
-from .nxutils import init_julia, load_julia, parse_orientation
+from .nxutils import parse_orientation
 
 degrees = 180.0 / np.pi
 radians = np.pi / 180.0
@@ -59,6 +59,57 @@ def rotmat(axis, angle):
     return np.matrix(mat)
 
 
+def rotmats(axis, angles):
+    """Return a stack of rotation matrices about the specified axis.
+
+    Parameters
+    ----------
+    axis : {1, 2, 3}
+        Index of the rotation axis.
+    angles : array_like
+        Angles of rotation in degrees.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (..., 3, 3) containing a rotation matrix for each
+        angle, with the same convention as `rotmat`.
+    """
+    angles = np.asarray(angles, dtype=float) * radians
+    cang = np.cos(angles)
+    sang = np.sin(angles)
+    i, j = [(1, 2), (2, 0), (0, 1)][axis-1]
+    mats = np.zeros(angles.shape + (3, 3))
+    mats[..., axis-1, axis-1] = 1.0
+    mats[..., i, i] = mats[..., j, j] = cang
+    mats[..., i, j] = -sang
+    mats[..., j, i] = sang
+    return mats
+
+
+def drotmats(axis, angles):
+    """Return the derivatives of `rotmats` with respect to the angles.
+
+    Parameters
+    ----------
+    axis : {1, 2, 3}
+        Index of the rotation axis.
+    angles : array_like
+        Angles of rotation in degrees.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (..., 3, 3) containing the derivative of each
+        rotation matrix per degree.
+    """
+    generator = np.zeros((3, 3))
+    i, j = [(1, 2), (2, 0), (0, 1)][axis-1]
+    generator[i, j] = -1.0
+    generator[j, i] = 1.0
+    return radians * generator @ rotmats(axis, angles)
+
+
 def vec(x, y=0.0, z=0.0):
     """Return a 1x3 column vector."""
     return np.matrix((x, y, z)).T
@@ -153,6 +204,26 @@ class NXRefine:
     space_groups = {'P': 'P1', 'A': 'Amm2', 'B': 'P1', 'C': 'C121',
                     'I': 'I222', 'F': 'F222', 'R': 'R3'}
     """Space groups with minimal systematic absences for each centring."""
+    lattice_names = ['a', 'b', 'c', 'alpha', 'beta', 'gamma']
+    """Names of the lattice parameters."""
+    jacobian_names = lattice_names + [
+        'wavelength', 'distance', 'xc', 'yc', 'pixel_size', 'yaw', 'pitch',
+        'roll', 'phi', 'phi_step', 'chi', 'omega', 'theta', 'xs', 'ys', 'zs']
+    """Parameters with analytic derivatives of the refinement residuals."""
+    detector_rotations = [('roll', 1), ('pitch', 2), ('yaw', 3)]
+    """Angles and axes of the rotations defining `Dimat`."""
+    goniometer_rotations = [('theta', 2), ('omega', 3), ('chi', 1)]
+    """Angles and axes of the rotations defining `Gmat` at zero phi."""
+    state_names = lattice_names + [
+        'space_group', 'laue_group', 'symmetry', 'centring', 'wavelength',
+        'distance', 'detector_orientation', 'yaw', 'pitch', 'roll', 'xc',
+        'yc', 'pixel_size', 'shape', 'phi', 'phi_step', 'chi', 'omega',
+        'theta', 'xs', 'ys', 'zs', 'polar_tolerance', '_polar_max',
+        '_hkl_tolerance', 'Umat']
+    """Attributes defining the state of a refinement."""
+    peak_names = ['xp', 'yp', 'zp', 'intensity', 'polar_angle',
+                  'azimuthal_angle', '_idx']
+    """Attributes defining the peaks used in a refinement."""
 
     def __init__(self, entry=None, subentry=''):
         self._entry = None
@@ -234,12 +305,7 @@ class NXRefine:
         self._idx = None
         self._peaks_error = None
         self._mode = None
-        self._Dmat_cache = inv(rotmat(1, self.roll) * rotmat(2, self.pitch) *
-                               rotmat(3, self.yaw))
-        self._Gmat_cache = (rotmat(2, self.theta) * rotmat(3, self.omega) *
-                            rotmat(1, self.chi))
-        self.julia = None
-
+        self._cache = {}
         self.parameters = None
 
         if self.entry is not None and self.entry.nxfile is not None:
@@ -1127,15 +1193,13 @@ class NXRefine:
             Maximum polar angle in degrees.
         """
         try:
-            if not isinstance(self.polar_angle, np.ndarray):
+            if (not isinstance(self.polar_angle, np.ndarray)
+                    and self.npks > 0):
                 self.polar_angle, self.azimuthal_angle = \
                     self.calculate_angles(self.xp, self.yp)
-            self.x = []
-            self.y = []
-            for i in range(self.npks):
-                if self.polar_angle[i] <= polar_max:
-                    self.x.append(self.xp[i])
-                    self.y.append(self.yp[i])
+            mask = self.polar_angle[:self.npks] <= polar_max
+            self.x = list(self.xp[:self.npks][mask])
+            self.y = list(self.yp[:self.npks][mask])
         except Exception:
             pass
         self._polar_max = polar_max
@@ -1217,7 +1281,7 @@ class NXRefine:
             _sg = self.space_groups[self.centring]
         else:
             _sg = self.space_group
-        return gemmi.SpaceGroup(_sg)
+        return self._cached('sg', _sg, lambda: gemmi.SpaceGroup(_sg))
 
     @sg.setter
     def sg(self, value):
@@ -1232,9 +1296,19 @@ class NXRefine:
         self.laue_group = _sg.laue_str()
         self.centring = _sg.centring_type()
 
+    @property
+    def _miller_key(self):
+        """Parameters defining the allowed Miller indices."""
+        return (self.lattice_parameters, self.space_group, self.centring,
+                self.wavelength, self.polar_max)
+
     @property
     def miller(self):
         """Set of allowed Miller indices."""
+        return self._cached('miller', self._miller_key,
+                            self._calculate_miller)
+
+    def _calculate_miller(self):
         indices = gemmi.make_miller_array(
             cell=self.unit_cell,
             spacegroup=self.sg,
@@ -1243,6 +1317,47 @@ class NXRefine:
         return indices[np.argsort(
             self.unit_cell.calculate_d_array(indices))[::-1]]
 
+    @property
+    def equivalents(self):
+        """Symmetry-equivalent HKL indices of each of the Miller indices.
+
+        Each list of equivalent indices is ordered as in `indices_hkl`.
+        """
+        return self._cached('equivalents', self._miller_key,
+                            self._calculate_equivalents)
+
+    def _calculate_equivalents(self):
+        """Apply all the symmetry operations to all the Miller indices.
+
+        The equivalent indices are sorted in descending order, and
+        duplicates removed, by encoding each HKL as a single integer.
+        """
+        miller = self.miller
+        if len(miller) == 0:
+            return []
+        ops = self.sg.operations()
+        rotations = np.array([op.rot for op in ops.sym_ops]) // gemmi.Op.DEN
+        hkls = np.einsum('nj,kji->nki', miller, rotations)
+        m = np.abs(hkls).max()
+        w = 2 * m + 1
+        keys = ((hkls[..., 0] + m) * w + hkls[..., 1] + m) * w + hkls[..., 2] + m
+        keys = -np.sort(-keys, axis=1)
+        unique = np.ones(keys.shape, dtype=bool)
+        unique[:, 1:] = keys[:, 1:] != keys[:, :-1]
+        hkls = np.stack((keys // w**2 - m, keys // w % w - m, keys % w - m),
+                        axis=-1)
+        if ops.is_centrosymmetric():
+            friedel = np.zeros(len(miller), dtype=bool)
+        else:
+            friedel = ~ops.centric_flag_array(miller).astype(bool)
+        _equivalents = []
+        for hkl, u, f in zip(hkls, unique, friedel):
+            _indices = [tuple(h) for h in hkl[u].tolist()]
+            if f:
+                _indices += [tuple(-i for i in h) for h in _indices]
+            _equivalents.append(_indices)
+        return _equivalents
+
     @property
     def indices(self):
         """Set of HKL indices allowed by the space group.
@@ -1250,10 +1365,7 @@ class NXRefine:
         Only a single index is returned when there are a number of
         symmetry-equivalent indices.
         """
-        _indices = []
-        for h in self.miller:
-            _indices.append(self.indices_hkl(*h)[0])
-        return _indices
+        return [hkls[0] for hkls in self.equivalents]
 
     def indices_hkl(self, H, K, L):
         """Return the symmetry-equivalent HKL indices."""
@@ -1271,9 +1383,11 @@ class NXRefine:
     @property
     def two_thetas(self):
         """The two-theta angles for all the HKL indices."""
-        return list(2 * np.degrees(
-            np.arcsin(self.wavelength /
-                      (2 * self.unit_cell.calculate_d_array(self.miller)))))
+        return self._cached(
+            'two_thetas', self._miller_key,
+            lambda: list(2 * np.degrees(np.arcsin(
+                self.wavelength /
+                (2 * self.unit_cell.calculate_d_array(self.miller))))))
 
     def two_theta_hkl(self, H, K, L):
         """Return the two-theta angle for the specified HKL values."""
@@ -1304,31 +1418,38 @@ class NXRefine:
             Map of ring indices to lists containing their two-theta
             values and symmetry-equivalent HKLs.
         """
+        return self._cached('rings',
+                            self._miller_key + (self.polar_tolerance,),
+                            self._calculate_rings)
+
+    def _calculate_rings(self):
         _rings = {}
         _r = 0
-        _indices = self.indices
-        for i, polar_angle in enumerate(self.two_thetas):
-            if i == 0:
-                _rings[0] = [polar_angle, [self.indices_hkl(*_indices[i])]]
-            elif polar_angle-_rings[_r][0] > self.polar_tolerance:
-                _r += 1
-                _rings[_r] = [polar_angle, [self.indices_hkl(*_indices[i])]]
+        for i, (polar_angle, hkls) in enumerate(zip(self.two_thetas,
+                                                    self.equivalents)):
+            if i == 0 or polar_angle-_rings[_r][0] > self.polar_tolerance:
+                if i > 0:
+                    _r += 1
+                _rings[_r] = [polar_angle, [hkls]]
+                pa, wa = polar_angle * len(hkls), len(hkls)
             else:
-                _rings[_r][1].append(self.indices_hkl(*_indices[i]))
-                pa = wa = 0.0
-                for j, hkl in enumerate(_rings[_r][1]):
-                    pa += self.two_theta_hkl(*hkl[0]) * len(hkl)
-                    wa += len(hkl)
+                _rings[_r][1].append(hkls)
+                pa += polar_angle * len(hkls)
+                wa += len(hkls)
                 _rings[_r][0] = pa / wa
         return _rings
 
     def assign_rings(self):
         """Assign all the identified Bragg peaks to rings."""
         rings = self.make_rings()
-        ring_angles = [rings[r][0] for r in rings]
-        self.rp = np.zeros((self.npks), dtype=int)
-        for i in range(self.npks):
-            self.rp[i] = (np.abs(self.polar_angle[i] - ring_angles)).argmin()
+        ring_angles = np.array([rings[r][0] for r in rings])
+        polar_angles = np.asarray(self.polar_angle[:self.npks], dtype=float)
+        i = np.searchsorted(ring_angles, polar_angles)
+        lower = np.clip(i - 1, 0, len(ring_angles) - 1)
+        upper = np.clip(i, 0, len(ring_angles) - 1)
+        self.rp = np.where(
+            polar_angles - ring_angles[lower] <= ring_angles[upper] -
+            polar_angles, lower, upper)
 
     def get_ring_list(self):
         """Return the HKL indices for all the rings."""
@@ -1357,13 +1478,6 @@ class NXRefine:
     @roll.setter
     def roll(self, value):
         self._roll = value
-        try:
-            self._Dmat_cache = inv(rotmat(1, self._roll) *
-                                   rotmat(2, self.pitch) *
-                                   rotmat(3, self.yaw))
-
-        except Exception:
-            pass
 
     @property
     def pitch(self):
@@ -1373,13 +1487,6 @@ class NXRefine:
     @pitch.setter
     def pitch(self, value):
         self._pitch = value
-        try:
-            self._Dmat_cache = inv(
-                rotmat(1, self.roll) * rotmat(2, self._pitch) *
-                rotmat(3, self.yaw))
-
-        except Exception:
-            pass
 
     @property
     def yaw(self):
@@ -1389,13 +1496,6 @@ class NXRefine:
     @yaw.setter
     def yaw(self, value):
         self._yaw = value
-        try:
-            self._Dmat_cache = inv(
-                rotmat(1, self.roll) * rotmat(2, self.pitch) *
-                rotmat(3, self._yaw))
-
-        except Exception:
-            pass
 
     @property
     def chi(self):
@@ -1405,12 +1505,6 @@ class NXRefine:
     @chi.setter
     def chi(self, value):
         self._chi = value
-        try:
-            self._Gmat_cache = (
-                rotmat(2, self.theta) * rotmat(3, self.omega) *
-                rotmat(1, self._chi))
-        except Exception:
-            pass
 
     @property
     def omega(self):
@@ -1420,12 +1514,6 @@ class NXRefine:
     @omega.setter
     def omega(self, value):
         self._omega = value
-        try:
-            self._Gmat_cache = (
-                rotmat(2, self.theta) * rotmat(3, self._omega) *
-                rotmat(1, self.chi))
-        except Exception:
-            pass
 
     @property
     def theta(self):
@@ -1435,12 +1523,6 @@ class NXRefine:
     @theta.setter
     def theta(self, value):
         self._theta = value
-        try:
-            self._Gmat_cache = (
-                rotmat(2, self._theta) * rotmat(3, self.omega) *
-                rotmat(1, self.chi))
-        except Exception:
-            pass
 
     @property
     def phi_start(self):
@@ -1466,17 +1548,63 @@ class NXRefine:
         except Exception:
             return 0
 
+    def _cached(self, name, key, function):
+        """Return a derived value, only recomputing it if the key changes.
+
+        This is used for matrices derived from the lattice and geometry
+        parameters, and for the Miller indices and rings derived from
+        the unit cell and space group.
+
+        Parameters
+        ----------
+        name : str
+            Name of the cached value.
+        key : tuple
+            Values of the parameters used to derive the value.
+        function : callable
+            Function returning the value if the parameters have changed.
+
+        Returns
+        -------
+        object
+            The derived value, which should not be modified in place.
+        """
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = self._cache[name] = (key, function())
+        return cached[1]
+
+    @property
+    def _orientation_key(self):
+        """Parameters defining the orientation and UB matrices."""
+        if self.Umat is None:
+            return None
+        else:
+            return (self.lattice_parameters,
+                    np.asarray(self.Umat, dtype=float).tobytes())
+
     @property
     def UBmat(self):
         """Return the UB matrix."""
         if self.Umat is not None:
-            return self.Umat * self.Bmat
+            return self._cached('UBmat', self._orientation_key,
+                                lambda: np.matrix(self.Umat) * self.Bmat)
         else:
             return np.matrix(np.eye(3))
 
+    @property
+    def UBimat(self):
+        """Return the inverse of the UB matrix."""
+        return self._cached('UBimat', self._orientation_key,
+                            lambda: inv(self.UBmat))
+
     @property
     def Bimat(self):
         """Return the inverse B matrix defined by the unit cell."""
+        return self._cached('Bimat', self.lattice_parameters,
+                            self._calculate_Bimat)
+
+    def _calculate_Bimat(self):
         a, b, c, alpha, beta, gamma = self.lattice_parameters
         alpha = alpha * radians
         beta = beta * radians
@@ -1490,7 +1618,8 @@ class NXRefine:
     @property
     def Bmat(self):
         """Return the B matrix defined by the unit cell."""
-        return inv(self.Bimat)
+        return self._cached('Bmat', self.lattice_parameters,
+                            lambda: inv(self.Bimat))
 
     @property
     def Omat(self):
@@ -1502,7 +1631,23 @@ class NXRefine:
             +X(det) = -y(lab), +Y(det) = -z(lab), and +Z(det) = x(lab)
 
         """
-        return parse_orientation(self.detector_orientation)
+        return self._cached(
+            'Omat', self._detector_key,
+            lambda: parse_orientation(self.detector_orientation))
+
+    @property
+    def Oimat(self):
+        """Return the matrix that rotates lab axes into detector axes."""
+        return self._cached('Oimat', self._detector_key,
+                            lambda: inv(self.Omat))
+
+    @property
+    def _detector_key(self):
+        """Parameters defining the detector orientation."""
+        if isinstance(self.detector_orientation, str):
+            return self.detector_orientation
+        else:
+            return np.asarray(self.detector_orientation).tobytes()
 
     @property
     def Dmat(self):
@@ -1511,14 +1656,25 @@ class NXRefine:
         It also transforms detector coords into lab coordinates.
             Operation order:    yaw -> pitch -> roll
         """
-        return self._Dmat_cache
+        return self._cached('Dmat', self.tilts, lambda: inv(self.Dimat))
+
+    @property
+    def Dimat(self):
+        """Return the inverse of the detector orientation matrix."""
+        return self._cached(
+            'Dimat', self.tilts,
+            lambda: (rotmat(1, self.roll) * rotmat(2, self.pitch) *
+                     rotmat(3, self.yaw)))
 
     def Gmat(self, phi):
         """Return the matrix that physically orients the goniometer head.
 
         It performs the inverse transform of lab coords into head coords.
         """
-        return self._Gmat_cache * rotmat(3, phi)
+        return self._cached(
+            'Gmat', (self.theta, self.omega, self.chi),
+            lambda: (rotmat(2, self.theta) * rotmat(3, self.omega) *
+                     rotmat(1, self.chi))) * rotmat(3, phi)
 
     @property
     def Cvec(self):
@@ -1539,33 +1695,81 @@ class NXRefine:
         return vec(self.xs, self.ys, self.zs)
 
     def Gvec(self, x, y, z):
+        """Return the scattering vector of a single pixel as a column."""
+        return vec(*self.calculate_Gvecs(x, y, z)[0])
+
+    def calculate_Gvecs(self, x, y, z):
+        """Return the scattering vectors of the specified pixels.
+
+        All the vectors are evaluated in a single pass, so this should be
+        used in preference to `Gvec` when there are many peaks.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Pixel coordinates.
+        z : array_like
+            Frame indices.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (N, 3) containing the scattering vectors in
+            the goniometer head frame in reciprocal Å.
+        """
+        return self._scattering_geometry(x, y, z)['G']
+
+    def _scattering_geometry(self, x, y, z):
+        """Return the intermediate vectors used to calculate G-vectors."""
+        x, y, z = [np.atleast_1d(np.asarray(v, dtype=float))
+                   for v in (x, y, z)]
         phi = self.phi + self.phi_step * z
-        v1 = vec(x, y)
-        v2 = self.pixel_size * inv(self.Omat) * (v1 - self.Cvec)
-        v3 = inv(self.Dmat) * v2 - self.Dvec(phi)
-        return (inv(self.Gmat(phi)) *
-                ((norm_vec(v3) / self.wavelength) - self.Evec))
+        Rmats = rotmats(3, phi)
+        Gmats = np.asarray(self.Gmat(0.0)) @ Rmats
+        v1 = np.stack((x, y, np.zeros_like(x)), axis=-1)
+        v2 = self.pixel_size * ((v1 - np.asarray(self.Cvec).ravel())
+                                @ np.asarray(self.Oimat).T)
+        Dvecs = Gmats @ np.asarray(self.Svec).ravel()
+        Dvecs[:, 0] -= self.distance
+        v3 = v2 @ np.asarray(self.Dimat).T - Dvecs
+        length = norm(v3, axis=1, keepdims=True)
+        u = v3 / length
+        v4 = u / self.wavelength - np.asarray(self.Evec).ravel()
+        return {'z': z, 'phi': phi, 'Rmats': Rmats, 'Gmats': Gmats,
+                'v2': v2, 'length': length, 'u': u, 'v4': v4,
+                'G': np.einsum('nji,nj->ni', Gmats, v4)}
 
     def get_Gvecs(self):
+        """Return the scattering vectors of all the peaks in `idx`."""
         idx = self.idx
-        self.Gvecs = [self.Gvec(x, y, z) for x, y, z
-                      in zip(self.xp[idx], self.yp[idx], self.zp[idx])]
-        return np.array(self.Gvecs).squeeze()
+        self.Gvecs = self.calculate_Gvecs(self.xp[idx], self.yp[idx],
+                                          self.zp[idx])
+        return self.Gvecs
 
     def calculate_angles(self, x, y):
-        """Return the polar and azimuthal angles of the specified pixels."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        polar_angles = []
-        azimuthal_angles = []
-        for i in range(len(x)):
-            peak = Oimat * (vec(x[i], y[i]) - self.Cvec)
-            v = norm(Mat * peak)
-            polar_angle = np.arctan(v / self.distance)
-            polar_angles.append(polar_angle)
-            azimuthal_angles.append(np.arctan2(-peak[1, 0], peak[2, 0]))
-        return (np.array(polar_angles) * degrees,
-                np.array(azimuthal_angles) * degrees)
+        """Return the polar and azimuthal angles of the specified pixels.
+
+        The angles of all the pixels are calculated in a single pass.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Pixel coordinates.
+
+        Returns
+        -------
+        polar_angles, azimuthal_angles : np.ndarray
+            Polar and azimuthal angles in degrees.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        Oimat = np.asarray(self.Oimat)
+        Mat = self.pixel_size * np.asarray(self.Dimat) @ Oimat
+        peaks = (np.stack((x - self.xc, y - self.yc, np.zeros_like(x)),
+                          axis=-1) @ Oimat.T)
+        polar_angles = np.arctan(norm(peaks @ Mat.T, axis=1) / self.distance)
+        azimuthal_angles = np.arctan2(-peaks[:, 1], peaks[:, 2])
+        return polar_angles * degrees, azimuthal_angles * degrees
 
     def angle_peaks(self, i, j):
         """Return the angle between two peaks in degrees.
@@ -1658,24 +1862,117 @@ class NXRefine:
         list
             HKL indices
         """
+        return list(self.calculate_hkls(x, y, z)[0])
+
+    def calculate_hkls(self, x, y, z):
+        """Return the HKL indices for the specified pixel coordinates.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Pixel coordinates.
+        z : array_like
+            Frame indices.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (N, 3) containing the HKL indices, which are
+            all zero if no orientation matrix is defined.
+        """
         if self.Umat is not None:
-            v5 = self.Gvec(x, y, z)
-#           v6 = inv(self.Umat) * v5
-#           v7 = inv(self.Bmat) * v6
-            v7 = inv(self.UBmat) * v5
-            return list(np.array(v7.T)[0])
+            return (self.calculate_Gvecs(x, y, z)
+                    @ np.asarray(self.UBimat).T)
         else:
-            return [0.0, 0.0, 0.0]
+            return np.zeros((np.size(x), 3))
+
+    def calculate_hkl_maps(self, frames, binning=1):
+        """Return the HKL indices of every pixel in the specified frames.
+
+        The pixel vectors in the laboratory frame are cached, so that
+        each frame only requires a single matrix product.
+
+        Parameters
+        ----------
+        frames : float or array_like
+            Frame indices.
+        binning : int, optional
+            Number of pixels along each detector axis combined into each
+            output pixel, by default 1. The HKL indices are calculated at
+            the center of each bin.
+
+        Returns
+        -------
+        H, K, L : np.ndarray
+            Arrays of shape (N, ny, nx) containing the HKL indices of the
+            N frames, where (ny, nx) is the detector shape divided by the
+            binning and rounded up. If `frames` is a scalar, the first
+            dimension is omitted.
+        """
+        if self.Umat is None:
+            raise NeXusError('No orientation matrix defined')
+        z = np.atleast_1d(np.asarray(frames, dtype=float))
+        pixels = self._pixel_vectors(binning)
+        Gmats = np.asarray(self.Gmat(0.0)) @ rotmats(
+            3, self.phi + self.phi_step * z)
+        Dvecs = Gmats @ np.asarray(self.Svec).ravel()
+        Dvecs[:, 0] -= self.distance
+        Evec = np.asarray(self.Evec).ravel()
+        UBimat = np.asarray(self.UBimat)
+        maps = np.empty((3, len(z)) + pixels.shape[:2])
+        for i, (Gmat, Dvec) in enumerate(zip(Gmats, Dvecs)):
+            v3 = pixels - Dvec
+            v4 = v3 / (self.wavelength * norm(v3, axis=-1, keepdims=True))
+            maps[:, i] = np.moveaxis((v4 - Evec) @ Gmat @ UBimat.T, -1, 0)
+        if np.ndim(frames) == 0:
+            maps = maps[:, 0]
+        return maps[0], maps[1], maps[2]
+
+    def _pixel_vectors(self, binning=1):
+        """Return the laboratory vectors to the centers of binned pixels."""
+        ny, nx = [int(n) for n in self.shape]
+
+        def centers(n):
+            start = np.arange(0, n, binning)
+            return (start + np.minimum(start + binning, n) - 1) / 2
+
+        def calculate():
+            x, y = np.meshgrid(centers(nx), centers(ny))
+            v1 = np.stack((x, y, np.zeros_like(x)), axis=-1)
+            v2 = self.pixel_size * ((v1 - np.asarray(self.Cvec).ravel())
+                                    @ np.asarray(self.Oimat).T)
+            return v2 @ np.asarray(self.Dimat).T
+
+        return self._cached(
+            'pixel_vectors', (self._detector_key, self.tilts, self.xc,
+                              self.yc, self.pixel_size, ny, nx, binning),
+            calculate)
+
+    def hkl_diffs(self, hkls):
+        """Return the deviations of HKL indices from the nearest lattice point.
+
+        Parameters
+        ----------
+        hkls : array_like
+            Array of shape (N, 3) or (3,) containing HKL indices.
+
+        Returns
+        -------
+        np.ndarray or float
+            Distances to the closest HKL vectors in reciprocal Å.
+        """
+        hkls = np.asarray(hkls, dtype=float)
+        return norm((hkls - np.rint(hkls)) @ np.asarray(self.Bmat).T,
+                    axis=-1)
 
     def get_hkls(self):
         """Return the set of hkls for all the  Bragg peaks as three columns."""
-        return zip(*[self.hkl(i) for i in range(self.npks)])
+        return tuple(self.calculate_hkls(self.xp, self.yp, self.zp).T)
 
     @property
     def hkls(self):
         """The set of HKLs for all the Bragg peaks."""
-        return [self.get_hkl(self.xp[i], self.yp[i], self.zp[i])
-                for i in range(self.npks)]
+        return self.calculate_hkls(self.xp, self.yp, self.zp).tolist()
 
     def hkl(self, i):
         """Return the calculated HKL indices for the specified peak."""
@@ -1694,87 +1991,103 @@ class NXRefine:
         list of NXPeaks
             List of NXPeaks containing the pixel/frame coordinates.
         """
-        v7 = vec(H, K, L)
-        v6 = self.Bmat * v7
-        v5 = self.Umat * v6
+        x, y, z, _ = self.calculate_xyzs([(H, K, L)])
+        return [NXPeak(*p, H=H, K=K, L=L, parent=self) for p in zip(x, y, z)]
 
-        def ewald_condition(phi): return (
-            norm(self.Evec)**2 - norm(self.Gmat(phi)*v5 + self.Evec)**2)
+    def get_xyzs(self, Qh=None, Qk=None, Ql=None):
+        """Return the peaks of all allowed reflections within the HKL limits.
 
-        phis = []
-        if H == 0 and K == 0 and L == 0:
-            pass
-        elif optimize.fsolve(ewald_condition, 45.0, full_output=1)[2] == 1:
-            phis = list(
-                np.unique(
-                    np.around(
-                        [optimize.fsolve(ewald_condition, phi) % 360
-                         for phi in np.arange(30, 390, 15)],
-                        decimals=4)))
-
-        def get_ij(phi):
-            v4 = self.Gmat(phi) * v5
-            p = norm_vec(v4 + self.Evec)
-            v3 = -(self.Dvec(phi)[0, 0] / p[0, 0]) * p
-            v2 = self.Dmat * (v3 + self.Dvec(phi))
-            v1 = (self.Omat * v2 / self.pixel_size) + self.Cvec
-            return v1[0, 0], v1[1, 0]
-
-        peaks = []
-        for phi in phis:
-            x, y = get_ij(phi)
-            z = ((phi - self.phi_start) / self.phi_step) % 3600
-            if z < 25:
-                z = z + 3600
-            elif z > 3625:
-                z = z - 3600
-            if x > 0 and x < self.shape[1] and y > 0 and y < self.shape[0]:
-                peaks.append(NXPeak(x, y, z, H=H, K=K, L=L, parent=self))
-
-        peaks = [peak for peak in peaks if peak.z > 0 and peak.z < 3648]
-
-        return peaks
+        Parameters
+        ----------
+        Qh, Qk, Ql : int, optional
+            Maximum absolute values of the H, K, and L indices, by default
+            the limits of the transform grid.
 
-    def get_xyzs(self, Qh=None, Qk=None, Ql=None):
-        if self.julia is None:
-            try:
-                self.julia = init_julia()
-            except Exception as error:
-                raise NeXusError(str(error))
-        load_julia(['julia/get_xyzs.jl'])
-        from juliacall import Main
-        Main.Gmat0 = np.array(self.Gmat(0.0))
-        Main.UBmat = np.array(self.UBmat)
-        Main.Dmat = np.array(self.Dmat)
-        Main.Omat = np.array(self.Omat) / self.pixel_size
-        Main.Cvec = list(np.array(self.Cvec.T).reshape((3)))
-        Main.Dvec = list(np.array(self.Dvec().T).reshape((3)))
-        Main.Evec = list(np.array(self.Evec.T).reshape((3)))
-        Main.shape = self.shape
+        Returns
+        -------
+        list of NXPeaks
+            List of NXPeaks containing the pixel/frame coordinates.
+        """
         if Qh is None:
             Qh = int(self.Qh[-1])
         if Qk is None:
             Qk = int(self.Qk[-1])
         if Ql is None:
             Ql = int(self.Ql[-1])
-        ps = self.julia.get_xyzs(Qh, Qk, Ql)
-        peaks = []
-        for p in ps:
-            try:
-                H, K, L = p[3], p[4], p[5]
-                if not self.absent(H, K, L):
-                    peaks.append(NXPeak(*p[0:3], H=H, K=K, L=L, parent=self))
-            except Exception:
-                pass
-        return peaks
+        hkls = np.stack(np.meshgrid(np.arange(-Qh, Qh+1),
+                                    np.arange(-Qk, Qk+1),
+                                    np.arange(-Ql, Ql+1), indexing='ij'),
+                        axis=-1).reshape(-1, 3).astype(np.int32)
+        hkls = hkls[~self.sg.operations().systematic_absences(hkls)]
+        x, y, z, hkls = self.calculate_xyzs(hkls)
+        return [NXPeak(*p[:3], H=p[3], K=p[4], L=p[5], parent=self)
+                for p in zip(x, y, z, *hkls.astype(int).T.tolist())]
+
+    def calculate_xyzs(self, hkls):
+        """Return the pixel/frame coordinates of the specified reflections.
+
+        For a rotation, phi, about the goniometer axis, the Ewald
+        condition reduces to A cos(phi) + B sin(phi) = C, so the angles at
+        which each reflection is in the diffraction condition are solved
+        analytically for all the reflections at once. The diffracted beams
+        are then intersected with the tilted detector plane, so that
+        `calculate_hkls` recovers the HKL indices of each peak.
+
+        Parameters
+        ----------
+        hkls : array_like
+            Array of shape (N, 3) containing the HKL indices.
+
+        Returns
+        -------
+        x, y, z : np.ndarray
+            Pixel coordinates and frame indices of the reflections that
+            are incident on the detector.
+        hkls : np.ndarray
+            HKL indices of each returned peak. Reflections usually appear
+            twice in a full rotation.
+        """
+        hkls = np.atleast_2d(np.asarray(hkls))
+        hkls = hkls[np.any(hkls != 0, axis=1)]
+        v5 = hkls @ np.asarray(self.UBmat).T
+        Evec = np.asarray(self.Evec).ravel()
+        w = np.asarray(self.Gmat(0.0)).T @ Evec
+        A = v5[:, 0] * w[0] + v5[:, 1] * w[1]
+        B = v5[:, 0] * w[1] - v5[:, 1] * w[0]
+        C = -(0.5 * np.sum(v5**2, axis=1) + v5[:, 2] * w[2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = C / np.hypot(A, B)
+        solved = np.abs(cosine) <= 1.0
+        delta = np.arctan2(B[solved], A[solved])
+        offset = np.arccos(cosine[solved])
+        tangent = np.isclose(offset, 0.0)
+        index = np.flatnonzero(solved)
+        index = np.concatenate((index, index[~tangent]))
+        phi = np.concatenate((delta + offset,
+                              delta[~tangent] - offset[~tangent]))
+        phi = (phi * degrees) % 360
+        hkls, v5 = hkls[index], v5[index]
+
+        Gmats = np.asarray(self.Gmat(0.0)) @ rotmats(3, phi)
+        p = np.einsum('nij,nj->ni', Gmats, v5) + Evec
+        p /= norm(p, axis=1, keepdims=True)
+        Dvecs = Gmats @ np.asarray(self.Svec).ravel()
+        Dvecs[:, 0] -= self.distance
+        normal = np.asarray(self.Dmat)[0]
+        v3 = -((Dvecs @ normal) / (p @ normal))[:, np.newaxis] * p
+        v2 = (v3 + Dvecs) @ np.asarray(self.Dmat).T
+        v1 = (v2 @ np.asarray(self.Omat).T / self.pixel_size
+              + np.asarray(self.Cvec).ravel())
+        x, y = v1[:, 0], v1[:, 1]
+        z = ((phi - self.phi_start) / self.phi_step) % 3600
+        z = np.where(z < 25, z + 3600, np.where(z > 3625, z - 3600, z))
+        valid = ((x > 0) & (x < self.shape[1]) & (y > 0) & (y < self.shape[0])
+                 & (z > 0) & (z < 3648))
+        return x[valid], y[valid], z[valid], hkls[valid]
 
     def polar(self, i):
         """Return the polar angle in degrees for the specified Bragg peak."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        peak = Oimat * (vec(self.xp[i], self.yp[i]) - self.Cvec)
-        v = norm(Mat * peak)
-        return np.degrees(np.arctan(v / self.distance))
+        return self.calculate_angles(self.xp[i], self.yp[i])[0][0]
 
     def score(self):
         """Return the goodness of fit of the calculated peak positions."""
@@ -1785,6 +2098,37 @@ class NXRefine:
         else:
             return 0.0
 
+    def hkl_score(self):
+        """Return the mean deviation of the peaks from integer HKL values.
+
+        Unlike `score`, which is in reciprocal Å, the deviations are in
+        reciprocal lattice units, so the score does not fall when the
+        lattice parameters grow.
+        """
+        idx = self.idx
+        if idx is not None and len(idx) > 0:
+            hkls = self.calculate_hkls(self.xp[idx], self.yp[idx],
+                                       self.zp[idx])
+            diffs = norm(hkls - np.rint(hkls), axis=-1)
+            weights = self.weights
+            return np.sum(weights * diffs) / np.sum(weights)
+        else:
+            return 0.0
+
+    def count_indexed(self):
+        """Return the number of peaks within the HKL and polar tolerances.
+
+        Unlike `idx`, which is only updated by `initialize_idx`, the
+        count is evaluated with the current parameters.
+        """
+        if self.polar_angle is not None:
+            valid = np.asarray(self.polar_angle) <= self.polar_max
+        else:
+            valid = np.ones(self.npks, dtype=bool)
+        hkls = self.calculate_hkls(self.xp[valid], self.yp[valid],
+                                   self.zp[valid])
+        return int(np.sum(self.hkl_diffs(hkls) <= self.hkl_tolerance))
+
     @property
     def idx(self):
         """List of peaks whose polar angles are less than the maximum."""
@@ -1800,9 +2144,10 @@ class NXRefine:
             self._idx[self.polar_angle>self.polar_max] = ma.masked
             if hkl_tolerance is not None:
                 self._hkl_tolerance = hkl_tolerance
-            mask = [i for i in self._idx.compressed()
-                    if self.diff(i) > self.hkl_tolerance]
-            self._idx[mask] = ma.masked
+            idx = self._idx.compressed()
+            diffs = self.hkl_diffs(self.calculate_hkls(
+                self.xp[idx], self.yp[idx], self.zp[idx]))
+            self._idx[idx[diffs > self.hkl_tolerance]] = ma.masked
 
     @property
     def weights(self):
@@ -1811,7 +2156,9 @@ class NXRefine:
 
     def diffs(self):
         """Return all the deviations from the calculated peak positions."""
-        return np.array([self.diff(i) for i in self.idx])
+        idx = self.idx
+        return self.hkl_diffs(self.calculate_hkls(
+            self.xp[idx], self.yp[idx], self.zp[idx]))
 
     def diff(self, i):
         """Return the deviation from the calculated peak position.
@@ -1827,16 +2174,23 @@ class NXRefine:
         Returns
         -------
         float
-            [description]
+            Distance to the closest HKL vector in reciprocal Å.
         """
-        H, K, L = self.hkl(i)
-        Q = np.matrix((H, K, L)).T
-        Q0 = np.matrix((np.rint(H), np.rint(K), np.rint(L))).T
-        return norm(self.Bmat * (Q - Q0))
+        return self.hkl_diffs(self.hkl(i))
 
     def angle_diffs(self):
         """Return the set of polar angle differences for all the peaks"""
-        return np.array([self.angle_diff(i) for i in self.idx])
+        return np.abs(self._angle_differences())
+
+    def _angle_differences(self):
+        """Return the signed polar angle differences for all the peaks."""
+        idx = self.idx
+        hkls = np.rint(self.calculate_hkls(self.xp[idx], self.yp[idx],
+                                           self.zp[idx])).astype(np.int32)
+        d = self.unit_cell.calculate_d_array(hkls)
+        polar0 = 2 * np.degrees(np.arcsin(self.wavelength / (2 * d)))
+        polar = self.calculate_angles(self.xp[idx], self.yp[idx])[0]
+        return polar - polar0
 
     def angle_diff(self, i):
         """Return the deviation from the calculated peak position in degrees.
@@ -1861,19 +2215,17 @@ class NXRefine:
 
     def get_peaks(self):
         """Return tuples containing the peaks and their parameters."""
-        peaks = np.array([i for i in range(self.npks)
-                          if self.polar_angle[i] < self.polar_max])
+        peaks = np.where(self.polar_angle < self.polar_max)[0]
         x, y, z = (np.rint(self.xp[peaks]).astype(np.int16),
                    np.rint(self.yp[peaks]).astype(np.int16),
                    np.rint(self.zp[peaks]).astype(np.int16))
         polar, azi = self.polar_angle[peaks], self.azimuthal_angle[peaks]
         intensity = self.intensity[peaks]
         if self.Umat is not None:
-            H, K, L = self.get_hkls()
-            H = np.array(H)[peaks]
-            K = np.array(K)[peaks]
-            L = np.array(L)[peaks]
-            diffs = np.array([self.diff(i) for i in peaks])
+            hkls = self.calculate_hkls(self.xp[peaks], self.yp[peaks],
+                                       self.zp[peaks])
+            H, K, L = hkls.T
+            diffs = self.hkl_diffs(hkls)
         else:
             H = K = L = diffs = np.zeros(peaks.shape, dtype=float)
         return list(zip(peaks, x, y, z, polar, azi, intensity, H, K, L, diffs))
@@ -1889,8 +2241,7 @@ class NXRefine:
         from lmfit import Parameters
         self.parameters = Parameters()
         if 'lattice' in opts:
-            self.define_lattice_parameters()
-            del opts['lattice']
+            self.define_lattice_parameters(opts.pop('lattice'))
         for opt in opts:
             self.parameters.add(opt, getattr(self, opt), vary=opts[opt])
         return self.parameters
@@ -1945,7 +2296,7 @@ class NXRefine:
             setattr(self, p, self.parameters[p].init_value)
         self.set_symmetry()
 
-    def refine_hkls(self, method='leastsq', **opts):
+    def refine_hkls(self, method='leastsq', npeaks=None, **opts):
         """Refine parameters based on the calculated HKL values.
 
         The parameters to be refined are defined by the keyword arguments,
@@ -1955,14 +2306,22 @@ class NXRefine:
         ----------
         method : str, optional
             LMFIT minimizer method, by default 'leastsq'
+        npeaks : int, optional
+            If there are more peaks than this, the parameters are first
+            refined using a subset of the peaks (see `stratified_idx`),
+            before a final refinement using all of them. By default, all
+            the peaks are used throughout.
         """
-        from lmfit import fit_report, minimize
+        from lmfit import fit_report
         if self.Umat is None:
             raise NeXusError('No orientation matrix defined')
         p0 = self.define_parameters(**opts)
         if len(p0) == 0:
             raise NeXusError('No parameters selected for refinement')
-        self.result = minimize(self.hkl_residuals, p0, method=method)
+        self.result = self._staged_minimize(
+            self.hkl_residuals, p0, method, npeaks,
+            **self._jacobian_options(self.hkl_jacobian, p0, method,
+                                     self.jacobian_names))
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_parameters(self.result.params)
@@ -1978,10 +2337,244 @@ class NXRefine:
         Returns
         -------
         array_like
-            An array of differences between calculated and nominal HKL values.
+            The components of the differences between the calculated and
+            nominal HKL vectors in reciprocal Å, whose sum of squares is
+            the sum of the squared `diffs`.
+        """
+        self.get_parameters(parameters)
+        return self._hkl_residuals().ravel()
+
+    def _hkl_residuals(self):
+        """Return the HKL deviations of the peaks in `idx` as vectors."""
+        idx = self.idx
+        hkls = self.calculate_hkls(self.xp[idx], self.yp[idx], self.zp[idx])
+        return (hkls - np.rint(hkls)) @ np.asarray(self.Bmat).T
+
+    def hkl_jacobian(self, parameters):
+        """Return the derivatives of the HKL residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (3N, M) containing the derivatives of
+            `hkl_residuals` with respect to the M varying parameters.
         """
         self.get_parameters(parameters)
-        return self.diffs()
+        idx = self.idx
+        geometry = self._scattering_geometry(self.xp[idx], self.yp[idx],
+                                             self.zp[idx])
+        hkls = np.rint(geometry['G'] @ np.asarray(self.UBimat).T)
+        Uimat = inv(np.asarray(self.Umat, dtype=float))
+        Bmat = np.asarray(self.Bmat)
+        columns = []
+        for name in self._varying(parameters):
+            if name in self.lattice_names:
+                dBmat = -Bmat @ self._Bimat_derivative(name) @ Bmat
+                columns.append(-hkls @ dBmat.T)
+            else:
+                columns.append(self._Gvec_derivative(name, geometry)
+                               @ Uimat.T)
+        return np.stack(columns, axis=-1).reshape(-1, len(columns))
+
+    def stratified_idx(self, npeaks, bins=8):
+        """Return a subset of the peaks in `idx` spread over the detector.
+
+        The peaks are divided into strata by the quantiles of their polar
+        angles and frame numbers. Peaks are then chosen from each stratum
+        in turn, in order of decreasing intensity, so that weak peaks in
+        sparsely populated regions are included as well as the strongest.
+
+        Parameters
+        ----------
+        npeaks : int
+            Number of peaks to be selected.
+        bins : int, optional
+            Number of polar angle and frame bins, by default 8.
+
+        Returns
+        -------
+        np.ndarray
+            Sorted indices of the selected peaks.
+        """
+        idx = self.idx
+        if len(idx) <= npeaks:
+            return idx
+        quantiles = np.linspace(0.0, 1.0, bins+1)[1:-1]
+        strata = np.zeros(idx.shape, dtype=int)
+        for values in (self.polar_angle[idx], self.zp[idx]):
+            strata = (bins * strata +
+                      np.digitize(values, np.quantile(values, quantiles)))
+        intensity = np.asarray(self.intensity[idx])
+        order = np.lexsort((-intensity, strata))
+        strata = strata[order]
+        rank = np.arange(len(idx)) - np.searchsorted(strata, strata)
+        order = order[np.lexsort((-intensity[order], rank))]
+        return np.sort(idx[order[:npeaks]])
+
+    def _staged_minimize(self, residuals, parameters, method, npeaks=None,
+                         **options):
+        """Minimize the residuals, starting with a subset of the peaks.
+
+        If `npeaks` is less than the number of peaks in `idx`, the
+        residuals are first minimized using the peaks selected by
+        `stratified_idx`. The result is then used as the starting point
+        for minimizing the residuals of all the peaks.
+        """
+        from lmfit import minimize
+        if npeaks is not None and len(self.idx) > npeaks:
+            full_idx = self._idx
+            mask = np.ones(self.npks, dtype=bool)
+            mask[self.stratified_idx(npeaks)] = False
+            self._idx = ma.array(np.arange(self.npks), mask=mask)
+            try:
+                result = minimize(residuals, parameters, method=method,
+                                  **options)
+            finally:
+                self._idx = full_idx
+            if result.success:
+                parameters = parameters.copy()
+                for name in parameters:
+                    parameters[name].value = result.params[name].value
+        return minimize(residuals, parameters, method=method, **options)
+
+    @staticmethod
+    def _varying(parameters):
+        """Return the names of the varying LMFIT parameters."""
+        return [p for p in parameters if parameters[p].vary]
+
+    def _jacobian_options(self, jacobian, parameters, method, names=None):
+        """Return the keyword arguments passing a Jacobian to LMFIT.
+
+        Analytic Jacobians are only used by the least-squares methods,
+        and only if the derivatives of all the varying parameters are
+        known, i.e., they are included in `names`. Otherwise, LMFIT
+        estimates them by finite differences.
+        """
+        if names is None:
+            names = list(parameters)
+        if (method in ['leastsq', 'least_squares'] and
+                all(p in names for p in self._varying(parameters))):
+            return {'Dfun': jacobian}
+        else:
+            return {}
+
+    def _linked_parameters(self, name):
+        """Return the lattice parameters that vary with the named one.
+
+        This accounts for the constraints applied by `set_symmetry`.
+        """
+        if self.symmetry == 'cubic':
+            return {'a': ('a', 'b', 'c')}.get(name, ())
+        elif self.symmetry in ['tetragonal', 'hexagonal']:
+            return {'a': ('a', 'b'), 'c': ('c',)}.get(name, ())
+        elif self.symmetry == 'orthorhombic':
+            return (name,) if name in ['a', 'b', 'c'] else ()
+        elif self.symmetry == 'monoclinic':
+            return (name,) if name not in ['alpha', 'gamma'] else ()
+        else:
+            return (name,)
+
+    def _Bimat_derivative(self, name):
+        """Return the derivative of `Bimat` with respect to a parameter."""
+        a, b, c, alpha, beta, gamma = self.lattice_parameters
+        ca, cb, cg = [np.cos(angle * radians) for angle in (alpha, beta, gamma)]
+        sa, sb, sg = [np.sin(angle * radians) for angle in (alpha, beta, gamma)]
+        B23 = c * (ca - cb * cg) / sg
+        B33 = np.sqrt(c**2 - (c * cb)**2 - B23**2)
+        dBimat = np.zeros((3, 3))
+        for p in self._linked_parameters(name):
+            d = np.zeros((3, 3))
+            if p == 'a':
+                d[0, 0] = 1.0
+            elif p == 'b':
+                d[0, 1], d[1, 1] = cg, sg
+            elif p == 'c':
+                d[0, 2], d[1, 2], d[2, 2] = cb, B23 / c, B33 / c
+            elif p == 'alpha':
+                d[1, 2] = -c * sa / sg * radians
+                d[2, 2] = -B23 * d[1, 2] / B33
+            elif p == 'beta':
+                d[0, 2] = -c * sb * radians
+                d[1, 2] = c * sb * cg / sg * radians
+                d[2, 2] = (c**2 * cb * sb * radians - B23 * d[1, 2]) / B33
+            elif p == 'gamma':
+                d[0, 1] = -b * sg * radians
+                d[1, 1] = b * cg * radians
+                d[1, 2] = (c * cb - B23 * cg / sg) * radians
+                d[2, 2] = -B23 * d[1, 2] / B33
+            dBimat += d
+        return dBimat
+
+    def _rotation_derivative(self, rotations, name):
+        """Return the derivative of a product of rotations by one angle.
+
+        Parameters
+        ----------
+        rotations : list of tuples
+            The attribute names and axes of the rotation angles, in the
+            order the rotation matrices are multiplied.
+        name : str
+            Name of the angle.
+        """
+        return np.linalg.multi_dot(
+            [drotmats(axis, getattr(self, p)) if p == name
+             else rotmats(axis, getattr(self, p)) for p, axis in rotations])
+
+    def _Gvec_derivative(self, name, geometry):
+        """Return the derivatives of the G-vectors by a named parameter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the parameter.
+        geometry : dict
+            Intermediate vectors returned by `_scattering_geometry`.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (N, 3) containing the derivatives.
+        """
+        Gmats, u, v2 = geometry['Gmats'], geometry['u'], geometry['v2']
+        Dimat = np.asarray(self.Dimat)
+        Svec = np.asarray(self.Svec).ravel()
+        dv3 = dv4 = dGmats = None
+        if name == 'distance':
+            dv3 = np.array((1.0, 0.0, 0.0))
+        elif name in ['xc', 'yc']:
+            axis = 0 if name == 'xc' else 1
+            dv3 = -self.pixel_size * Dimat @ np.asarray(self.Oimat)[:, axis]
+        elif name == 'pixel_size':
+            dv3 = v2 @ Dimat.T / self.pixel_size
+        elif name in ['yaw', 'pitch', 'roll']:
+            dDimat = self._rotation_derivative(self.detector_rotations, name)
+            dv3 = v2 @ dDimat.T
+        elif name in ['xs', 'ys', 'zs']:
+            dv3 = -Gmats[:, :, ['xs', 'ys', 'zs'].index(name)]
+        elif name == 'wavelength':
+            dv4 = -(u - np.array((1.0, 0.0, 0.0))) / self.wavelength**2
+        elif name in ['phi', 'phi_step']:
+            dGmats = np.asarray(self.Gmat(0.0)) @ drotmats(3, geometry['phi'])
+            if name == 'phi_step':
+                dGmats = dGmats * geometry['z'][:, np.newaxis, np.newaxis]
+        elif name in ['chi', 'omega', 'theta']:
+            dGmats = (self._rotation_derivative(self.goniometer_rotations,
+                                                name) @ geometry['Rmats'])
+        if dGmats is not None:
+            dv3 = -dGmats @ Svec
+        if dv3 is not None:
+            dv3 = np.broadcast_to(dv3, u.shape)
+            dv4 = ((dv3 - u * np.sum(u * dv3, axis=1, keepdims=True))
+                   / (geometry['length'] * self.wavelength))
+        dG = np.einsum('nji,nj->ni', Gmats, dv4)
+        if dGmats is not None:
+            dG += np.einsum('nji,nj->ni', dGmats, geometry['v4'])
+        return dG
 
     def refine_angles(self, method='nelder', **opts):
         """Refine parameters based on the calculated polar angles.
@@ -1989,11 +2582,16 @@ class NXRefine:
         Parameters
         ----------
         method : str, optional
-            LMFIT minimizer method, by default 'nelder'
+            LMFIT minimizer method, by default 'nelder'. The analytic
+            Jacobian is only used by the least-squares methods, e.g.,
+            'leastsq', which must be requested explicitly.
         """
         from lmfit import fit_report, minimize
         p0 = self.define_parameters(**opts)
-        self.result = minimize(self.angle_residuals, p0, method=method)
+        self.result = minimize(
+            self.angle_residuals, p0, method=method,
+            **self._jacobian_options(self.angle_jacobian, p0, method,
+                                     self.jacobian_names))
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_parameters(self.result.params)
@@ -2013,7 +2611,62 @@ class NXRefine:
             angles.
         """
         self.get_parameters(parameters)
-        return self.angle_diffs()
+        return self._angle_differences()
+
+    def angle_jacobian(self, parameters):
+        """Return the derivatives of the polar angle residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (N, M) containing the derivatives of
+            `angle_residuals` with respect to the M varying parameters.
+        """
+        self.get_parameters(parameters)
+        idx = self.idx
+        x, y, z = self.xp[idx], self.yp[idx], self.zp[idx]
+        Oimat = np.asarray(self.Oimat)
+        Mat = self.pixel_size * np.asarray(self.Dimat) @ Oimat
+        peaks = (np.stack((x - self.xc, y - self.yc, np.zeros_like(x)),
+                          axis=-1) @ Oimat.T)
+        m = peaks @ Mat.T
+        p = norm(m, axis=1)
+        scale = degrees / (self.distance**2 + p**2)
+        Bmat = np.asarray(self.Bmat)
+        hkls = np.rint(self.calculate_hkls(x, y, z))
+        w = hkls @ Bmat
+        s = norm(w, axis=1)
+        cosine = np.sqrt(1.0 - (self.wavelength * s / 2)**2)
+        columns = []
+        for name in self._varying(parameters):
+            dm = None
+            column = np.zeros_like(p)
+            if name == 'distance':
+                column = -p * scale
+            elif name in ['xc', 'yc']:
+                dm = -Mat @ Oimat[:, 0 if name == 'xc' else 1]
+            elif name == 'pixel_size':
+                column = self.distance * p * scale / self.pixel_size
+            elif name in ['yaw', 'pitch', 'roll']:
+                dMat = (self.pixel_size * self._rotation_derivative(
+                    self.detector_rotations, name) @ Oimat)
+                dm = peaks @ dMat.T
+            elif name == 'wavelength':
+                column = -degrees * s / cosine
+            elif name in self.lattice_names:
+                dBmat = -Bmat @ self._Bimat_derivative(name) @ Bmat
+                ds = np.sum(w * (hkls @ dBmat), axis=1) / s
+                column = -degrees * self.wavelength * ds / cosine
+            if dm is not None:
+                column = (self.distance * scale *
+                          np.sum(m * dm, axis=1) / p)
+            columns.append(column)
+        return np.stack(columns, axis=-1)
 
     def define_orientation_matrix(self):
         """Return the elements of the orientation matrix as LMFIT parameters.
@@ -2050,21 +2703,185 @@ class NXRefine:
             for j in range(3):
                 self.Umat[i, j] = p['U%d%d' % (i, j)].value
 
-    def refine_orientation_matrix(self, method='leastsq'):
+    def refine_orientation_matrix(self, method='leastsq', npeaks=None):
         """Refine the orientatoin matrix based on the calculated HKL values.
 
         Parameters
         ----------
         method : str, optional
             LMFIT minimizer method, by default 'leastsq'
+        npeaks : int, optional
+            Maximum number of peaks used in an initial refinement, as in
+            `refine_hkls`. By default, all the peaks are used.
         """
-        from lmfit import fit_report, minimize
+        from lmfit import fit_report
         p0 = self.define_orientation_matrix()
-        self.result = minimize(self.orient_residuals, p0, method=method)
+        self.result = self._staged_minimize(
+            self.orient_residuals, p0, method, npeaks,
+            **self._jacobian_options(self.orient_jacobian, p0, method))
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_orientation_matrix(self.result.params)
 
+    def get_state(self, peaks=True):
+        """Return the attributes used in refinements as a dictionary.
+
+        The state can be pickled, so it is used to pass the refinement
+        parameters to other processes.
+
+        Parameters
+        ----------
+        peaks : bool, optional
+            True if the peak positions and intensities are included, by
+            default True.
+
+        Returns
+        -------
+        dict
+            Values of the attributes in `state_names` and, optionally,
+            `peak_names`.
+        """
+        names = self.state_names + (self.peak_names if peaks else [])
+        state = {name: getattr(self, name) for name in names}
+        if state['Umat'] is not None:
+            state['Umat'] = np.matrix(state['Umat'], dtype=float)
+        return state
+
+    def set_state(self, state):
+        """Set the attributes used in refinements from a dictionary.
+
+        Parameters
+        ----------
+        state : dict
+            Attribute values returned by `get_state`.
+        """
+        for name in state:
+            setattr(self, name, state[name])
+
+    def perturbed_state(self, rng, names=(), scale=0.005, rotation=1.0):
+        """Return the refinement state with random changes to its values.
+
+        Parameters
+        ----------
+        rng : np.random.Generator
+            Random number generator.
+        names : list of str, optional
+            Parameters to be perturbed by normally distributed fractions
+            of their values, with a minimum absolute standard deviation
+            equal to `scale`.
+        scale : float, optional
+            Relative standard deviation of the parameter changes, by
+            default 0.005.
+        rotation : float, optional
+            Standard deviation in degrees of random rotations of the
+            orientation matrix about each axis, by default 1.0.
+
+        Returns
+        -------
+        dict
+            The perturbed state, excluding the peaks.
+        """
+        state = self.get_state(peaks=False)
+        for name in names:
+            value = state[name]
+            state[name] = value + rng.normal(0.0, scale * max(abs(value), 1))
+        if state['Umat'] is not None and rotation:
+            angles = rng.normal(0.0, rotation, 3)
+            state['Umat'] = (rotmat(1, angles[0]) * rotmat(2, angles[1]) *
+                             rotmat(3, angles[2]) * state['Umat'])
+        return state
+
+    def refine_multistart(self, trials=8, scale=0.005, rotation=1.0,
+                          orientation=True, method='leastsq',
+                          max_workers=None, seed=None, tolerance=0.1,
+                          min_fraction=0.5, **opts):
+        """Repeat refinements from perturbed starting values in parallel.
+
+        The first trial starts from the current values. In the others,
+        the varying parameters are perturbed as in `perturbed_state`.
+        Each trial runs `refine_hkls` with the keyword arguments, if any,
+        followed by `refine_orientation_matrix`. The trials run in
+        separate processes.
+
+        A trial is rejected if any of its fits fails, if its parameters
+        are not finite or have moved further from the current values
+        than `tolerance` allows, or if it indexes fewer than
+        `min_fraction` of the peaks that are currently indexed. Of the
+        others, the solution with the lowest `hkl_score` is kept. This
+        is in reciprocal lattice units, so a solution cannot win by
+        inflating the unit cell.
+
+        Parameters
+        ----------
+        trials : int, optional
+            Number of refinements, by default 8.
+        scale : float, optional
+            Relative standard deviation of the parameter perturbations, by
+            default 0.005.
+        rotation : float, optional
+            Standard deviation in degrees of the orientation perturbations,
+            by default 1.0.
+        orientation : bool, optional
+            True if the orientation matrix is refined, by default True.
+        method : str, optional
+            LMFIT minimizer method, by default 'leastsq'.
+        max_workers : int, optional
+            Maximum number of processes, by default the number of trials
+            or CPUs, whichever is smaller. If 1, the trials run in this
+            process.
+        seed : int, optional
+            Seed of the random number generator.
+        tolerance : float, optional
+            Maximum change of each refined parameter as a fraction of its
+            current value, or of 1 if the value is smaller, by default
+            0.1.
+        min_fraction : float, optional
+            Minimum fraction of the currently indexed peaks that must
+            still be indexed after a trial, by default 0.5.
+
+        Returns
+        -------
+        list of float
+            The `hkl_score` of each trial, with infinite values for any
+            that were rejected.
+        """
+        from .nxutils import NXExecutor, as_completed, refine_trial
+        if self.Umat is None:
+            raise NeXusError('No orientation matrix defined')
+        if opts:
+            names = self._varying(self.define_parameters(**opts))
+        else:
+            names = []
+        rng = np.random.default_rng(seed)
+        starts = [self.get_state(peaks=False)]
+        starts += [self.perturbed_state(rng, names, scale, rotation)
+                   for _ in range(trials - 1)]
+        peaks = {name: getattr(self, name) for name in self.peak_names}
+        bounds = {}
+        for name in self.jacobian_names:
+            value = getattr(self, name)
+            delta = tolerance * max(abs(value), 1.0)
+            bounds[name] = (value - delta, value + delta)
+        min_indexed = min_fraction * self.count_indexed()
+        args = (peaks, opts, orientation, method, bounds, min_indexed)
+        if max_workers is None:
+            max_workers = min(trials, os.cpu_count() or 1)
+        if max_workers == 1:
+            results = [refine_trial(start, *args) for start in starts]
+        else:
+            results = [None] * trials
+            with NXExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(refine_trial, start, *args): i
+                           for i, start in enumerate(starts)}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+        scores = [result[0] for result in results]
+        best = int(np.argmin(scores))
+        if np.isfinite(scores[best]):
+            self.set_state(results[best][1])
+            self.fit_report = results[best][2]
+        return scores
+
     def restore_orientation_matrix(self):
         """Restore the orientation matrix to the values before refinement."""
         self.Umat = self.init_p
@@ -2080,10 +2897,33 @@ class NXRefine:
         Returns
         -------
         array_like
-            An array of differences between calculated and nominal HKL values.
+            The components of the differences between the calculated and
+            nominal HKL vectors in reciprocal Å.
+        """
+        self.get_orientation_matrix(p)
+        return self._hkl_residuals().ravel()
+
+    def orient_jacobian(self, p):
+        """Return the derivatives of the orientation matrix residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (3N, 9) containing the derivatives of
+            `orient_residuals` with respect to the orientation matrix
+            elements.
         """
         self.get_orientation_matrix(p)
-        return self.diffs()
+        Uimat = inv(np.asarray(self.Umat, dtype=float))
+        Gvecs = self.get_Gvecs() @ Uimat.T
+        columns = [-np.outer(Gvecs[:, j], Uimat[:, i])
+                   for i in range(3) for j in range(3)]
+        return np.stack(columns, axis=-1).reshape(-1, 9)
 
     def get_polarization(self, beam_polarization=0.99):
         """Return the synchrotron x-ray polarization across the detector.
@@ -12,7 +12,8 @@ from pathlib import Path
 import numpy as np
 from nexusformat.nexus import nxopen, nxsetconfig
 
-from .nxutils import NXExecutor, as_completed
+from .nxutils import (NXExecutor, add_stored_chunks, as_completed,
+                      read_stored_chunks)
 
 
 def triclinic(data):
@@ -84,7 +85,8 @@ def cubic2(data):
     outarr += np.flip(outarr, 2)
     return outarr
 
-def symmetrize_entries(symm_function, data_type, data_file, data_path):
+def symmetrize_entries(symm_function, data_type, data_file, data_path,
+                       dtype=None):
     nxsetconfig(lock=3600, lockexpiry=28800)
     with nxopen(data_file, 'r') as data_root:
         data_path = Path(data_path).name
@@ -94,33 +96,39 @@ def symmetrize_entries(symm_function, data_type, data_file, data_path):
             nxsetconfig(memory=data_size)
             if i == 0:
                 if data_type == 'signal':
-                    data = data_root[entry][data_path].nxsignal.nxvalue
+                    data = read_stored_chunks(
+                        data_root[entry][data_path].nxsignal, dtype=dtype)
                 elif data_root[entry][data_path].nxweights:
-                    data = data_root[entry][data_path].nxweights.nxvalue
+                    data = read_stored_chunks(
+                        data_root[entry][data_path].nxweights, dtype=dtype)
                 else:
-                    signal = data_root[entry][data_path].nxsignal.nxvalue
+                    signal = read_stored_chunks(
+                        data_root[entry][data_path].nxsignal, dtype=dtype)
                     data = np.zeros(signal.shape, dtype=signal.dtype)
                     data[np.where(signal > 0)] = 1
             else:
                 if data_type == 'signal':
-                    data += data_root[entry][data_path].nxsignal.nxvalue
+                    add_stored_chunks(data_root[entry][data_path].nxsignal,
+                                      data)
                 elif data_root[entry][data_path].nxweights:
-                    data += data_root[entry][data_path].nxweights.nxvalue
+                    add_stored_chunks(data_root[entry][data_path].nxweights,
+                                      data)
     result = symm_function(data)
     with nxopen(tempfile.mkstemp(suffix='.nxs')[1], mode='w') as root:
         root['data'] = result
     return data_type, root.nxfilename
 
 
-def symmetrize_data(symm_function, data_type, data_file, data_path):
+def symmetrize_data(symm_function, data_type, data_file, data_path,
+                    dtype=None):
     nxsetconfig(lock=3600, lockexpiry=28800)
     with nxopen(data_file, 'r') as data_root:
         data_size = int(data_root[data_path].nbytes / 1e6) + 1000
         nxsetconfig(memory=data_size)
         if data_type == 'signal':
-            data = data_root[data_path].nxvalue
+            data = read_stored_chunks(data_root[data_path], dtype=dtype)
         else:
-            signal = data_root[data_path].nxvalue
+            signal = read_stored_chunks(data_root[data_path], dtype=dtype)
             data = np.zeros(signal.shape, signal.dtype)
             data[np.where(signal > 0)] = 1
     result = symm_function(data)
@@ -152,7 +160,24 @@ class NXSymmetry:
         self.data_file = data.nxfilename
         self.data_path = data.nxpath
 
-    def symmetrize(self, entries=False):
+    def symmetrize(self, entries=False, dtype=None):
+        """Return the symmetrized data divided by the symmetrized weights.
+
+        Parameters
+        ----------
+        entries : bool, optional
+            True if the data in all the numbered entries are summed
+            before symmetrization, by default False.
+        dtype : dtype, optional
+            Floating point type of the result. The data and weights are
+            read, summed, and divided in this type, so single precision
+            halves the peak memory. By default, the stored type is used.
+
+        Returns
+        -------
+        ndarray
+            Symmetrized data, which are zero where the weights are zero.
+        """
         if entries:
             symmetrize = symmetrize_entries
         else:
@@ -162,7 +187,7 @@ class NXSymmetry:
             for data_type in ['signal', 'weights']:
                 futures.append(executor.submit(
                     symmetrize, self.symm_function, data_type,
-                    self.data_file, self.data_path))
+                    self.data_file, self.data_path, dtype))
         for future in as_completed(futures):
             data_type, result_file = future.result()
             with nxopen(result_file, 'r') as result_root:
@@ -171,6 +196,14 @@ class NXSymmetry:
                 else:
                     weights = result_root['data'].nxvalue
             Path(result_file).unlink()
+        if dtype is None:
+            dtype = np.result_type(signal, weights, 1.0)
+        result = signal.astype(dtype, copy=False)
+        del signal
+        valid = weights > 0
         with np.errstate(divide='ignore', invalid='ignore'):
-            result = np.where(weights > 0, signal / weights, 0.0)
+            np.divide(result, weights, out=result, where=valid,
+                      casting='unsafe')
+        np.logical_not(valid, out=valid)
+        result[valid] = 0.0
         return result
@@ -22,6 +22,10 @@ from nexusformat.nexus import (NeXusError, NXdata, NXentry, NXfield, NXlog,
                                NXroot, nxopen, nxsetconfig)
 from skimage.feature import peak_local_max
 
+# Julia resources included in this process, and the names they define
+_julia_resources = set()
+_julia_names = {'LaplaceInterpolation.jl': 'LaplaceInterpolation'}
+
 
 def peak_search(data_file, data_path, i, j, k, threshold, mask=None,
                 min_pixels=10):
@@ -373,6 +377,108 @@ def find_maximum_chunk(data_file, data_path, i, j, k,
     return i, local_vsum, local_fsum, local_psum, local_maximum
 
 
+def stored_chunks(field):
+    """Return the slices of the chunks of a field stored in its file.
+
+    HDF5 does not allocate chunks that have never been written, which
+    are read as the fill value. If the field is not chunked or is not
+    saved in a file, None is returned, and all its values should be
+    treated as stored.
+
+    Parameters
+    ----------
+    field : NXfield
+        Field to be inspected, which may be linked to another file.
+
+    Returns
+    -------
+    list of tuples of slices or None
+        Slices of each stored chunk.
+    """
+    if field.nxfile is None or not field.chunks:
+        return None
+    chunks, shape = field.chunks, field.shape
+    with field.nxfile as f:
+        dsid = f[field.nxfilepath].id
+        offsets = [dsid.get_chunk_info(i).chunk_offset
+                   for i in range(dsid.get_num_chunks())]
+    return [tuple(slice(o, min(o+c, n))
+                  for o, c, n in zip(offset, chunks, shape))
+            for offset in offsets]
+
+
+def add_stored_chunks(field, out, dtype=None):
+    """Add the stored chunks of a field to an array.
+
+    Chunks that are not stored in the file are skipped, so the cost
+    scales with the number of chunks containing data. If most of the
+    chunks are stored, the field is read as a single array.
+
+    Parameters
+    ----------
+    field : NXfield
+        Field to be read, which should have a fill value of zero.
+    out : ndarray
+        Array with the same shape as the field, to which the stored
+        values are added.
+    dtype : dtype, optional
+        Type to which the values are converted, by default the type of
+        the output array.
+    """
+    slices = stored_chunks(field)
+    if dtype is None:
+        dtype = out.dtype
+    if slices is None or len(slices) > 0.5 * np.prod(
+            [-(-n // c) for n, c in zip(field.shape, field.chunks)]):
+        out += np.asarray(field.nxvalue, dtype=dtype)
+        return
+    with field.nxfile as f:
+        dataset = f[field.nxfilepath]
+        for index in slices:
+            out[index] += dataset[index].astype(dtype)
+
+
+def read_stored_chunks(field, dtype=None):
+    """Return the values of a field, only reading the stored chunks."""
+    if dtype is None:
+        dtype = field.dtype
+    out = np.zeros(field.shape, dtype=dtype)
+    add_stored_chunks(field, out)
+    return out
+
+
+def write_nonzero_chunks(field, data, offset=0):
+    """Write an array to a field, skipping chunks that are all zero.
+
+    The skipped chunks are left unallocated in the file, so that they
+    take no space and are skipped by `add_stored_chunks`. The field
+    should have a fill value of zero.
+
+    Parameters
+    ----------
+    field : NXfield
+        Chunked field saved in a file opened for writing.
+    data : ndarray
+        Values to be written, with the same shape as the field apart
+        from the first dimension.
+    offset : int, optional
+        Index along the first axis of the field at which the data are
+        written, which should be a multiple of the chunk size, by
+        default 0.
+    """
+    chunks = field.chunks
+    with field.nxfile as f:
+        dataset = f[field.nxfilepath]
+        for start in np.ndindex(*[-(-n // c)
+                                  for n, c in zip(data.shape, chunks)]):
+            index = tuple(slice(i*c, (i+1)*c) for i, c in zip(start, chunks))
+            block = data[index]
+            if np.any(block):
+                target = (slice(index[0].start + offset,
+                                index[0].start + offset + len(block)),)
+                dataset[target + index[1:]] = block
+
+
 def prime_julia_environment():
     """Set env vars so juliapkg uses a shared, in-env Julia depot.
 
@@ -385,8 +491,10 @@ def prime_julia_environment():
     juliapkg's ``~/.julia`` default applies.
 
     Also sets ``JULIA_SSL_CA_ROOTS_PATH`` to certifi's CA bundle as a
-    macOS ``Downloads.jl`` HTTPS workaround. Existing values of any of
-    these three variables are respected.
+    macOS ``Downloads.jl`` HTTPS workaround, and points
+    ``PYTHON_JULIACALL_SYSIMAGE`` at the system image built by
+    ``nxinstall --sysimage`` if it exists. Existing values of any of
+    these variables are respected.
     """
     import os
     import sys
@@ -404,6 +512,23 @@ def prime_julia_environment():
         depot = os.path.join(prefix, 'julia_depot')
         os.environ.setdefault('JULIA_DEPOT_PATH', depot)
         os.environ.setdefault('JULIAUP_DEPOT_PATH', depot)
+    sysimage = julia_sysimage()
+    if os.path.exists(sysimage):
+        os.environ.setdefault('PYTHON_JULIACALL_SYSIMAGE', sysimage)
+
+
+def julia_sysimage():
+    """Return the path of the NXRefine Julia system image.
+
+    The system image is stored in the ``sysimages`` directory of the
+    first Julia depot, so it is shared by all users of the depot set by
+    ``prime_julia_environment``.
+    """
+    depot = os.environ.get('JULIA_DEPOT_PATH', '').split(os.pathsep)[0]
+    if not depot:
+        depot = os.path.join(os.path.expanduser('~'), '.julia')
+    extension = {'win32': 'dll', 'darwin': 'dylib'}.get(sys.platform, 'so')
+    return os.path.join(depot, 'sysimages', f'nxrefine.{extension}')
 
 
 def init_julia():
@@ -438,10 +563,244 @@ def init_julia():
 
 
 def load_julia(resources):
-    """Load .jl resources shipped in ``nxrefine.julia`` into Main."""
+    """Load .jl resources shipped in ``nxrefine.julia`` into Main.
+
+    Each resource is only included once per process. Resources whose
+    functions are already defined in Main, e.g., by the system image
+    built by ``nxinstall --sysimage``, are not included at all.
+    """
     from juliacall import Main
     for resource in resources:
-        Main.include(str(package_files('nxrefine.julia') / resource))
+        if resource in _julia_resources:
+            continue
+        name = _julia_names.get(resource)
+        if name is None or not Main.seval(f"isdefined(Main, :{name})"):
+            Main.include(str(package_files('nxrefine.julia') / resource))
+        _julia_resources.add(resource)
+
+
+def punch_fill_batch(data_file, data_path, i, reflections, corners,
+                     mask_indices, shape, interpolation='julia'):
+    """Interpolate the data within the punched holes of a batch of peaks.
+
+    The batch is read from the file as a single slab bounding all the
+    cubes surrounding the reflections, which should be selected to lie
+    within neighboring chunks of the data. The holes are then filled
+    by calls to `LaplaceInterpolation.matern_3d_grid`, starting Julia
+    if it is not already running in this process, or by its SciPy
+    equivalent in `nxrefine.nxpdf`.
+
+    Parameters
+    ----------
+    data_file : str or ndarray
+        File path to the symmetrized data, or the data themselves if
+        called in the same process.
+    data_path : str
+        Internal path to the symmetrized data. If None, `data_file` is
+        a NumPy '.npy' file, which is memory-mapped.
+    i : int
+        Index of the batch, returned for progress monitoring.
+    reflections : list of tuples
+        (H, K, L) values of the reflections, used in error messages.
+    corners : ndarray
+        Array of shape (n, 3) containing the (l, k, h) indices of the
+        first voxel of each cube.
+    mask_indices : ndarray
+        Array of shape (m, 3) containing the indices of the punched
+        voxels within each cube.
+    shape : tuple of ints
+        Shape of each cube.
+    interpolation : {'julia', 'scipy'}, optional
+        Backend used to interpolate the holes, by default 'julia'.
+
+    Returns
+    -------
+    tuple of (i, filled, values, failures)
+        `filled` is a list of the positions within the batch of the
+        successfully filled reflections, and `values` the (n, m) array
+        of interpolated values at the punched voxels. `failures` is a
+        list of (outcome, (H, K, L), message) tuples.
+    """
+    if interpolation == 'scipy':
+        from .nxpdf import matern_3d_grid
+
+        def interpolate(v):
+            return matern_3d_grid(v, mask_indices)
+    else:
+        Main = init_julia()
+        load_julia(['LaplaceInterpolation.jl'])
+        idx = [Main.CartesianIndex(int(m[0]+1), int(m[1]+1), int(m[2]+1))
+               for m in mask_indices]
+
+        def interpolate(v):
+            return Main.LaplaceInterpolation.matern_3d_grid(v, idx)
+    start = corners.min(axis=0)
+    stop = corners.max(axis=0) + shape
+    index = tuple(slice(a, b) for a, b in zip(start, stop))
+    if isinstance(data_file, np.ndarray):
+        slab = data_file[index]
+    elif data_path is None:
+        slab = np.array(np.load(data_file, mmap_mode='r')[index])
+    else:
+        nxsetconfig(lock=3600, lockexpiry=28800)
+        with nxopen(data_file, 'r') as data_root:
+            slab = data_root[data_path][index].nxvalue
+    punched = tuple(mask_indices.T)
+    filled, values, failures = [], [], []
+    for j, (hkl, corner) in enumerate(zip(reflections, corners)):
+        v = slab[tuple(slice(a, a+n) for a, n in zip(corner-start, shape))]
+        if not np.any(v > 0.0):
+            failures.append(('no_signal', hkl,
+                             f"max={float(np.nanmax(v)):.3g}"))
+            continue
+        try:
+            w = interpolate(v)
+        except Exception as error:
+            failures.append(('matern_failed', hkl, str(error)))
+            continue
+        filled.append(j)
+        values.append(np.asarray(w)[punched])
+    values = np.array(values).reshape(len(filled), len(mask_indices))
+    return i, filled, values, failures
+
+
+def pdf_series_scan(directory, options, shared, mask=False):
+    """Calculate the PDF of one scan in a series in a worker process.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Scan directory.
+    options : dict
+        Keyword arguments used to initialize `NXMultiReduce`.
+    shared : dict
+        PDF grid, hole mask, and reflection indices shared by the
+        series, or None if they are calculated for each scan. The taper
+        function is recalculated, using the cache in `spherical_taper`.
+    mask : bool, optional
+        True if the masked transform is used, by default False.
+
+    Returns
+    -------
+    str or Path
+        The scan directory.
+    """
+    from .nxreduce import NXMultiReduce
+    reduce = NXMultiReduce(directory=directory, **options)
+    reduce.shared = shared
+    reduce._concurrent = False
+    reduce.nxpdf(mask=mask)
+    return directory
+
+
+def refine_series_scans(directories, seeds, options):
+    """Refine consecutive scans in a series in a worker process.
+
+    Each entry is seeded with the solution of the same entry in the
+    preceding scan (see `NXReduce.refine_from_seed`).
+
+    Parameters
+    ----------
+    directories : list of str or Path
+        Scan directories in the order of the series.
+    seeds : dict
+        Refined states of the entries in the scan preceding the first
+        directory, keyed by entry name.
+    options : dict
+        Keyword arguments used to initialize `NXReduce`.
+
+    Returns
+    -------
+    list of dict
+        Convergence statistics of each entry.
+    """
+    from .nxreduce import NXReduce
+    seeds = dict(seeds)
+    stats = []
+    for directory in directories:
+        for entry in NXReduce(directory=directory).entries:
+            reduce = NXReduce(entry, directory=directory, refine=True,
+                              **options)
+            entry_stats = reduce.refine_from_seed(seeds.get(entry))
+            if 'state' in entry_stats:
+                seeds[entry] = entry_stats.pop('state')
+            stats.append(entry_stats)
+    return stats
+
+
+def refine_trial(state, peaks, opts, orientation=True, method='leastsq',
+                 bounds=None, min_indexed=0):
+    """Refine the crystal parameters from one set of starting values.
+
+    Parameters
+    ----------
+    state : dict
+        Starting values of the refinement parameters, as returned by
+        `NXRefine.get_state`.
+    peaks : dict
+        Peak positions and intensities, as returned by
+        `NXRefine.get_state`.
+    opts : dict
+        Keyword arguments passed to `NXRefine.refine_hkls`. If empty,
+        only the orientation matrix is refined.
+    orientation : bool, optional
+        True if the orientation matrix is refined, by default True.
+    method : str, optional
+        LMFIT minimizer method, by default 'leastsq'.
+    bounds : dict, optional
+        Lower and upper limits of the refined parameters, keyed by the
+        parameter names. The trial is rejected if any of them is
+        outside its limits or is not finite.
+    min_indexed : float, optional
+        Minimum number of peaks that must be indexed by the refined
+        parameters, by default 0.
+
+    Returns
+    -------
+    score : float
+        The `NXRefine.hkl_score` of the refined parameters, or infinity
+        if the refinement failed or was rejected.
+    state : dict
+        Refined parameters.
+    fit_report : str
+        LMFIT fit reports, followed by the reason for rejecting the
+        trial, if any, or the error message if the refinement failed.
+    """
+    from .nxrefine import NXRefine
+    refine = NXRefine()
+    refine.set_state(peaks)
+    refine.set_state(state)
+    reports = []
+
+    def reject(reason):
+        return np.inf, state, '\n'.join(reports + [reason])
+
+    try:
+        if opts:
+            refine.refine_hkls(method=method, **opts)
+            reports.append(refine.fit_report)
+            if not refine.result.success:
+                return reject('Lattice refinement failed')
+        if orientation:
+            refine.refine_orientation_matrix(method=method)
+            reports.append(refine.fit_report)
+            if not refine.result.success:
+                return reject('Orientation refinement failed')
+        refined = refine.get_state(peaks=False)
+        for name, (low, high) in (bounds or {}).items():
+            if not low <= refined[name] <= high:
+                return reject(f"'{name}' out of range: {refined[name]}")
+        if not np.all(np.isfinite(refined['Umat'])):
+            return reject('Orientation matrix is not finite')
+        indexed = refine.count_indexed()
+        if indexed < min_indexed:
+            return reject(f'Only {indexed} peaks indexed')
+        score = refine.hkl_score()
+    except Exception as error:
+        return np.inf, state, str(error)
+    if not np.isfinite(score):
+        return reject('Score is not finite')
+    return score, refined, '\n'.join(reports)
 
 
 def parse_orientation(orientation):
@@ -0,0 +1,538 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2026, Argonne National Laboratory.
+#
+# Distributed under the terms of an Open Source License.
+#
+# The full license is in the file LICENSE.pdf, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import ast
+import operator
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+import psutil
+from nexusformat.nexus import (NeXusError, NXcollection, NXdata, NXentry,
+                               NXfield, nxopen, nxsetconfig)
+
+from .nxutils import NXExecutor, write_nonzero_chunks
+
+functions = {name: getattr(np, name)
+             for name in ['abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos',
+                          'minimum', 'maximum', 'where', 'clip',
+                          'nan_to_num']}
+
+
+def parse_expression(expression, labels):
+    """Return an expression with the volume labels made explicit.
+
+    Parenthesized terms followed by a volume label, such as
+    '(signal/weights)_T1', are rewritten so that the 'signal' and
+    'weights' within the parentheses refer to that volume, *i.e.*,
+    '(signal_T1/weights_T1)'.
+
+    Parameters
+    ----------
+    expression : str
+        Arithmetic expression.
+    labels : list of str
+        Labels of the volumes used in the expression.
+
+    Returns
+    -------
+    str
+        The rewritten expression.
+    """
+    pattern = re.compile(r'\(([^()]*)\)_(' + '|'.join(
+        re.escape(label) for label in labels) + r')\b')
+
+    def substitute(match):
+        term, label = match.groups()
+        term = re.sub(r'\b(signal|weights)\b', rf'\1_{label}', term)
+        return f'({term})'
+
+    return pattern.sub(substitute, expression)
+
+
+operators = {ast.Add: operator.add, ast.Sub: operator.sub,
+             ast.Mult: operator.mul, ast.Div: operator.truediv,
+             ast.Pow: operator.pow, ast.BitAnd: operator.and_,
+             ast.BitOr: operator.or_, ast.USub: operator.neg,
+             ast.UAdd: operator.pos, ast.Invert: operator.invert,
+             ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+             ast.GtE: operator.ge, ast.Eq: operator.eq,
+             ast.NotEq: operator.ne}
+
+
+def check_expression(expression, names):
+    """Return the syntax tree of an expression after validating it.
+
+    Only numeric constants, the given variable names, the arithmetic,
+    comparison, and bitwise operators in `operators`, and calls to the
+    functions in `functions` are allowed, so the expression cannot
+    access any other Python objects. Constants are evaluated as floats,
+    so integer powers cannot create arbitrarily large numbers.
+
+    Parameters
+    ----------
+    expression : str
+        Arithmetic expression.
+    names : iterable of str
+        Names of the variables that may be used.
+
+    Returns
+    -------
+    ast.Expression
+        The validated syntax tree, to be evaluated by
+        `evaluate_expression`.
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as error:
+        raise NeXusError(f"Invalid expression: {error}")
+    names = set(names)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Expression, ast.Load, ast.keyword,
+                             ast.operator, ast.unaryop, ast.cmpop)):
+            continue
+        elif isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            if type(node.op) not in operators:
+                raise NeXusError(
+                    f"Operator '{type(node.op).__name__}' not allowed")
+        elif isinstance(node, ast.Compare):
+            for op in node.ops:
+                if type(op) not in operators:
+                    raise NeXusError(
+                        f"Operator '{type(op).__name__}' not allowed")
+        elif isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name)
+                    and node.func.id in functions):
+                raise NeXusError("Only calls to "
+                                 f"{', '.join(functions)} are allowed")
+            if any(keyword.arg is None for keyword in node.keywords):
+                raise NeXusError("Keyword unpacking not allowed")
+        elif isinstance(node, ast.Name):
+            if node.id not in names and node.id not in functions:
+                raise NeXusError(f"Unknown name '{node.id}'")
+        elif isinstance(node, ast.Constant):
+            if (not isinstance(node.value, (int, float))
+                    or isinstance(node.value, bool)):
+                raise NeXusError(f"Invalid constant {node.value!r}")
+        else:
+            raise NeXusError(
+                f"'{type(node).__name__}' not allowed in expressions")
+    return tree
+
+
+def evaluate_expression(tree, namespace):
+    """Evaluate a syntax tree returned by `check_expression`.
+
+    Parameters
+    ----------
+    tree : ast.AST
+        Validated syntax tree.
+    namespace : dict
+        Values of the variables used in the expression.
+
+    Returns
+    -------
+    array-like
+        The value of the expression.
+    """
+    if isinstance(tree, ast.Expression):
+        return evaluate_expression(tree.body, namespace)
+    elif isinstance(tree, ast.BinOp):
+        return operators[type(tree.op)](
+            evaluate_expression(tree.left, namespace),
+            evaluate_expression(tree.right, namespace))
+    elif isinstance(tree, ast.UnaryOp):
+        return operators[type(tree.op)](
+            evaluate_expression(tree.operand, namespace))
+    elif isinstance(tree, ast.Compare):
+        left = evaluate_expression(tree.left, namespace)
+        result = None
+        for op, comparator in zip(tree.ops, tree.comparators):
+            right = evaluate_expression(comparator, namespace)
+            value = operators[type(op)](left, right)
+            result = value if result is None else result & value
+            left = right
+        return result
+    elif isinstance(tree, ast.Call):
+        return functions[tree.func.id](
+            *[evaluate_expression(arg, namespace) for arg in tree.args],
+            **{keyword.arg: evaluate_expression(keyword.value, namespace)
+               for keyword in tree.keywords})
+    elif isinstance(tree, ast.Name):
+        return namespace[tree.id]
+    elif isinstance(tree, ast.Constant):
+        return float(tree.value)
+    else:
+        raise NeXusError(
+            f"'{type(tree).__name__}' not allowed in expressions")
+
+
+def volume_names(labels):
+    """Return the variable names defined for volumes with these labels."""
+    return [name for label in labels
+            for name in (label, f'signal_{label}', f'weights_{label}')]
+
+
+def evaluate_block(expression, volumes, index):
+    """Evaluate an arithmetic expression on a block of several volumes.
+
+    For each volume with label 'T', the expression may use the
+    normalized data as 'T', *i.e.*, the signal divided by the weights
+    where the weights are non-zero, and the raw arrays as 'signal_T'
+    and 'weights_T'. If a volume has no weights, they are set to 1
+    wherever the signal is positive. The result is only defined where
+    all the weights are positive and is set to zero elsewhere. Apart
+    from these variables, only numeric constants, operators, and the
+    functions in `functions` may be used (see `check_expression`).
+
+    Parameters
+    ----------
+    expression : str
+        Expression returned by `parse_expression`.
+    volumes : dict
+        Dictionary of (file name, group path) tuples, keyed by label,
+        identifying the NXdata groups of the volumes.
+    index : tuple of slices
+        Block to be evaluated.
+
+    Returns
+    -------
+    tuple of (index, result, valid)
+        `result` is the evaluated block, and `valid` is 1 where all the
+        weights are positive and 0 elsewhere.
+    """
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    tree = check_expression(expression, volume_names(volumes))
+    namespace = {}
+    valid = None
+    for label, (data_file, data_path) in volumes.items():
+        with nxopen(data_file, 'r') as root:
+            group = root[data_path]
+            signal = group.nxsignal[index].nxvalue
+            if group.nxweights is not None:
+                weights = group.nxweights[index].nxvalue
+            else:
+                weights = (signal > 0).astype(signal.dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            namespace[label] = np.where(weights > 0, signal / weights, 0.0)
+        namespace[f'signal_{label}'] = signal
+        namespace[f'weights_{label}'] = weights
+        if valid is None:
+            valid = weights > 0
+        else:
+            valid &= weights > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = evaluate_expression(tree, namespace)
+    result = np.where(valid, np.nan_to_num(result), 0.0)
+    return index, result, valid.astype(np.float32)
+
+
+class NXArithmetic:
+    """Evaluate arithmetic expressions on transforms from multiple scans.
+
+    The volumes are processed in blocks of planes along the first axis,
+    aligned to the HDF5 chunks of the first volume, so that only a few
+    blocks are in memory at any time. The blocks may be distributed
+    over a process pool. The result is written in the same layout as
+    the transforms, *i.e.*, as 'v' and 'n' fields in '/entry/data',
+    with 'n' set to 1 where all the volumes have positive weights, so
+    that it may be loaded and combined like any other transform. Chunks
+    of the result that are all zero are not written.
+
+    Parameters
+    ----------
+    expression : str
+        Expression to be evaluated, *e.g.*, 'T1 - T2' or
+        '(signal/weights)_T1 - (signal/weights)_T2'. See
+        `evaluate_block` for the variables that may be used.
+    volumes : dict
+        NXdata groups containing the transforms, keyed by the labels
+        used in the expression. They must all share the same grid.
+    memory : float, optional
+        Memory budget in MB, by default half the available memory.
+    max_workers : int, optional
+        Number of processes, by default None, in which case the blocks
+        are evaluated sequentially.
+    mp_context : str, optional
+        Multiprocessing context, by default 'spawn'.
+    """
+
+    def __init__(self, expression, volumes, memory=None, max_workers=None,
+                 mp_context='spawn'):
+        if not volumes:
+            raise NeXusError('No volumes specified')
+        for label in volumes:
+            if not label.isidentifier() or label in functions:
+                raise NeXusError(f"Invalid volume label '{label}'")
+        self.volumes = volumes
+        self.expression = parse_expression(expression, list(volumes))
+        check_expression(self.expression, volume_names(volumes))
+        if memory is None:
+            memory = psutil.virtual_memory().available / 2e6
+        self.memory = memory
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.first = next(iter(volumes.values()))
+        self.check_grids()
+
+    def __repr__(self):
+        return f"NXArithmetic('{self.expression}')"
+
+    def check_grids(self):
+        """Raise an exception if the volumes have different grids."""
+        axes = self.first.nxaxes
+        for label, group in self.volumes.items():
+            if group.nxsignal.shape != self.first.nxsignal.shape:
+                raise NeXusError(f"Volume '{label}' has a different shape")
+            for axis, other in zip(axes, group.nxaxes):
+                if not np.allclose(axis.nxvalue, other.nxvalue):
+                    raise NeXusError(
+                        f"Volume '{label}' has a different '{axis.nxname}' "
+                        "grid")
+
+    @property
+    def shape(self):
+        return self.first.nxsignal.shape
+
+    @property
+    def blocks(self):
+        """Blocks of planes along the first axis evaluated together.
+
+        The block size is a multiple of the chunk size along the first
+        axis, chosen so that the blocks being evaluated by all the
+        workers fit within the memory budget.
+        """
+        signal = self.first.nxsignal
+        step = signal.chunks[0] if signal.chunks else 1
+        plane_size = 8 * np.prod(self.shape[1:]) * (3 * len(self.volumes) + 4)
+        workers = self.max_workers or 1
+        planes = int(self.memory * 1e6 / (2 * workers * plane_size))
+        size = max(step, planes // step * step)
+        return [np.s_[i:min(i+size, self.shape[0])]
+                for i in range(0, self.shape[0], size)]
+
+    def evaluate(self, output_file):
+        """Evaluate the expression and write the result to a file.
+
+        Parameters
+        ----------
+        output_file : str or Path
+            File to contain the result in '/entry/data'.
+        """
+        volumes = {label: (group.nxfilename, group.nxpath)
+                   for label, group in self.volumes.items()}
+        signal = self.first.nxsignal
+        chunks = signal.chunks if signal.chunks else True
+        with nxopen(output_file, 'w') as root:
+            root['entry'] = NXentry()
+            axes = [NXfield(axis.nxvalue, name=axis.nxname, attrs=axis.attrs)
+                    for axis in self.first.nxaxes]
+            root['entry/data'] = NXdata(
+                NXfield(shape=self.shape, dtype=signal.dtype, name='v',
+                        chunks=chunks, fillvalue=0), axes)
+            root['entry/data/n'] = NXfield(shape=self.shape, dtype=np.float32,
+                                           chunks=chunks, fillvalue=0)
+            root['entry/data/v'].attrs['weights'] = 'n'
+            if 'angles' in self.first.attrs:
+                root['entry/data'].attrs['angles'] = self.first.attrs['angles']
+            root['entry/data/expression'] = self.expression
+            output = root['entry/data']
+
+            def write(result):
+                (index,), values, valid = result
+                write_nonzero_chunks(output['v'], values, index.start)
+                write_nonzero_chunks(output['n'], valid, index.start)
+
+            if self.max_workers:
+                with NXExecutor(max_workers=self.max_workers,
+                                mp_context=self.mp_context) as executor:
+                    pending = set()
+                    blocks = deque(self.blocks)
+                    while blocks or pending:
+                        while blocks and len(pending) < 2*self.max_workers:
+                            pending.add(executor.submit(
+                                evaluate_block, self.expression, volumes,
+                                (blocks.popleft(),)))
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write(future.result())
+            else:
+                for block in self.blocks:
+                    write(evaluate_block(self.expression, volumes, (block,)))
+
+
+def bin_volume(data, factor):
+    """Return the sums of a 3D array over cubes of factor**3 voxels.
+
+    Arrays whose dimensions are not multiples of the binning factor
+    are padded with zeros, so the last bin along each axis may contain
+    fewer voxels.
+    """
+    shape = tuple(-(-n // factor) for n in data.shape)
+    padded = np.zeros(tuple(n * factor for n in shape), dtype=data.dtype)
+    padded[tuple(slice(0, n) for n in data.shape)] = data
+    return padded.reshape(shape[0], factor, shape[1], factor,
+                          shape[2], factor).sum(axis=(1, 3, 5))
+
+
+def bin_axis(axis, factor):
+    """Return the mean values of an axis within each bin."""
+    starts = np.arange(0, len(axis), factor)
+    counts = np.diff(np.append(starts, len(axis)))
+    return np.add.reduceat(np.asarray(axis, dtype=np.float64), starts) / counts
+
+
+def write_pyramid(group, factors=(2, 4, 8), memory=None):
+    """Write binned copies of a transform alongside the full volume.
+
+    The binned levels are stored in the file containing the signal as
+    NXdata groups in '/entry/pyramid', named 'bin2', 'bin4', etc., with
+    the sums of the signal and weights over each bin and the mean axis
+    values. The weighted data of each level are therefore the means of
+    the full-resolution data over the bin. If the transform has no
+    weights, they are set to 1 wherever the signal is positive. The
+    volume is read in slabs, whose size is a multiple of the largest
+    binning factor, so all the levels are written in a single pass.
+
+    Parameters
+    ----------
+    group : NXdata
+        Group containing the transform, whose signal and weights may
+        be linked to another file.
+    factors : tuple of ints, optional
+        Binning factors, each of which must divide the largest, by
+        default (2, 4, 8).
+    memory : float, optional
+        Memory budget in MB, by default half the available memory.
+    """
+    step = max(factors)
+    if any(step % factor for factor in factors):
+        raise NeXusError('Each binning factor must divide the largest')
+    signal, weights = group.nxsignal, group.nxweights
+    shape = signal.shape
+    if memory is None:
+        memory = psutil.virtual_memory().available / 2e6
+    plane_size = 16 * np.prod(shape[1:])
+    planes = max(step, int(memory * 1e6 / (2 * plane_size)) // step * step)
+    with nxopen(signal.nxfilename, 'rw') as root:
+        signal = root[signal.nxfilepath]
+        if weights is not None and weights.nxfilename == root.nxfilename:
+            weights = root[weights.nxfilepath]
+        entry = root[signal.nxfilepath.split('/')[1]]
+        if 'pyramid' in entry:
+            del entry['pyramid']
+        entry['pyramid'] = NXcollection()
+        levels = {}
+        for factor in factors:
+            axes = [NXfield(bin_axis(axis.nxvalue, factor), name=axis.nxname,
+                            attrs=axis.attrs) for axis in group.nxaxes]
+            binned = tuple(-(-n // factor) for n in shape)
+            level = NXdata(NXfield(shape=binned, dtype=np.float32,
+                                   name=signal.nxname), axes)
+            level[f'{signal.nxname}_weights'] = NXfield(shape=binned,
+                                                        dtype=np.float32)
+            level.attrs['factor'] = factor
+            entry['pyramid'][f'bin{factor}'] = level
+            levels[factor] = entry['pyramid'][f'bin{factor}']
+        for i in range(0, shape[0], planes):
+            j = min(i+planes, shape[0])
+            data = signal[i:j].nxvalue.astype(np.float64)
+            if weights is not None:
+                w = weights[i:j].nxvalue.astype(np.float64)
+            else:
+                w = (data > 0).astype(np.float64)
+            for factor, level in levels.items():
+                index = np.s_[i//factor:-(-j // factor)]
+                level.nxsignal[index] = bin_volume(data, factor)
+                level.nxweights[index] = bin_volume(w, factor)
+
+
+class NXPyramid:
+    """Multi-resolution access to a transform and its binned levels.
+
+    Parameters
+    ----------
+    group : NXdata
+        Group containing the full-resolution transform. Binned levels
+        written by `write_pyramid` are read from the file containing
+        its signal.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.levels = {1: group}
+        root = nxopen(group.nxsignal.nxfilename)
+        entry = root[group.nxsignal.nxfilepath.split('/')[1]]
+        if 'pyramid' in entry:
+            for level in entry['pyramid'].NXdata:
+                self.levels[int(level.attrs['factor'])] = level
+
+    def __repr__(self):
+        return f"NXPyramid(levels={sorted(self.levels)})"
+
+    def level(self, limits=None, shape=None):
+        """Return the coarsest binning factor that satisfies a view.
+
+        Parameters
+        ----------
+        limits : list of tuples, optional
+            Minimum and maximum axis values of the view along each
+            axis, with None for the full range, by default None.
+        shape : tuple of ints, optional
+            Minimum number of points required along each axis within
+            the limits, by default None, in which case the coarsest
+            level is returned.
+
+        Returns
+        -------
+        int
+            Binning factor of the selected level.
+        """
+        if shape is None:
+            return max(self.levels)
+        if limits is None:
+            limits = [None] * len(shape)
+        for factor in sorted(self.levels, reverse=True):
+            axes = self.levels[factor].nxaxes
+            points = []
+            for axis, limit in zip(axes, limits):
+                values = axis.nxvalue
+                if limit is None:
+                    points.append(len(values))
+                elif limit[0] == limit[1]:
+                    points.append(1)
+                else:
+                    points.append(np.count_nonzero(
+                        (values >= limit[0]) & (values <= limit[1])))
+            if all(p >= n for p, n in zip(points, shape)):
+                return factor
+        return 1
+
+    def view(self, limits=None, shape=None):
+        """Return the weighted data of a view from the coarsest level.
+
+        See `level` for a description of the parameters. An axis whose
+        limits are equal is reduced to the nearest point.
+
+        Returns
+        -------
+        NXdata
+            Weighted data within the limits.
+        """
+        group = self.levels[self.level(limits, shape)]
+        if limits is not None:
+            index = tuple(slice(None) if limit is None
+                          else float(limit[0]) if limit[0] == limit[1]
+                          else slice(float(limit[0]), float(limit[1]))
+                          for limit in limits)
+            group = group[index]
+        if group.nxweights is not None:
+            return group.weighted_data()
+        return group
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -----------------------------------------------------------------------------
+# Copyright (c) 2026, Argonne National Laboratory.
+#
+# Distributed under the terms of an Open Source License.
+#
+# The full license is in the file LICENSE.pdf, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import argparse
+from pathlib import Path
+
+from nexusformat.nexus import NeXusError, nxopen
+
+from nxrefine.nxreduce import NXMultiReduce
+from nxrefine.nxvolume import NXArithmetic
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Evaluate arithmetic expressions on transforms")
+    parser.add_argument('-e', '--expression', required=True,
+                        help="expression, e.g., 'T1 - T2' or "
+                             "'(signal/weights)_T1 - (signal/weights)_T2'")
+    parser.add_argument('-v', '--volumes', nargs='+', required=True,
+                        help='labeled scan directories or wrapper files, '
+                             'e.g., T1=300K T2=100K')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output file')
+    parser.add_argument('-M', '--mask', action='store_true',
+                        help='use transforms with 3D mask')
+    parser.add_argument('-m', '--memory', type=float,
+                        help='memory budget in MB')
+    parser.add_argument('-c', '--cores', type=int,
+                        help='number of processes')
+
+    args = parser.parse_args()
+
+    transform_path = 'masked_transform' if args.mask else 'transform'
+    volumes = {}
+    for volume in args.volumes:
+        label, _, path = volume.partition('=')
+        path = Path(path)
+        if path.is_dir():
+            group = NXMultiReduce(directory=path).find_group(transform_path)
+        else:
+            entry = nxopen(path)['entry']
+            group = entry[transform_path] if transform_path in entry else None
+        if group is None:
+            raise NeXusError(f"No '{transform_path}' group found in '{path}'")
+        volumes[label] = group
+
+    arithmetic = NXArithmetic(args.expression, volumes, memory=args.memory,
+                              max_workers=args.cores)
+    arithmetic.evaluate(args.output)
+
+
+if __name__ == "__main__":
+    main()
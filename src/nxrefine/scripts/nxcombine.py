@@ -23,6 +23,8 @@ def main():
                         help='combine transforms')
     parser.add_argument('-M', '--mask', action='store_true',
                         help='combine transforms with 3D mask')
+    parser.add_argument('-y', '--pyramid', action='store_true',
+                        help='write 2x, 4x, and 8x binned volumes')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing transform')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -32,7 +34,7 @@ def main():
 
     reduce = NXMultiReduce(directory=args.directory, entries=args.entries,
                            combine=True, regular=args.regular, mask=args.mask,
-                           overwrite=args.overwrite)
+                           pyramid=args.pyramid, overwrite=args.overwrite)
     if args.queue:
         reduce.queue('nxcombine', args)
     else:
@@ -9,12 +9,62 @@
 
 """Prefetch Julia and its packages so NXRefine can run offline."""
 
+import argparse
+import os
+import subprocess
 import sys
+import tempfile
 
-from nxrefine.nxutils import load_julia, prime_julia_environment
+from nxrefine.nxutils import (julia_sysimage, load_julia, package_files,
+                              prime_julia_environment)
+
+SYSIMAGE_SCRIPT = """
+include(raw"{laplace}")
+v = rand(9, 9, 9)
+LaplaceInterpolation.matern_3d_grid(v, [CartesianIndex(5, 5, 5)])
+LaplaceInterpolation.matern_3d_grid(v, [CartesianIndex(5, 5, 5)], 2, 0.5)
+"""
+
+BUILD_SCRIPT = """
+import Pkg
+Pkg.activate(; temp=true)
+Pkg.add("PackageCompiler")
+using PackageCompiler
+create_sysimage(["PythonCall"]; project=raw"{project}",
+                sysimage_path=raw"{sysimage}", script=raw"{script}")
+"""
+
+
+def build_sysimage(sysimage):
+    """Build a Julia system image containing the NXRefine functions.
+
+    The image is compiled by PackageCompiler, using the Julia binary and
+    project resolved by juliapkg, and includes the LaplaceInterpolation
+    module, so that it does not need to be included and compiled when a
+    new process starts Julia.
+    """
+    import juliapkg
+    resources = package_files('nxrefine.julia')
+    os.makedirs(os.path.dirname(sysimage), exist_ok=True)
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, 'sysimage.jl')
+        with open(script, 'w') as f:
+            f.write(SYSIMAGE_SCRIPT.format(
+                laplace=resources / 'LaplaceInterpolation.jl'))
+        build = os.path.join(directory, 'build.jl')
+        with open(build, 'w') as f:
+            f.write(BUILD_SCRIPT.format(project=juliapkg.project(),
+                                        sysimage=sysimage, script=script))
+        subprocess.run([juliapkg.executable(), build], check=True)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Install Julia and the Julia packages used by NXRefine")
+    parser.add_argument('-s', '--sysimage', action='store_true',
+                        help='build a precompiled Julia system image')
+    args = parser.parse_args()
+
     prime_julia_environment()
 
     import juliapkg
@@ -22,8 +72,14 @@ def main():
     print("Resolving Julia and Julia packages (requires internet)...")
     juliapkg.resolve()
 
+    if args.sysimage:
+        sysimage = julia_sysimage()
+        print(f"\nBuilding Julia system image '{sysimage}'...")
+        build_sysimage(sysimage)
+        os.environ.setdefault('PYTHON_JULIACALL_SYSIMAGE', sysimage)
+
     from juliacall import Main
-    Main.seval("using Roots, LinearAlgebra, SparseArrays")
+    Main.seval("using LinearAlgebra, SparseArrays")
 
     load_julia(['LaplaceInterpolation.jl'])
 
@@ -23,6 +23,24 @@ def main():
                         help='radius of punched holes in Å-1')
     parser.add_argument('-Q', '--Qmax', type=float,
                         help='Maximum Q in Å-1 used in PDF tapers')
+    parser.add_argument('-x', '--rmax', type=float,
+                        help='Maximum r in Å of a local PDF region')
+    parser.add_argument('-m', '--memory', type=float,
+                        help='memory budget in MB for in-core transforms')
+    parser.add_argument('-p', '--precision', default='double',
+                        choices=['single', 'double'],
+                        help='floating point precision of the transforms')
+    parser.add_argument('-i', '--interpolation', default='julia',
+                        choices=['julia', 'scipy'],
+                        help='backend used to fill punched holes')
+    parser.add_argument('-P', '--pipeline', action='store_true',
+                        help='keep intermediate volumes in memory')
+    parser.add_argument('-S', '--series', action='store_true',
+                        help='calculate PDFs of all scans in the parent')
+    parser.add_argument('-j', '--parallel', action='store_true',
+                        help='process the scans of a series in parallel')
+    parser.add_argument('-y', '--pyramid', action='store_true',
+                        help='write 2x, 4x, and 8x binned volumes')
     parser.add_argument('-R', '--regular', action='store_true',
                         help='Calculate using regular transforms')
     parser.add_argument('-M', '--mask', action='store_true',
@@ -36,10 +54,18 @@ def main():
 
     reduce = NXMultiReduce(directory=args.directory, pdf=True,
                            laue=args.laue, radius=args.radius, qmax=args.Qmax,
+                           memory=args.memory, precision=args.precision,
+                           interpolation=args.interpolation,
+                           pipeline=args.pipeline, rmax=args.rmax,
                            regular=args.regular, mask=args.mask,
-                           overwrite=args.overwrite)
+                           pyramid=args.pyramid, overwrite=args.overwrite)
     if args.queue:
         reduce.queue('nxpdf', args)
+    elif args.series:
+        if reduce.regular:
+            reduce.nxpdf_series(parallel=args.parallel)
+        if reduce.mask:
+            reduce.nxpdf_series(mask=True, parallel=args.parallel)
     else:
         if reduce.regular:
             reduce.nxpdf()
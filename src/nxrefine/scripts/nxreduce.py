@@ -47,6 +47,8 @@ def main():
                         help='perform regular CCTW transforms')
     parser.add_argument('-M', '--mask', action='store_true',
                         help='perform CCTW transforms with 3D mask')
+    parser.add_argument('-y', '--pyramid', action='store_true',
+                        help='write 2x, 4x, and 8x binned volumes')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing maximum')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -67,7 +69,7 @@ def main():
                           prepare=args.prepare, transform=args.transform,
                           combine=args.combine, pdf=args.pdf,
                           regular=args.regular, mask=args.mask,
-                          overwrite=args.overwrite)
+                          pyramid=args.pyramid, overwrite=args.overwrite)
         if args.queue:
             reduce.queue('nxreduce', args)
         else:
@@ -77,7 +79,8 @@ def main():
         reduce = NXMultiReduce(directory=args.directory,
                                subentry=args.subentry, combine=args.combine,
                                pdf=args.pdf, regular=args.regular,
-                               mask=args.mask, overwrite=args.overwrite)
+                               mask=args.mask, pyramid=args.pyramid,
+                               overwrite=args.overwrite)
         reduce.nxreduce()
 
 
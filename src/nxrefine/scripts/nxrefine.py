@@ -28,6 +28,10 @@ def main():
                         help='tolerance for including peak in Å-1')
     parser.add_argument('-s', '--subentry', default='',
                         help='subentry to be processed')
+    parser.add_argument('-S', '--series', action='store_true',
+                        help='refine all scans in the parent')
+    parser.add_argument('-j', '--parallel', action='store_true',
+                        help='process the scans of a series in parallel')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing maximum')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -35,6 +39,17 @@ def main():
 
     args = parser.parse_args()
 
+    if args.series:
+        reduce = NXMultiReduce(directory=args.directory,
+                               subentry=args.subentry,
+                               overwrite=args.overwrite)
+        if args.polar_max:
+            reduce.polar_max = args.polar_max
+        if args.hkl_tolerance:
+            reduce.hkl_tolerance = args.hkl_tolerance
+        reduce.nxrefine_series(lattice=args.lattice, parallel=args.parallel)
+        return
+
     if args.entries:
         entries = args.entries
     else:
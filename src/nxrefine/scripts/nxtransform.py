@@ -36,6 +36,8 @@ def main():
                         help='perform regular transform')
     parser.add_argument('-M', '--mask', action='store_true',
                         help='perform transform with 3D mask')
+    parser.add_argument('-y', '--pyramid', action='store_true',
+                        help='write 2x, 4x, and 8x binned volumes')
     parser.add_argument('-s', '--subentry', default='',
                         help='subentry to be processed')
     parser.add_argument('-o', '--overwrite', action='store_true',
@@ -54,7 +56,8 @@ def main():
         reduce = NXReduce(
             entry, args.subentry, args.directory, transform=True,
             Qh=to_array(args.qh), Qk=to_array(args.qk), Ql=to_array(args.ql),
-            regular=args.regular, mask=args.mask, overwrite=args.overwrite)
+            regular=args.regular, mask=args.mask, pyramid=args.pyramid,
+            overwrite=args.overwrite)
         if args.queue:
             reduce.queue('nxtransform', args)
         else:
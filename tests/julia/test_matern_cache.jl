@@ -0,0 +1,71 @@
+# Tests of the factorization caches used by LaplaceInterpolation.matern_3d_grid
+#
+# These are not collected by pytest. Run them, with several threads, using
+#
+#   julia --threads 4 tests/julia/test_matern_cache.jl
+
+using LinearAlgebra, SparseArrays, Test
+
+include(joinpath(@__DIR__, "..", "..", "src", "nxrefine", "julia",
+                 "LaplaceInterpolation.jl"))
+using .LaplaceInterpolation
+const LI = LaplaceInterpolation
+
+""" Interpolate without the caches """
+function reference_fill(imgg, discard, m, eps)
+    Nx, Ny, Nz = size(imgg)
+    A = nablasq_3d_grid(Nx, Ny, Nz, 1.0, 1.0, 1.0) + eps^2 * I
+    A3D = A
+    for i = 1:m - 1
+        A3D = A3D * A
+    end
+    C = sparse(I, length(imgg), length(imgg))
+    for j in discard
+        C[j, j] = 0.0
+    end
+    rhs = vec(copy(imgg))
+    rhs[discard] .= 0.0
+    return reshape((C - (I - C) * A3D) \ rhs, size(imgg))
+end
+
+""" Return the linear indices of a cubic punch centered at (i, j, k) """
+punch(i, j, k, n) = sort!(vec(LinearIndices((n, n, n))[i-1:i+1, j-1:j+1,
+                                                       k-1:k+1]))
+
+n = 9
+imgg = rand(n, n, n)
+
+@testset "matern_3d_grid" begin
+    for (m, eps) in ((1, 0.0), (2, 0.1))
+        discard = punch(5, 5, 5, n)
+        expected = reference_fill(imgg, discard, m, eps)
+        @test matern_3d_grid(imgg, discard, m, eps) ≈ expected
+        @test matern_3d_grid(imgg, discard, m, eps) ≈ expected
+    end
+end
+
+@testset "cache eviction" begin
+    store_max = LI.SETTINGS.A_matrix_STORE_MAX
+    punches = [punch(i, j, 5, n) for i in 2:8 for j in 2:4]
+    @test length(punches) > store_max
+    for discard in punches
+        matern_3d_grid(imgg, discard, 1, 0.0)
+    end
+    @test length(LI.A_factorization) == store_max
+    @test length(LI.A_factorization_order) == store_max
+    @test haskey(LI.A_factorization, (n, n, n, punches[end], 1, 0.0, 1.0, 1.0,
+                                      1.0))
+    @test !haskey(LI.A_factorization, (n, n, n, punches[1], 1, 0.0, 1.0, 1.0,
+                                       1.0))
+end
+
+@testset "threaded solves" begin
+    punches = [punch(i, j, k, n) for i in (3, 7) for j in (3, 7) for k in (3, 7)]
+    tasks = repeat(eachindex(punches), 4)
+    expected = [reference_fill(imgg, discard, 1, 0.0) for discard in punches]
+    results = Vector{Array{Float64, 3}}(undef, length(tasks))
+    Threads.@threads for i in eachindex(tasks)
+        results[i] = matern_3d_grid(imgg, punches[tasks[i]], 1, 0.0)
+    end
+    @test all(results[i] ≈ expected[tasks[i]] for i in eachindex(tasks))
+end
@@ -0,0 +1,27 @@
+"""Tests for auto-indexing with UBMatrixFFT."""
+
+import numpy as np
+
+from nxrefine.nxorient import UBMatrixFFT
+
+
+class TestProjections:
+
+    def test_histograms(self):
+        rng = np.random.default_rng(0)
+        q_vectors = rng.normal(size=(200, 3))
+        ub = UBMatrixFFT(min_d=2.0, max_d=10.0, dir_step_size=0.2,
+                         fft_num=64, q_vectors=q_vectors)
+        ub.initialize()
+        assert ub._fj_list.shape == (len(ub._t_list), 64)
+        idx_factor = ub.fft_num / ub._q_max
+        for i in (0, 17, len(ub._t_list) - 1):
+            projections = q_vectors @ ub._t_list[i]
+            expected = np.zeros(ub.fft_num)
+            for p in projections:
+                expected[int(np.floor(abs(p) * idx_factor))] += 1
+            np.testing.assert_array_equal(ub._fj_list[i], expected)
+            np.testing.assert_array_equal(
+                ub._projection(projections, idx_factor), expected)
+        np.testing.assert_allclose(
+            ub._magnitude_fft, np.abs(np.fft.rfft(ub._fj_list, axis=1)))
@@ -0,0 +1,269 @@
+"""Tests for the numerical helpers used in PDF calculations."""
+
+import numpy as np
+import scipy.fft
+
+from nxrefine.nxpdf import (PunchFillView, WeightsTaper, laplacian_3d_grid,
+                            matern_3d_grid, matern_factorization, pdf_axes,
+                            pdf_memory, pdf_transform, pdf_transform_chunked,
+                            pdf_transform_local, punch_batches,
+                            punch_fill_blocks, spherical_taper)
+
+
+def reference_taper(x, y, z, qmax):
+    """Original meshgrid implementation of the spherical taper."""
+    Z, Y, X = np.meshgrid(z, y, x, indexing='ij')
+    taper = np.ones(X.shape, dtype=np.float32)
+    R = 2 * np.sqrt(X**2 + Y**2 + Z**2) / qmax
+    idx = (R > 1.0) & (R < 2.0)
+    taper[idx] = 0.5 * (1 - np.cos(R[idx] * np.pi))
+    taper[R >= 2.0] = taper.min()
+    return taper
+
+
+def grid():
+    return (np.linspace(-6, 6, 25) * 1.1, np.linspace(-5, 5, 21) * 1.2,
+            np.linspace(-4, 4, 17) * 0.9)
+
+
+class TestTaper:
+
+    def test_matches_meshgrid_taper(self):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        assert taper.shape == (17, 21, 25)
+        assert taper.dtype == np.float32
+        np.testing.assert_allclose(taper, reference_taper(x, y, z, 9.0),
+                                   atol=1e-6)
+
+    def test_taper_is_cached(self):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 8.0)
+        assert spherical_taper(x, y, z, 8.0) is taper
+        assert spherical_taper(x, y, z, 7.0) is not taper
+        assert not any(isinstance(value, np.ndarray) and value.ndim > 1
+                       for value in vars(taper).values())
+
+    def test_taper_slabs(self):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        full = np.asarray(taper)
+        np.testing.assert_array_equal(taper[3:9, :-1, 2:], full[3:9, :-1, 2:])
+        np.testing.assert_array_equal(taper[..., 4], full[..., 4])
+        np.testing.assert_array_equal(taper[16, 0, 0], full[16, 0, 0])
+        np.testing.assert_array_equal(
+            spherical_taper(x, y, z, 40.0), np.ones(taper.shape))
+
+
+class TestTransform:
+
+    def test_matches_shifted_fftn(self):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(0).random(taper.shape)
+        original = data.copy()
+        tapered = (data * taper)[:-1, :-1, :-1]
+        expected = np.real(scipy.fft.fftshift(scipy.fft.fftn(
+            scipy.fft.fftshift(tapered)))) / tapered.size
+        np.testing.assert_allclose(pdf_transform(data, taper), expected,
+                                   atol=1e-10)
+        np.testing.assert_array_equal(data, original)
+
+    def test_chunked_matches_in_core(self, tmp_path):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(1).random(taper.shape)
+        expected = pdf_transform(data, taper)
+        output = np.zeros(expected.shape)
+        pdf_transform_chunked(data, taper, output, tmp_path / 'scratch.npy',
+                              3)
+        np.testing.assert_allclose(output, expected, atol=1e-12)
+
+    def test_chunked_reads_taper_slabs(self, tmp_path):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(6).random(taper.shape)
+        expected = pdf_transform(data, taper)
+        sizes = []
+
+        class RecordedTaper(WeightsTaper):
+            def __getitem__(self, index):
+                slab = super().__getitem__(index)
+                sizes.append(slab.shape[0])
+                return slab
+
+        weights = RecordedTaper(1.0 / np.asarray(taper)[None])
+        assert weights.shape == taper.shape
+        output = np.zeros(expected.shape)
+        pdf_transform_chunked(data, weights, output,
+                              tmp_path / 'scratch.npy', 3)
+        np.testing.assert_allclose(output, expected, atol=1e-6)
+        assert max(sizes) == 3
+
+    def test_memory(self):
+        shape = (401, 401, 401)
+        in_core = pdf_memory(shape, 8, np.float32)
+        assert in_core > 400**3 * (8 + 4*4)
+        slab = pdf_memory(shape, 8, np.float32, chunk_size=1)
+        assert pdf_memory(shape, 8, np.float32, chunk_size=10) == 10 * slab
+        assert slab < in_core / 100
+        assert pdf_memory(shape, 8, np.float32, chunk_size=1,
+                          processes=8) > slab
+
+    def test_chunked_skips_empty_slabs(self, tmp_path):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(5).random(taper.shape)
+        data[:6] = data[12:] = 0.0
+        expected = pdf_transform(data, taper)
+        output = np.zeros(expected.shape)
+        pdf_transform_chunked(data, taper, output, tmp_path / 'scratch.npy',
+                              2)
+        np.testing.assert_allclose(output, expected, atol=1e-12)
+
+    def test_odd_grid_matches_fftn(self):
+        data = np.random.default_rng(2).random((12, 10, 9))
+        taper = np.ones(data.shape)
+        tapered = data[:-1, :-1, :-1]
+        expected = np.real(scipy.fft.fftshift(scipy.fft.fftn(
+            scipy.fft.fftshift(tapered)))) / tapered.size
+        np.testing.assert_allclose(pdf_transform(data, taper), expected,
+                                   atol=1e-10)
+
+    def test_single_precision(self, tmp_path):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(3).random(taper.shape)
+        expected = pdf_transform(data, taper)
+        fft = pdf_transform(data, taper, dtype=np.float32)
+        assert fft.dtype == np.float32
+        np.testing.assert_allclose(fft, expected, atol=1e-5)
+        output = np.zeros(expected.shape, dtype=np.float32)
+        pdf_transform_chunked(data, taper, output, tmp_path / 'scratch.npy',
+                              5, dtype=np.float32)
+        np.testing.assert_allclose(output, expected, atol=1e-5)
+
+    def test_local_matches_full_grid(self):
+        x, y, z = grid()
+        taper = spherical_taper(x, y, z, 9.0)
+        data = np.random.default_rng(4).random(taper.shape)
+        steps = (z[1]-z[0], y[1]-y[0], x[1]-x[0])
+        expected = pdf_transform(data, taper)
+        full = pdf_axes(data.shape, steps)
+        local = pdf_axes(data.shape, steps, rmax=(0.5, 0.4, 0.3))
+        index = np.ix_(*[np.isin(f, r) for f, r in zip(full, local)])
+        assert expected[index].shape == (7, 9, 7)
+        fft = pdf_transform_local(data, taper, steps, local, chunk_size=5)
+        np.testing.assert_allclose(fft, expected[index], atol=1e-10)
+
+
+class TestPunchBatches:
+
+    def test_grid_indices(self):
+        axes = (np.linspace(-4, 4, 81), np.linspace(-5, 5, 101),
+                np.linspace(-6, 6, 121))
+        indices = [(0, 0, 0), (1, 2, 3), (-6, 0, 0), (6, 5, 4), (0.05, 0, 0),
+                   (7, 0, 0)]
+        batches, rejected = punch_batches(indices, axes, (5, 5, 5),
+                                          chunks=(10, 10, 10))
+        corners = {hkl: tuple(corner.tolist())
+                   for reflections, cubes in batches
+                   for hkl, corner in zip(reflections, cubes)}
+        assert corners == {(0, 0, 0): (38, 48, 58), (1, 2, 3): (68, 68, 68)}
+        assert dict((hkl, bucket) for bucket, hkl, _ in rejected) == {
+            (-6, 0, 0): 'edge', (6, 5, 4): 'edge', (0.05, 0, 0): 'off_grid',
+            (7, 0, 0): 'off_grid'}
+
+    def test_batches_are_chunk_aligned(self):
+        axes = (np.arange(100.0), np.arange(100.0), np.arange(100.0))
+        indices = [(H, K, L) for H in range(10, 90, 7)
+                   for K in range(10, 90, 13) for L in range(10, 90, 17)]
+        batches, rejected = punch_batches(indices, axes, (3, 3, 3),
+                                          chunks=(8, 8, 8))
+        assert not rejected
+        assert sum(len(reflections) for reflections, _ in batches) == len(
+            indices)
+        for _, corners in batches:
+            blocks = (corners + 1) // 16
+            assert np.all(blocks == blocks[0])
+
+
+def punched_cube():
+    ml, mk, mh = np.ogrid[0:9, 0:7, 0:11]
+    mask = ((ml-4)/2)**2 + ((mk-3)/1.5)**2 + ((mh-5)/2.5)**2 <= 1
+    return mask, np.argwhere(mask)
+
+
+class TestMatern:
+
+    def test_laplacian(self):
+        laplacian = laplacian_3d_grid((4, 3, 5))
+        np.testing.assert_allclose(laplacian.sum(axis=1), 0)
+        degree = laplacian.diagonal().reshape(4, 3, 5)
+        assert degree[0, 0, 0] == 3 and degree[1, 1, 1] == 6
+
+    def test_reproduces_linear_data(self):
+        mask, punched = punched_cube()
+        ml, mk, mh = np.ogrid[0:9, 0:7, 0:11]
+        data = np.broadcast_to(1.0 + 0.5*ml - 0.2*mk + 0.1*mh, mask.shape)
+        for m, epsilon in [(1, 0.0), (2, 0.0)]:
+            filled = matern_3d_grid(np.where(mask, 0.0, data), punched,
+                                    m=m, epsilon=epsilon)
+            np.testing.assert_allclose(filled, data, atol=1e-10)
+
+    def test_known_voxels_unchanged(self):
+        mask, punched = punched_cube()
+        data = np.random.default_rng(4).random(mask.shape)
+        filled = matern_3d_grid(data, punched, m=2, epsilon=0.5)
+        np.testing.assert_array_equal(filled[~mask], data[~mask])
+        assert np.all(filled[mask] > 0) and np.all(filled[mask] < 1)
+
+    def test_factorization_is_reused(self):
+        mask, punched = punched_cube()
+        system = matern_factorization(mask.shape, punched, m=2)
+        assert matern_factorization(mask.shape, punched, m=2) is system
+        assert matern_factorization(mask.shape, punched, m=1) is not system
+        rng = np.random.default_rng(5)
+        for _ in range(3):
+            data = rng.random(mask.shape)
+            filled = matern_3d_grid(data, punched, m=2)
+            laplacian = laplacian_3d_grid(mask.shape)
+            residual = (laplacian @ (laplacian @ filled.ravel()))
+            np.testing.assert_allclose(residual.reshape(mask.shape)[mask], 0,
+                                       atol=1e-10)
+
+
+class TestPunchFillView:
+
+    def setup_method(self):
+        rng = np.random.default_rng(6)
+        self.data = rng.random((20, 17, 23))
+        self.fill = np.zeros(self.data.shape)
+        for corner in [(0, 0, 0), (8, 5, 11), (15, 13, 20)]:
+            index = tuple(slice(c, c+4) for c in corner)
+            self.fill[index] = rng.random(self.fill[index].shape) + 1
+        self.changed = self.fill > 0
+        self.blocks = punch_fill_blocks(self.fill, self.changed, (5, 5, 5))
+
+    def test_blocks(self):
+        corners, values, mask = self.blocks
+        assert values.shape[1:] == (5, 5, 5)
+        assert mask.sum() == self.changed.sum()
+        np.testing.assert_array_equal(np.sort(values[mask]),
+                                      np.sort(self.fill[self.changed]))
+
+    def test_filled_view(self):
+        view = PunchFillView(self.data, *self.blocks)
+        expected = np.where(self.changed, self.fill, self.data)
+        assert view.shape == self.data.shape
+        np.testing.assert_array_equal(view.nxvalue, expected)
+        np.testing.assert_array_equal(view[3:18, :-1, 10:], expected[
+            3:18, :-1, 10:])
+        np.testing.assert_array_equal(view[9, 6], expected[9, 6])
+
+    def test_punched_view(self):
+        view = PunchFillView(self.data, *self.blocks, filled=False)
+        expected = np.where(self.changed, 0, self.data)
+        np.testing.assert_array_equal(view[...], expected)
+        np.testing.assert_array_equal(view[14:, 12:, 19:], expected[
+            14:, 12:, 19:])
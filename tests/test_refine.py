@@ -0,0 +1,312 @@
+"""Tests for the crystallographic calculations in NXRefine."""
+
+import numpy as np
+from lmfit import Parameters
+
+from nxrefine.nxrefine import NXRefine, rotmat, rotmats
+from nxrefine.nxutils import refine_trial
+
+
+def monoclinic_refine(npks=200, seed=0):
+    """Return an oriented monoclinic crystal with random peak positions."""
+    refine = NXRefine()
+    refine.a, refine.b, refine.c = 4.1, 5.3, 6.7
+    refine.beta = 103.0
+    refine.space_group = 'P121'
+    refine.wavelength = 0.3
+    refine.distance = 600.0
+    refine.pixel_size = 0.172
+    refine.xc, refine.yc = 740.0, 820.0
+    refine.yaw, refine.pitch, refine.roll = 0.3, -0.2, 0.1
+    refine.chi, refine.omega, refine.theta = -88.0, 1.0, 0.5
+    refine.xs, refine.ys, refine.zs = 0.01, -0.02, 0.03
+    refine.phi, refine.phi_step = -5.0, 0.1
+    refine.Umat = rotmat(1, 20) * rotmat(2, -35) * rotmat(3, 50)
+    rng = np.random.default_rng(seed)
+    refine.xp = rng.uniform(0, 1475, npks)
+    refine.yp = rng.uniform(0, 1679, npks)
+    refine.zp = rng.uniform(0, 3600, npks)
+    refine.intensity = rng.uniform(1, 100, npks)
+    refine.polar_angle, refine.azimuthal_angle = refine.calculate_angles(
+        refine.xp, refine.yp)
+    refine.polar_max = 30.0
+    return refine
+
+
+def predicted_refine():
+    """Return a crystal whose peaks are predicted from its parameters."""
+    refine = monoclinic_refine()
+    refine.shape = [1679, 1475]
+    peaks = refine.get_xyzs(4, 4, 4)
+    refine.xp = np.array([peak.x for peak in peaks])
+    refine.yp = np.array([peak.y for peak in peaks])
+    refine.zp = np.array([peak.z for peak in peaks])
+    refine.intensity = np.ones(refine.xp.shape)
+    refine.polar_angle, refine.azimuthal_angle = refine.calculate_angles(
+        refine.xp, refine.yp)
+    refine.initialize_idx(hkl_tolerance=0.5)
+    return refine
+
+
+class TestVectorized:
+
+    def test_rotmats(self):
+        angles = [0.0, 12.5, -170.0]
+        for axis in (1, 2, 3):
+            for angle, mat in zip(angles, rotmats(axis, angles)):
+                np.testing.assert_allclose(mat, rotmat(axis, angle),
+                                           atol=1e-15)
+
+    def test_angles(self):
+        refine = NXRefine()
+        radius = refine.distance * np.tan(np.radians([0.0, 5.0, 10.0]))
+        x = refine.xc + radius / refine.pixel_size
+        y = np.full(x.shape, refine.yc)
+        polar_angles, _ = refine.calculate_angles(x, y)
+        np.testing.assert_allclose(polar_angles, [0.0, 5.0, 10.0],
+                                   atol=1e-12)
+        refine.xp, refine.yp = x, y
+        assert np.isclose(refine.polar(2), 10.0)
+
+    def test_hkls_match_single_peaks(self):
+        refine = monoclinic_refine()
+        hkls = refine.calculate_hkls(refine.xp, refine.yp, refine.zp)
+        for i in range(0, refine.npks, 17):
+            np.testing.assert_allclose(hkls[i], refine.hkl(i), rtol=1e-12)
+            np.testing.assert_allclose(
+                refine.calculate_Gvecs(refine.xp[i], refine.yp[i],
+                                       refine.zp[i])[0],
+                np.asarray(refine.Gvec(*refine.xyz(i))).ravel())
+            assert np.isclose(refine.hkl_diffs(hkls)[i], refine.diff(i))
+
+    def test_idx_and_diffs(self):
+        refine = monoclinic_refine()
+        refine.initialize_idx(hkl_tolerance=0.08)
+        idx = refine.idx
+        assert 0 < len(idx) < refine.npks
+        assert np.all(refine.polar_angle[idx] <= refine.polar_max)
+        diffs = refine.diffs()
+        assert np.all(diffs <= 0.08)
+        np.testing.assert_allclose(diffs, [refine.diff(i) for i in idx])
+        np.testing.assert_allclose(refine.get_Gvecs(),
+                                   refine.calculate_Gvecs(refine.xp[idx],
+                                                          refine.yp[idx],
+                                                          refine.zp[idx]))
+
+    def test_hkl_maps(self):
+        refine = monoclinic_refine()
+        refine.shape = [49, 37]
+        H, K, L = refine.calculate_hkl_maps(12.5)
+        assert H.shape == (49, 37)
+        y, x = np.mgrid[0:49, 0:37]
+        np.testing.assert_allclose(
+            np.stack((H, K, L), axis=-1),
+            refine.calculate_hkls(x.ravel(), y.ravel(),
+                                  12.5).reshape(49, 37, 3),
+            rtol=1e-12, atol=1e-12)
+        maps = refine.calculate_hkl_maps([12.5, 100.0], binning=3)
+        assert maps[0].shape == (2, 17, 13)
+        np.testing.assert_allclose(maps[1][0, :-1, :-1], K[1:-1:3, 1:-1:3],
+                                   rtol=1e-12)
+
+    def test_predicted_peaks_are_indexed(self):
+        refine = monoclinic_refine()
+        refine.shape = [1679, 1475]
+        peaks = refine.get_xyzs(4, 4, 4)
+        assert len(peaks) > 100
+        xyz = np.array([(peak.x, peak.y, peak.z) for peak in peaks])
+        hkls = np.array([(peak.H, peak.K, peak.L) for peak in peaks])
+        np.testing.assert_allclose(refine.calculate_hkls(*xyz.T), hkls,
+                                   atol=1e-9)
+        assert not any(refine.absent(*hkl) for hkl in hkls)
+        assert len(refine.get_xyz(1, 2, 3)) == 2
+
+
+class TestMatrixCache:
+
+    def test_invalidation(self):
+        refine = monoclinic_refine()
+        Bmat, UBmat, Dmat = refine.Bmat, refine.UBmat, refine.Dmat
+        assert refine.Bmat is Bmat and refine.UBmat is UBmat
+        refine.roll = 0.5
+        assert refine.Bmat is Bmat and refine.Dmat is not Dmat
+        np.testing.assert_allclose(
+            refine.Dimat, rotmat(1, 0.5) * rotmat(2, -0.2) * rotmat(3, 0.3))
+        refine.a = 4.2
+        assert refine.Bmat is not Bmat
+        np.testing.assert_allclose(refine.Bimat @ refine.Bmat, np.eye(3),
+                                   atol=1e-12)
+        UBmat = refine.UBmat
+        refine.Umat[0, 0] += 0.01
+        assert refine.UBmat is not UBmat
+        np.testing.assert_allclose(refine.UBimat @ refine.UBmat, np.eye(3),
+                                   atol=1e-12)
+
+
+class TestJacobians:
+
+    def numerical_jacobian(self, residuals, parameters, step=1e-6):
+        columns = []
+        for name in parameters:
+            p1, p2 = parameters.copy(), parameters.copy()
+            p1[name].value += step
+            p2[name].value -= step
+            columns.append((residuals(p1) - residuals(p2)) / (2 * step))
+        residuals(parameters)
+        return np.stack(columns, axis=-1)
+
+    def test_hkl_jacobian(self):
+        refine = predicted_refine()
+        refine.distance += 0.5
+        parameters = Parameters()
+        for name in refine.jacobian_names:
+            parameters.add(name, getattr(refine, name))
+        np.testing.assert_allclose(
+            refine.hkl_jacobian(parameters),
+            self.numerical_jacobian(refine.hkl_residuals, parameters),
+            atol=1e-7)
+        np.testing.assert_allclose(
+            refine.angle_jacobian(parameters),
+            self.numerical_jacobian(refine.angle_residuals, parameters),
+            atol=1e-5)
+        parameters = refine.define_orientation_matrix()
+        np.testing.assert_allclose(
+            refine.orient_jacobian(parameters),
+            self.numerical_jacobian(refine.orient_residuals, parameters),
+            atol=1e-7)
+
+    def test_refinement(self):
+        refine = predicted_refine()
+        refine.distance += 1.0
+        refine.a += 0.01
+        refine.yaw += 0.05
+        refine.refine_hkls(distance=True, a=True, yaw=True)
+        assert refine.result.success
+        assert np.isclose(refine.distance, 600.0)
+        assert np.isclose(refine.a, 4.1)
+        assert np.isclose(refine.yaw, 0.3)
+        assert refine.result.nfev < 10
+
+    def test_angle_refinement(self):
+        refine = predicted_refine()
+        refine.distance += 1.0
+        refine.refine_angles(distance=True)
+        assert refine.result.method == 'Nelder-Mead'
+        nelder = refine.distance
+        refine.distance = 601.0
+        refine.refine_angles(method='leastsq', distance=True)
+        assert refine.result.method == 'leastsq'
+        assert refine.result.success
+        assert np.isclose(refine.distance, nelder, rtol=1e-4)
+
+
+class TestRings:
+
+    def test_equivalents(self):
+        for space_group, cell in [('P 1 21 1', (4.1, 5.3, 6.7, 90, 103, 90)),
+                                  ('P 3 2 1', (4.9, 4.9, 5.4, 90, 90, 120)),
+                                  ('F d -3', (8.0, 8.0, 8.0, 90, 90, 90))]:
+            refine = NXRefine()
+            refine.a, refine.b, refine.c = cell[:3]
+            refine.alpha, refine.beta, refine.gamma = cell[3:]
+            refine.space_group = space_group
+            refine.polar_max = 30.0
+            assert refine.miller is refine.miller
+            for hkl, hkls in zip(refine.miller, refine.equivalents):
+                assert hkls == refine.indices_hkl(*hkl)
+
+    def test_rings(self):
+        refine = monoclinic_refine()
+        rings = refine.make_rings()
+        assert refine.make_rings() is rings
+        ring_angles = np.array([rings[r][0] for r in rings])
+        assert np.all(np.diff(ring_angles) > 0)
+        refine.assign_rings()
+        for polar_angle, rp in zip(refine.polar_angle, refine.rp):
+            assert rp == np.abs(polar_angle - ring_angles).argmin()
+        refine.polar_tolerance = 0.2
+        assert len(refine.make_rings()) < len(rings)
+
+
+class TestMultistart:
+
+    def test_state(self):
+        refine = monoclinic_refine()
+        state = refine.get_state()
+        other = NXRefine()
+        other.set_state(state)
+        np.testing.assert_allclose(other.UBmat, refine.UBmat)
+        np.testing.assert_array_equal(other.zp, refine.zp)
+        other.Umat[0, 0] += 0.01
+        assert refine.Umat[0, 0] != other.Umat[0, 0]
+
+    def test_refine_multistart(self):
+        refine = predicted_refine()
+        refine.Umat = rotmat(1, 3.0) * refine.Umat
+        refine.distance += 1.0
+        score = refine.score()
+        scores = refine.refine_multistart(trials=3, max_workers=1, seed=0,
+                                          distance=True)
+        assert len(scores) == 3
+        assert refine.score() < score
+        assert np.isclose(refine.hkl_score(), min(scores))
+
+    def test_refine_multistart_pool(self):
+        for lattice in (False, True):
+            refine = predicted_refine()
+            refine.distance += 1.0
+            scores = refine.refine_multistart(trials=4, max_workers=2,
+                                              seed=0, distance=True,
+                                              lattice=lattice)
+            assert len(scores) == 4
+            assert np.all(np.isfinite(scores))
+            assert np.isclose(refine.hkl_score(), min(scores))
+            assert np.isclose(refine.distance, 600.0)
+            assert np.isclose(refine.a, 4.1)
+
+    def test_rejected_trials(self):
+        refine = predicted_refine()
+        state = refine.get_state(peaks=False)
+        peaks = {name: getattr(refine, name) for name in refine.peak_names}
+        score, _, report = refine_trial(state, peaks, {'distance': True},
+                                        bounds={'distance': (0.0, 500.0)})
+        assert score == np.inf and 'distance' in report
+        score, _, report = refine_trial(state, peaks, {},
+                                        min_indexed=refine.npks + 1)
+        assert score == np.inf and 'indexed' in report
+        score, refined, _ = refine_trial(state, peaks, {})
+        assert np.isclose(score, refine.hkl_score(), atol=1e-12)
+        refine.a *= 1000.0
+        assert refine.score() < 1e-3 * refined['a']
+        assert refine.hkl_score() > 0.1
+
+
+class TestStaged:
+
+    def test_stratified_idx(self):
+        refine = monoclinic_refine(npks=2000)
+        refine.hkl_tolerance = 1.0
+        idx = refine.idx
+        subset = refine.stratified_idx(200)
+        assert len(subset) == 200
+        assert np.all(np.diff(subset) > 0)
+        assert np.all(np.isin(subset, idx))
+        assert idx[np.argmax(refine.intensity[idx])] in subset
+        edges = np.quantile(refine.zp[idx], np.linspace(0, 1, 9))
+        counts, _ = np.histogram(refine.zp[subset], edges)
+        assert counts.min() >= 20
+        np.testing.assert_array_equal(refine.stratified_idx(len(idx)), idx)
+
+    def test_staged_refinement(self):
+        refine = predicted_refine()
+        refine.distance += 1.0
+        refine.a += 0.01
+        npks = len(refine.idx)
+        refine.refine_hkls(npeaks=50, distance=True, a=True)
+        assert refine.result.success
+        assert len(refine.idx) == npks
+        assert np.isclose(refine.distance, 600.0)
+        assert np.isclose(refine.a, 4.1)
+        refine.Umat = rotmat(1, 0.2) * refine.Umat
+        refine.refine_orientation_matrix(npeaks=50)
+        assert refine.score() < 1e-6
@@ -0,0 +1,123 @@
+"""Tests for blockwise arithmetic and binned levels of transforms."""
+
+import numpy as np
+import pytest
+from nexusformat.nexus import (NeXusError, NXdata, NXentry, NXfield, NXlink,
+                               nxopen)
+
+from nxrefine.nxutils import (read_stored_chunks, stored_chunks,
+                              write_nonzero_chunks)
+from nxrefine.nxvolume import (NXArithmetic, NXPyramid, bin_volume,
+                               check_expression, evaluate_expression,
+                               parse_expression, write_pyramid)
+
+
+def transform_group(directory, label, v, n):
+    """Create a transform file and a wrapper group linking to it."""
+    transform_file = directory / f'{label}_transform.nxs'
+    with nxopen(transform_file, 'w') as root:
+        root['entry'] = NXentry()
+        root['entry/data'] = NXdata()
+        root['entry/data/v'] = NXfield(v, chunks=(4,)+v.shape[1:])
+        root['entry/data/n'] = NXfield(n)
+    axes = [NXfield(np.linspace(-1, 1, size), name=name)
+            for size, name in zip(v.shape, ['Ql', 'Qk', 'Qh'])]
+    with nxopen(directory / f'{label}.nxs', 'w') as root:
+        root['entry'] = NXentry()
+        root['entry/transform'] = NXdata(
+            NXlink(name='data', target='/entry/data/v', file=transform_file),
+            axes)
+        root['entry/transform/weights'] = NXlink(target='/entry/data/n',
+                                                 file=transform_file)
+    return nxopen(directory / f'{label}.nxs')['entry/transform']
+
+
+class TestArithmetic:
+
+    def test_parse_expression(self):
+        assert parse_expression('(signal/weights)_T1 - T2', ['T1', 'T2']) == (
+            '(signal_T1/weights_T1) - T2')
+
+    def test_check_expression(self):
+        names = ['T1', 'signal_T1']
+        tree = check_expression(
+            'where(T1 > 0, sqrt(signal_T1) / T1, -1) ** 2', names)
+        values = {'T1': np.array([0.0, 4.0]),
+                  'signal_T1': np.array([1.0, 16.0])}
+        np.testing.assert_array_equal(evaluate_expression(tree, values),
+                                      [1.0, 1.0])
+        for expression in ['().__class__.__mro__', 'T1.real', 'T2 + 1',
+                           'open("x")', 'T1[0]', 'lambda: T1', '"T1"',
+                           'clip(**T1)', '[T1]', 'T1 if T1 else T1']:
+            with pytest.raises(NeXusError):
+                check_expression(expression, names)
+
+    def test_difference(self, tmp_path):
+        rng = np.random.default_rng(0)
+        shape = (18, 7, 9)
+        v1, v2 = [rng.random(shape).astype(np.float32) for _ in range(2)]
+        n1, n2 = [rng.integers(0, 3, shape).astype(np.float32)
+                  for _ in range(2)]
+        volumes = {'T1': transform_group(tmp_path, 'T1', v1, n1),
+                   'T2': transform_group(tmp_path, 'T2', v2, n2)}
+        arithmetic = NXArithmetic(
+            '(signal/weights)_T1 - (signal/weights)_T2', volumes,
+            memory=0.01)
+        assert len(arithmetic.blocks) == 5
+        arithmetic.evaluate(tmp_path / 'difference.nxs')
+        valid = (n1 > 0) & (n2 > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = np.where(valid, v1/n1 - v2/n2, 0.0)
+        result = nxopen(tmp_path / 'difference.nxs')['entry/data']
+        np.testing.assert_allclose(result.nxsignal.nxvalue, expected,
+                                   rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(result.nxweights.nxvalue, valid)
+
+
+class TestPyramid:
+
+    def test_bin_volume(self):
+        data = np.arange(5*6*7, dtype=float).reshape(5, 6, 7)
+        binned = bin_volume(data, 2)
+        assert binned.shape == (3, 3, 4)
+        assert binned[0, 0, 0] == data[:2, :2, :2].sum()
+        assert binned[-1, -1, -1] == data[4:, 4:, 6:].sum()
+        assert binned.sum() == data.sum()
+
+    def test_levels(self, tmp_path):
+        rng = np.random.default_rng(1)
+        shape = (21, 17, 19)
+        v = rng.random(shape).astype(np.float32)
+        n = rng.integers(0, 3, shape).astype(np.float32)
+        group = transform_group(tmp_path, 'T', v, n)
+        write_pyramid(group, memory=0.01)
+        pyramid = NXPyramid(group)
+        assert sorted(pyramid.levels) == [1, 2, 4, 8]
+        for factor in (2, 4, 8):
+            level = pyramid.levels[factor]
+            np.testing.assert_allclose(level.nxsignal.nxvalue,
+                                       bin_volume(v, factor), rtol=1e-5)
+            np.testing.assert_allclose(level.nxweights.nxvalue,
+                                       bin_volume(n, factor), rtol=1e-5)
+        assert pyramid.level() == 8
+        assert pyramid.level([(0, 0), None, None], (1, 5, 4)) == 4
+        assert pyramid.level([(0, 0), None, None], (1, 17, 19)) == 1
+        view = pyramid.view([(0, 0), None, None], (1, 5, 4))
+        assert view.nxsignal.shape == (5, 5)
+
+
+class TestStoredChunks:
+
+    def test_empty_chunks_are_not_stored(self, tmp_path):
+        data = np.zeros((20, 18, 16), dtype=np.float32)
+        data[2:5, 3:7, 1:4] = 1.0
+        data[15, 17, 15] = 2.0
+        with nxopen(tmp_path / 'sparse.nxs', 'w') as root:
+            root['entry'] = NXentry()
+            root['entry/v'] = NXfield(shape=data.shape, dtype=data.dtype,
+                                      chunks=(4, 4, 4), fillvalue=0)
+            write_nonzero_chunks(root['entry/v'], data)
+        field = nxopen(tmp_path / 'sparse.nxs')['entry/v']
+        assert len(stored_chunks(field)) == 5
+        np.testing.assert_array_equal(read_stored_chunks(field), data)
+        assert stored_chunks(NXfield(data)) is None